@@ -1,16 +1,258 @@
+import os
+import base64
+import binascii
+import shlex
 import yaml
+import asyncio
 import logging
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any, Optional, Tuple, Union
 from ssh_manager import pool
+from executors import run_batch
+from commands import (
+    PLAYBOOK_STRATEGIES, SerialSpec, parse_max_fail_percentage, serial_batches, rollout_should_abort
+)
+from capture import CAPTURE_MAX_BYTES
 
 logger = logging.getLogger(__name__)
 
+SUPPORTED_MODULES = ["apt", "service", "file", "shell"]
+
+# Compiled module scripts report their outcome on a line starting with this marker
+RESULT_MARKER = "__NEUTRON_RESULT__"
+
+# Pipelined plays report one record per task on lines starting with this marker
+TASK_MARKER = "__NEUTRON_TASK__"
+# Modules that compile to a script and can be shipped in a pipelined program
+PIPELINE_MODULES = {"apt", "service", "file", "shell"}
+# Idle timeout for a pipelined program (tasks run silently, output goes to temp files)
+PIPELINE_TIMEOUT = int(os.getenv("PLAYBOOK_PIPELINE_TIMEOUT", "1800"))
+
+# apt install scripts list the packages they had to install after this marker
+APT_MISSING_MARKER = "__NEUTRON_APT_MISSING__"
+APT_STAMP_DIR = "/var/lib/apt/periodic"
+
+# Hosts a task runs on concurrently (Ansible's `forks`)
+DEFAULT_FORKS = int(os.getenv("PLAYBOOK_FORKS", "50"))
+
+
+def _report(status: str) -> str:
+    return f"echo {RESULT_MARKER} {status}"
+
+
+def _fail(message: str) -> str:
+    return f"{{ echo {shlex.quote(f'{RESULT_MARKER} failed {message}')}; exit 1; }}"
+
+
+def parse_script_result(exit_code: int, stdout: str, stderr: str) -> tuple[bool, bool, str]:
+    """Turn a module script's output into (success, changed, error)"""
+    status, message = "", ""
+    other_lines = []
+    for line in stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            _, _, rest = line.partition(" ")
+            status, _, message = rest.partition(" ")
+        else:
+            other_lines.append(line)
+    detail = stderr or "\n".join(other_lines)
+
+    if status == "failed" or exit_code != 0 or not status:
+        reason = message or f"Exit code {exit_code}"
+        return False, False, f"{reason}: {detail}"
+    return True, status == "changed", ""
+
+
+def shell_result(exit_code: int, stdout: str, stderr: str) -> tuple[bool, bool, str]:
+    """Outcome of a shell task"""
+    if exit_code == 0:
+        # Shell command is always reported as changed if it runs successfully
+        return True, True, stdout
+    return False, False, f"Exit code {exit_code}: {stderr or stdout}"
+
+
+def build_pipeline_script(scripts: List[str]) -> str:
+    """Chain task scripts into one program that reports a record per task.
+
+    Each task runs in a subshell with its output captured to temp files; a
+    `__NEUTRON_TASK__ <index> <exit code> <stdout b64> <stderr b64>` line is
+    printed when it finishes, and the program stops at the first failure.
+    """
+    limit = CAPTURE_MAX_BYTES
+    lines = [
+        'tmp=$(mktemp -d) || exit 1',
+        'trap \'rm -rf "$tmp"\' EXIT'
+    ]
+    for index, script in enumerate(scripts):
+        lines.append(f'( {script}\n) </dev/null >"$tmp/out" 2>"$tmp/err"; rc=$?')
+        lines.append(
+            f'printf \'%s %s %s %s %s\\n\' {TASK_MARKER} {index} "$rc" '
+            f'"$(head -c {limit} "$tmp/out" | base64 | tr -d \'\\n\')" '
+            f'"$(head -c {limit} "$tmp/err" | base64 | tr -d \'\\n\')"'
+        )
+        lines.append('[ "$rc" -eq 0 ] || exit 0')
+    return "\n".join(lines)
+
+
+def parse_task_record(line: str) -> Optional[Tuple[int, int, str, str]]:
+    """Decode a pipelined task record into (index, exit code, stdout, stderr)"""
+    parts = line.rstrip("\r").split(" ")
+    if len(parts) != 5 or parts[0] != TASK_MARKER:
+        return None
+    try:
+        out, err = (base64.b64decode(p).decode("utf-8", errors="replace") for p in parts[3:])
+        return int(parts[1]), int(parts[2]), out, err
+    except (ValueError, binascii.Error):
+        return None
+
+
+def parse_apt_args(args: Any) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Normalize apt arguments into a spec, or return (None, error)"""
+    if isinstance(args, str):
+        names, state, options = args, "present", {}
+    elif isinstance(args, dict):
+        names, state, options = args.get("name"), args.get("state", "present"), args
+    else:
+        return None, "Invalid apt module arguments"
+
+    # `name` may be a single package, a comma-separated string or a list
+    if isinstance(names, str):
+        names = [n.strip() for n in names.split(",") if n.strip()]
+    elif isinstance(names, list):
+        names = [str(n) for n in names if n]
+    else:
+        names = []
+    if not names:
+        return None, "Package name is required"
+
+    try:
+        cache_valid_time = int(options.get("cache_valid_time", 0))
+    except (TypeError, ValueError):
+        return None, "cache_valid_time must be a number of seconds"
+
+    return {
+        "names": names,
+        "state": state,
+        "update_cache": bool(options.get("update_cache", True)),
+        "cache_valid_time": cache_valid_time
+    }, ""
+
+
+def apt_install_script(names: List[str], update_cache: bool, cache_valid_time: int) -> str:
+    """One dpkg-query pass over all packages, then a single install transaction.
+
+    The missing packages are reported on an APT_MISSING_MARKER line. The index
+    refresh is skipped when the host's update stamp is newer than
+    `cache_valid_time` seconds.
+    """
+    pkgs = " ".join(shlex.quote(n) for n in names)
+    lines = [
+        'missing=""',
+        f"for p in {pkgs}; do",
+        "  dpkg-query -W -f='${Status}' \"$p\" 2>/dev/null | grep -q 'ok installed' || missing=\"$missing $p\"",
+        "done",
+        f'echo "{APT_MISSING_MARKER}$missing"',
+        # Idempotent: everything already installed, no change
+        f'if [ -z "$missing" ]; then {_report("ok")}; exit 0; fi',
+        "export DEBIAN_FRONTEND=noninteractive"
+    ]
+    refresh = (
+        f"apt-get update || {_fail('Cache update failed')}\n"
+        f"mkdir -p {APT_STAMP_DIR} && touch {APT_STAMP_DIR}/update-success-stamp"
+    )
+    if update_cache and cache_valid_time > 0:
+        lines += [
+            "stamp=0",
+            f"for f in {APT_STAMP_DIR}/update-success-stamp /var/lib/apt/lists; do",
+            '  t=$(stat -c %Y "$f" 2>/dev/null) && [ "$t" -gt "$stamp" ] && stamp=$t',
+            "done",
+            f'if [ $(( $(date +%s) - stamp )) -ge {cache_valid_time} ]; then',
+            refresh,
+            "fi"
+        ]
+    elif update_cache:
+        lines.append(refresh)
+    lines += [
+        "set -f",
+        f"apt-get install -y $missing || {_fail('Install failed')}",
+        _report("changed")
+    ]
+    return "\n".join(lines)
+
+
+class AptGroup:
+    """Consecutive `state: present` apt tasks installed in one transaction"""
+
+    def __init__(self, tasks: List[Dict[str, Any]], specs: List[Dict[str, Any]]):
+        self.tasks = tasks
+        self.specs = specs
+
+    @staticmethod
+    def group_key(spec: Dict[str, Any]) -> Tuple[bool, int]:
+        return spec["update_cache"], spec["cache_valid_time"]
+
+    def script(self) -> str:
+        names = []
+        for spec in self.specs:
+            names.extend(n for n in spec["names"] if n not in names)
+        update_cache, cache_valid_time = self.group_key(self.specs[0])
+        return apt_install_script(names, update_cache, cache_valid_time)
+
+    def outcomes(self, exit_code: int, stdout: str, stderr: str) -> List[Optional[tuple[bool, bool, str]]]:
+        """Per-task (success, changed, error); None marks tasks skipped after a failure"""
+        missing = None
+        for line in stdout.splitlines():
+            if line.startswith(APT_MISSING_MARKER):
+                missing = set(line[len(APT_MISSING_MARKER):].split())
+
+        success, _, error = parse_script_result(exit_code, stdout, stderr)
+        if success:
+            missing = missing or set()
+            return [(True, bool(missing & set(spec["names"])), "") for spec in self.specs]
+
+        # Report the failure on the first task that needed an install, as sequential runs would
+        outcomes: List[Optional[tuple[bool, bool, str]]] = []
+        failed = False
+        for spec in self.specs:
+            if failed:
+                outcomes.append(None)
+            elif missing is not None and not (missing & set(spec["names"])):
+                outcomes.append((True, False, ""))
+            else:
+                outcomes.append((False, False, error))
+                failed = True
+        return outcomes
+
+
+# A playbook step: a single task, or several apt tasks coalesced into one transaction
+Unit = Union[Dict[str, Any], AptGroup]
+
+
 class AnsibleEngine:
-    def __init__(self, host_ids: List[int]):
+    def __init__(
+        self,
+        host_ids: List[int],
+        forks: Optional[int] = None,
+        strategy: Optional[str] = None,
+        serial: SerialSpec = None,
+        max_fail_percentage: Optional[float] = None,
+        pipelining: Optional[bool] = None
+    ):
         self.host_ids = host_ids
-
-    def run_playbook_yaml(self, yaml_content: str) -> Dict[int, Dict[str, Any]]:
-        """Parses and executes a list of declarative tasks from YAML"""
+        self.forks = max(1, forks or DEFAULT_FORKS)
+        # None means "use the play's keyword of the same name, else the default"
+        self.strategy = strategy
+        self.serial = serial
+        self.max_fail_percentage = parse_max_fail_percentage(max_fail_percentage)
+        self.pipelining = pipelining
+        # Called as on_task_result(host_id, step, task_entry) from worker threads
+        self.on_task_result: Optional[Callable[[int, int, Dict[str, Any]], None]] = None
+
+    @staticmethod
+    def parse_playbook(yaml_content: str) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Parse YAML and normalize it into a flat task list plus play keywords.
+
+        Play keywords (e.g. `strategy`) are taken from the first play that sets them;
+        `max_fail_percentage` is validated here so a bad value fails before any host is touched.
+        """
         try:
             playbook = yaml.safe_load(yaml_content)
         except Exception as e:
@@ -21,240 +263,433 @@ class AnsibleEngine:
 
         # Normalize playbook structure (it might be a list of tasks or list of plays)
         tasks = []
+        play_options = {}
         for item in playbook:
             if isinstance(item, dict) and "tasks" in item:
                 tasks.extend(item["tasks"])
+                for key, value in item.items():
+                    if key != "tasks":
+                        play_options.setdefault(key, value)
             else:
                 tasks.append(item)
+        if "max_fail_percentage" in play_options:
+            play_options["max_fail_percentage"] = parse_max_fail_percentage(play_options["max_fail_percentage"])
+        return tasks, play_options
+
+    @staticmethod
+    def find_module(task: Dict[str, Any]) -> Tuple[Optional[str], Any]:
+        """Find the active module in the task"""
+        for key in SUPPORTED_MODULES:
+            if key in task:
+                return key, task[key]
+        return None, None
+
+    async def run_playbook_yaml(self, yaml_content: str) -> Dict[int, Dict[str, Any]]:
+        """Parses and executes a list of declarative tasks from YAML.
+
+        Each task runs on up to `forks` hosts at once, off the event loop. The
+        "linear" strategy starts a task only once every host has finished the
+        previous one; "free" lets each host work through its task list alone.
+        With `serial`, hosts are processed in rolling batches and the run stops
+        early when a batch exceeds `max_fail_percentage`.
+
+        With `pipelining`, each host receives its whole task list as one remote
+        program (one channel, one round trip), so hosts progress independently
+        as with the "free" strategy.
+        """
+        tasks, play_options = self.parse_playbook(yaml_content)
+        strategy = self.strategy or play_options.get("strategy", "linear")
+        if strategy not in PLAYBOOK_STRATEGIES:
+            raise ValueError(f"Unknown playbook strategy: {strategy}")
+        serial = self.serial if self.serial is not None else play_options.get("serial")
+        max_fail_percentage = self.max_fail_percentage
+        if max_fail_percentage is None:
+            max_fail_percentage = play_options.get("max_fail_percentage")
+        pipelining = self.pipelining
+        if pipelining is None:
+            pipelining = bool(play_options.get("pipelining", False))
+        batches = serial_batches(self.host_ids, serial)
+        units = self._build_units(tasks)
 
         results = {hid: {"success": True, "changed_count": 0, "tasks": []} for hid in self.host_ids}
+        semaphore = asyncio.Semaphore(self.forks)
 
-        for task in tasks:
-            task_name = task.get("name", "Unnamed Task")
-            
-            # Find the active module in the task
-            module_name = None
-            module_args = None
-            for key in ["apt", "service", "file", "shell"]:
-                if key in task:
-                    module_name = key
-                    module_args = task[key]
-                    break
-
-            if not module_name:
-                for hid in self.host_ids:
-                    results[hid]["tasks"].append({
-                        "name": task_name,
-                        "status": "failed",
-                        "changed": False,
-                        "error": "No supported module found in task definition"
-                    })
-                    results[hid]["success"] = False
-                continue
+        async def run_on_host(hid: int, unit: Unit):
+            async with semaphore:
+                await run_batch(self._run_unit_on_host, hid, unit, results[hid])
 
-            for hid in self.host_ids:
-                # If host already failed previous tasks, skip it or continue? We continue but mark status
-                if not results[hid]["success"]:
-                    results[hid]["tasks"].append({
-                        "name": task_name,
-                        "status": "skipped",
-                        "changed": False,
-                        "error": "Skipped due to previous task failure"
-                    })
-                    continue
+        async def run_linear(batch: List[int]):
+            for unit in units:
+                await asyncio.gather(*(run_on_host(hid, unit) for hid in batch))
 
-                conn = pool.get_connection(hid)
-                if not conn or not conn.is_connected:
-                    results[hid]["tasks"].append({
-                        "name": task_name,
-                        "status": "failed",
-                        "changed": False,
-                        "error": "Host not connected"
-                    })
-                    results[hid]["success"] = False
-                    continue
+        async def run_free(batch: List[int]):
+            async def run_all_tasks(hid: int):
+                for unit in units:
+                    await run_on_host(hid, unit)
 
-                # Execute task on host
-                success, changed, error = self._execute_module(conn, module_name, module_args)
-                
-                status_str = "changed" if changed else ("ok" if success else "failed")
-                if not success:
-                    results[hid]["success"] = False
+            await asyncio.gather(*(run_all_tasks(hid) for hid in batch))
 
-                if changed:
-                    results[hid]["changed_count"] += 1
+        async def run_pipelined(batch: List[int]):
+            async def run_host(hid: int):
+                async with semaphore:
+                    await run_batch(self._run_pipelined, hid, units, results[hid])
 
-                results[hid]["tasks"].append({
-                    "name": task_name,
-                    "status": status_str,
-                    "changed": changed,
-                    "error": error
-                })
+            await asyncio.gather(*(run_host(hid) for hid in batch))
+
+        if pipelining:
+            run_hosts = run_pipelined
+        else:
+            run_hosts = run_free if strategy == "free" else run_linear
+        for index, batch in enumerate(batches):
+            await run_hosts(batch)
+
+            failed = sum(1 for hid in batch if not results[hid]["success"])
+            if index < len(batches) - 1 and rollout_should_abort(failed, len(batch), max_fail_percentage):
+                logger.warning(f"Playbook aborted after batch {index + 1}: {failed}/{len(batch)} hosts failed")
+                for remaining in batches[index + 1:]:
+                    for hid in remaining:
+                        results[hid]["success"] = False
+                        for task in tasks:
+                            self._append_task(hid, results[hid], {
+                                "name": task.get("name", "Unnamed Task"),
+                                "status": "skipped",
+                                "changed": False,
+                                "error": "Skipped: rollout aborted after too many failures"
+                            })
+                break
 
         return results
 
-    def _execute_module(self, conn, module_name: str, args: Any) -> tuple[bool, bool, str]:
-        """Runs the module check & execute logic on target host to maintain idempotence"""
+    def _build_units(self, tasks: List[Dict[str, Any]]) -> List[Unit]:
+        """Coalesce consecutive `state: present` apt tasks that share a cache policy"""
+        units: List[Unit] = []
+        for task in tasks:
+            module_name, module_args = self.find_module(task)
+            spec = parse_apt_args(module_args)[0] if module_name == "apt" else None
+            if spec and spec["state"] == "present":
+                last = units[-1] if units else None
+                if isinstance(last, AptGroup) and AptGroup.group_key(last.specs[0]) == AptGroup.group_key(spec):
+                    last.tasks.append(task)
+                    last.specs.append(spec)
+                else:
+                    units.append(AptGroup([task], [spec]))
+                continue
+            units.append(task)
+        return units
+
+    def _run_unit_on_host(self, hid: int, unit: Unit, host_result: Dict[str, Any]):
+        if isinstance(unit, AptGroup):
+            self._run_apt_group(hid, unit, host_result)
+        else:
+            self._run_task_on_host(hid, unit, host_result)
+
+    def _run_apt_group(self, hid: int, group: AptGroup, host_result: Dict[str, Any]):
+        """Check and install the packages of several apt tasks in one round trip (blocking)"""
+        conn = pool.get_connection(hid)
+        if not host_result["success"] or not conn or not conn.is_connected:
+            for task in group.tasks:
+                self._run_task_on_host(hid, task, host_result)
+            return
+
         try:
-            if module_name == "apt":
-                return self._run_apt(conn, args)
-            elif module_name == "service":
-                return self._run_service(conn, args)
-            elif module_name == "file":
-                return self._run_file(conn, args)
-            elif module_name == "shell":
-                return self._run_shell(conn, args)
+            exit_code, stdout, stderr = conn.execute_command(f"sh -c {shlex.quote(group.script())}")
         except Exception as e:
-            return False, False, f"Internal engine error: {str(e)}"
-        return False, False, "Unknown module"
-
-    def _run_apt(self, conn, args: Any) -> tuple[bool, bool, str]:
-        if isinstance(args, str):
-            name = args
-            state = "present"
-        elif isinstance(args, dict):
-            name = args.get("name")
-            state = args.get("state", "present")
+            exit_code, stdout, stderr = -1, "", f"Internal engine error: {str(e)}"
+        self._record_unit(hid, group, exit_code, stdout, stderr, host_result)
+
+    def _record_unit(self, hid: int, unit: Unit, exit_code: int, stdout: str, stderr: str,
+                     host_result: Dict[str, Any]):
+        """Record the outcome of a compiled unit from its script output"""
+        if isinstance(unit, AptGroup):
+            for task, outcome in zip(unit.tasks, unit.outcomes(exit_code, stdout, stderr)):
+                if outcome is None:
+                    # Host already failed, so this records a skip
+                    self._run_task_on_host(hid, task, host_result)
+                else:
+                    self._record_result(hid, host_result, task.get("name", "Unnamed Task"), *outcome)
+            return
+
+        module_name, _ = self.find_module(unit)
+        if module_name == "shell":
+            outcome = shell_result(exit_code, stdout, stderr)
         else:
-            return False, False, "Invalid apt module arguments"
-
-        if not name:
-            return False, False, "Package name is required"
-
-        # Check if package is installed (DPKG query)
-        exit_code, stdout, stderr = conn.execute_command(f"dpkg -s {name}")
-        is_installed = (exit_code == 0)
-
-        if state == "present":
-            if is_installed:
-                return True, False, ""  # Idempotent: Already installed, no change
-            # Install package
-            # We use non-interactive mode and auto accept
-            logger.info(f"Installing package {name} on {conn.name}")
-            exit_code, stdout, stderr = conn.execute_command(
-                f"export DEBIAN_FRONTEND=noninteractive && apt-get update && apt-get install -y {name}"
-            )
-            if exit_code == 0:
-                return True, True, ""
-            return False, False, f"Install failed: {stderr or stdout}"
-
-        elif state == "absent":
-            if not is_installed:
-                return True, False, ""  # Idempotent: Already absent, no change
-            # Remove package
-            logger.info(f"Removing package {name} on {conn.name}")
-            exit_code, stdout, stderr = conn.execute_command(
-                f"export DEBIAN_FRONTEND=noninteractive && apt-get remove -y {name}"
+            outcome = parse_script_result(exit_code, stdout, stderr)
+        self._record_result(hid, host_result, unit.get("name", "Unnamed Task"), *outcome)
+
+    def _run_task_on_host(self, hid: int, task: Dict[str, Any], host_result: Dict[str, Any]):
+        """Run one task on one host and record its outcome (blocking)"""
+        task_name = task.get("name", "Unnamed Task")
+        module_name, module_args = self.find_module(task)
+
+        if not module_name:
+            self._append_task(hid, host_result, {
+                "name": task_name,
+                "status": "failed",
+                "changed": False,
+                "error": "No supported module found in task definition"
+            })
+            host_result["success"] = False
+            return
+
+        # If host already failed previous tasks, skip it or continue? We continue but mark status
+        if not host_result["success"]:
+            self._append_task(hid, host_result, {
+                "name": task_name,
+                "status": "skipped",
+                "changed": False,
+                "error": "Skipped due to previous task failure"
+            })
+            return
+
+        conn = pool.get_connection(hid)
+        if not conn or not conn.is_connected:
+            self._append_task(hid, host_result, {
+                "name": task_name,
+                "status": "failed",
+                "changed": False,
+                "error": "Host not connected"
+            })
+            host_result["success"] = False
+            return
+
+        # Execute task on host
+        success, changed, error = self._execute_module(conn, module_name, module_args)
+        self._record_result(hid, host_result, task_name, success, changed, error)
+
+    def _record_result(self, hid: int, host_result: Dict[str, Any], task_name: str,
+                       success: bool, changed: bool, error: str):
+        status_str = "changed" if changed else ("ok" if success else "failed")
+        if not success:
+            host_result["success"] = False
+
+        if changed:
+            host_result["changed_count"] += 1
+
+        self._append_task(hid, host_result, {
+            "name": task_name,
+            "status": status_str,
+            "changed": changed,
+            "error": error
+        })
+
+    def _append_task(self, hid: int, host_result: Dict[str, Any], entry: Dict[str, Any]):
+        """Add a task result for a host and notify the `on_task_result` hook"""
+        host_result["tasks"].append(entry)
+        if self.on_task_result:
+            try:
+                self.on_task_result(hid, len(host_result["tasks"]), entry)
+            except Exception as e:
+                logger.error(f"Task result hook failed: {e}")
+
+    def _run_pipelined(self, hid: int, units: List[Unit], host_result: Dict[str, Any]):
+        """Run a host's task list with pipelining (blocking).
+
+        Consecutive tasks that compile to scripts are shipped as one remote
+        program; anything else (unknown modules, invalid arguments) falls back
+        to per-task execution.
+        """
+        segment: List[Tuple[Unit, str]] = []
+        for unit in units:
+            script = ""
+            if isinstance(unit, AptGroup):
+                script = unit.script()
+            else:
+                module_name, module_args = self.find_module(unit)
+                if module_name in PIPELINE_MODULES:
+                    script, _ = self._compile_task(module_name, module_args)
+            if script:
+                segment.append((unit, script))
+                continue
+            if segment:
+                self._run_segment(hid, segment, host_result)
+                segment = []
+            self._run_unit_on_host(hid, unit, host_result)
+        if segment:
+            self._run_segment(hid, segment, host_result)
+
+    def _run_segment(self, hid: int, segment: List[Tuple[Unit, str]], host_result: Dict[str, Any]):
+        """Execute compiled units in one channel, recording each as its record arrives"""
+        units = [unit for unit, _ in segment]
+        conn = pool.get_connection(hid)
+        if not host_result["success"] or not conn or not conn.is_connected:
+            for unit in units:
+                self._run_unit_on_host(hid, unit, host_result)
+            return
+
+        done = 0
+        buffer = b""
+
+        def on_output(stream: str, data: bytes):
+            nonlocal buffer, done
+            if stream != "stdout":
+                return
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                record = parse_task_record(line.decode("utf-8", errors="replace"))
+                if not record or record[0] != done:
+                    continue
+                _, exit_code, out, err = record
+                self._record_unit(hid, units[done], exit_code, out, err, host_result)
+                done += 1
+
+        # Same interpreter as the per-task path, whatever the user's login shell is
+        program = build_pipeline_script([script for _, script in segment])
+        exit_code, error = conn.stream_command(f"sh -c {shlex.quote(program)}", on_output, PIPELINE_TIMEOUT)
+        if done < len(units) and host_result["success"]:
+            # The program died before reporting every unit (lost connection, timeout)
+            unit = units[done]
+            task = unit.tasks[0] if isinstance(unit, AptGroup) else unit
+            reason = error or f"exit code {exit_code}"
+            self._record_result(
+                hid, host_result, task.get("name", "Unnamed Task"), False, False,
+                f"Pipelined run ended early: {reason}"
             )
-            if exit_code == 0:
-                return True, True, ""
-            return False, False, f"Removal failed: {stderr or stdout}"
+            if isinstance(unit, AptGroup):
+                for task in unit.tasks[1:]:
+                    self._run_task_on_host(hid, task, host_result)
+            done += 1
+        # Units after a failure are reported as skipped
+        for unit in units[done:]:
+            self._run_unit_on_host(hid, unit, host_result)
 
-        return False, False, f"Unsupported state: {state}"
+    def _execute_module(self, conn, module_name: str, args: Any) -> tuple[bool, bool, str]:
+        """Runs the module check & execute logic on target host to maintain idempotence.
+
+        Check, action and report are compiled into one remote script, so each
+        task costs a single channel round trip.
+        """
+        try:
+            if module_name == "shell":
+                return self._run_shell(conn, args)
+            if module_name not in SUPPORTED_MODULES:
+                return False, False, "Unknown module"
+
+            script, error = self._compile_task(module_name, args)
+            if not script:
+                return False, False, error
+            return self._run_script(conn, script)
+        except Exception as e:
+            return False, False, f"Internal engine error: {str(e)}"
 
-    def _run_service(self, conn, args: Any) -> tuple[bool, bool, str]:
+    def _compile_task(self, module_name: str, args: Any) -> tuple[str, str]:
+        """Compile a task into a remote sh script, or return ("", error)"""
+        if module_name == "shell":
+            if not isinstance(args, str):
+                return "", "Invalid shell module argument (must be string command)"
+            # Per-task mode runs shell tasks through the login shell, so do the same here
+            return f'"${{SHELL:-sh}}" -c {shlex.quote(args)}', ""
+        return {
+            "apt": self._compile_apt,
+            "service": self._compile_service,
+            "file": self._compile_file
+        }[module_name](args)
+
+    def _run_script(self, conn, script: str) -> tuple[bool, bool, str]:
+        """Run a compiled module script and parse its result marker"""
+        exit_code, stdout, stderr = conn.execute_command(f"sh -c {shlex.quote(script)}")
+        return parse_script_result(exit_code, stdout, stderr)
+
+    def _compile_apt(self, args: Any) -> tuple[str, str]:
+        spec, error = parse_apt_args(args)
+        if not spec:
+            return "", error
+
+        if spec["state"] == "present":
+            return apt_install_script(spec["names"], spec["update_cache"], spec["cache_valid_time"]), ""
+
+        elif spec["state"] == "absent":
+            pkgs = " ".join(shlex.quote(n) for n in spec["names"])
+            # Idempotent: already absent, no change
+            return (
+                'installed=""\n'
+                f"for p in {pkgs}; do\n"
+                "  dpkg-query -W -f='${Status}' \"$p\" 2>/dev/null | grep -q 'ok installed' && installed=\"$installed $p\"\n"
+                "done\n"
+                f'if [ -z "$installed" ]; then {_report("ok")}; exit 0; fi\n'
+                "export DEBIAN_FRONTEND=noninteractive\n"
+                "set -f\n"
+                f"apt-get remove -y $installed || {_fail('Removal failed')}\n"
+                f"{_report('changed')}"
+            ), ""
+
+        return "", f"Unsupported state: {spec['state']}"
+
+    def _compile_service(self, args: Any) -> tuple[str, str]:
         if not isinstance(args, dict):
-            return False, False, "Invalid service module arguments"
+            return "", "Invalid service module arguments"
 
         name = args.get("name")
         state = args.get("state")
 
         if not name or not state:
-            return False, False, "Service name and state are required"
+            return "", "Service name and state are required"
 
-        # Check active status of systemd service
-        exit_code, stdout, stderr = conn.execute_command(f"systemctl is-active {name}")
-        is_active = (stdout.strip() == "active")
+        svc = shlex.quote(str(name))
+        is_active = f'[ "$(systemctl is-active {svc} 2>/dev/null)" = "active" ]'
 
         if state == "started":
-            if is_active:
-                return True, False, ""  # Idempotent: service is already started
-            # Start service
-            exit_code, stdout, stderr = conn.execute_command(f"systemctl start {name}")
-            if exit_code == 0:
-                return True, True, ""
-            return False, False, f"Failed to start service: {stderr or stdout}"
+            return (
+                f"if {is_active}; then {_report('ok')}; exit 0; fi\n"
+                f"systemctl start {svc} || {_fail('Failed to start service')}\n"
+                f"{_report('changed')}"
+            ), ""
 
         elif state == "stopped":
-            if not is_active:
-                return True, False, ""  # Idempotent: service is already stopped
-            # Stop service
-            exit_code, stdout, stderr = conn.execute_command(f"systemctl stop {name}")
-            if exit_code == 0:
-                return True, True, ""
-            return False, False, f"Failed to stop service: {stderr or stdout}"
+            return (
+                f"if ! {is_active}; then {_report('ok')}; exit 0; fi\n"
+                f"systemctl stop {svc} || {_fail('Failed to stop service')}\n"
+                f"{_report('changed')}"
+            ), ""
 
         elif state == "restarted":
             # Restart is always a change (non-idempotent by nature)
-            exit_code, stdout, stderr = conn.execute_command(f"systemctl restart {name}")
-            if exit_code == 0:
-                return True, True, ""
-            return False, False, f"Failed to restart service: {stderr or stdout}"
+            return (
+                f"systemctl restart {svc} || {_fail('Failed to restart service')}\n"
+                f"{_report('changed')}"
+            ), ""
 
-        return False, False, f"Unsupported service state: {state}"
+        return "", f"Unsupported service state: {state}"
 
-    def _run_file(self, conn, args: Any) -> tuple[bool, bool, str]:
+    def _compile_file(self, args: Any) -> tuple[str, str]:
         if not isinstance(args, dict):
-            return False, False, "Invalid file module arguments"
+            return "", "Invalid file module arguments"
 
         path = args.get("path")
         state = args.get("state", "file")  # directory, file, absent
         mode = args.get("mode")            # e.g., 0755, 0644
 
         if not path:
-            return False, False, "Path is required"
-
-        # Check if path exists and what type it is
-        # We can use test -e, test -d, test -f
-        exit_code, stdout, stderr = conn.execute_command(f"test -e {path}")
-        exists = (exit_code == 0)
+            return "", "Path is required"
 
+        qpath = shlex.quote(str(path))
         if state == "absent":
-            if not exists:
-                return True, False, ""
-            exit_code, stdout, stderr = conn.execute_command(f"rm -rf {path}")
-            if exit_code == 0:
-                return True, True, ""
-            return False, False, f"Failed to remove file: {stderr or stdout}"
-
-        elif state == "directory":
-            changed = False
-            if not exists:
-                exit_code, stdout, stderr = conn.execute_command(f"mkdir -p {path}")
-                if exit_code != 0:
-                    return False, False, f"Failed to create directory: {stderr or stdout}"
-                changed = True
-            
-            # Apply mode/permissions if specified
-            if mode:
-                # We can check current permissions, but running chmod is cheap.
-                # Let's run chmod if requested.
-                exit_code, stdout, stderr = conn.execute_command(f"chmod {mode} {path}")
-                if exit_code != 0:
-                    return False, False, f"Failed to set mode {mode}: {stderr or stdout}"
-                # If directory just created, changed=True. If existed but mode set, also changed=True.
-                # In real Ansible it detects actual changes, let's treat mode change as changed.
-                changed = True
-
-            return True, changed, ""
-
-        elif state == "file":
-            changed = False
-            if not exists:
-                exit_code, stdout, stderr = conn.execute_command(f"touch {path}")
-                if exit_code != 0:
-                    return False, False, f"Failed to create file: {stderr or stdout}"
-                changed = True
-            
-            if mode:
-                exit_code, stdout, stderr = conn.execute_command(f"chmod {mode} {path}")
-                if exit_code != 0:
-                    return False, False, f"Failed to set mode {mode}: {stderr or stdout}"
-                changed = True
-
-            return True, changed, ""
-
-        return False, False, f"Unsupported file state: {state}"
+            return (
+                f"if [ ! -e {qpath} ]; then {_report('ok')}; exit 0; fi\n"
+                f"rm -rf {qpath} || {_fail('Failed to remove file')}\n"
+                f"{_report('changed')}"
+            ), ""
+
+        if state not in ("directory", "file"):
+            return "", f"Unsupported file state: {state}"
+
+        if state == "directory":
+            create = f"mkdir -p {qpath} || {_fail('Failed to create directory')}"
+        else:
+            create = f"touch {qpath} || {_fail('Failed to create file')}"
+
+        lines = [
+            "status=ok",
+            f"if [ ! -e {qpath} ]; then {create}; status=changed; fi"
+        ]
+        if mode:
+            # A requested mode is always reported as a change, like before
+            mode_str = str(mode)
+            lines.append(
+                f"chmod {shlex.quote(mode_str)} {qpath} || {_fail(f'Failed to set mode {mode_str}')}; status=changed"
+            )
+        lines.append(f'echo "{RESULT_MARKER} $status"')
+        return "\n".join(lines), ""
 
     def _run_shell(self, conn, args: Any) -> tuple[bool, bool, str]:
         if not isinstance(args, str):
@@ -262,7 +697,4 @@ class AnsibleEngine:
 
         # Run command directly
         exit_code, stdout, stderr = conn.execute_command(args)
-        if exit_code == 0:
-            # Shell command is always reported as changed if it runs successfully
-            return True, True, stdout
-        return False, False, f"Exit code {exit_code}: {stderr or stdout}"
+        return shell_result(exit_code, stdout, stderr)
@@ -0,0 +1,116 @@
+"""Benchmark SFTP transfers: plain paramiko put/get vs the transfer engine
+
+Usage:
+    python bench_sftp.py --host 10.0.0.5 --user deploy --key ~/.ssh/id_ed25519 \
+        [--port 22] [--size-mb 256] [--repeat 3] [--remote-dir /tmp]
+
+The baseline opens a new SFTP session per transfer and uses sftp.put/get with
+paramiko defaults, as Neutron did before. The engine run goes through
+SSHConnection.upload_file/download_file (reused session, large window,
+pipelined writes, prefetched reads). A final pass interrupts an upload at 90%
+and checks that the next upload sends only the remainder.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import paramiko
+
+import sftp_transfer
+from ssh_manager import SSHConnection
+
+
+def _mbps(nbytes: int, seconds: float) -> float:
+    return nbytes / seconds / 1e6 if seconds else 0.0
+
+
+def _timed(label: str, func, nbytes: int, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    print(f"  {label:<22} best {best:7.2f}s  {_mbps(nbytes, best):8.1f} MB/s")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", required=True)
+    parser.add_argument("--port", type=int, default=22)
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--remote-dir", default="/tmp")
+    args = parser.parse_args()
+
+    conn = SSHConnection(0, args.host, args.host, args.port, args.user, os.path.expanduser(args.key))
+    success, message = conn.connect()
+    if not success:
+        raise SystemExit(message)
+
+    size = args.size_mb * 1024 * 1024
+    remote = f"{args.remote_dir.rstrip('/')}/neutron-bench-{os.getpid()}.bin"
+    with tempfile.TemporaryDirectory() as tmp:
+        local = os.path.join(tmp, "source.bin")
+        fetched = os.path.join(tmp, "fetched.bin")
+        with open(local, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        def baseline(action):
+            def run():
+                transport = conn.client.get_transport()
+                sftp = paramiko.SFTPClient.from_transport(transport)
+                try:
+                    if action == "put":
+                        sftp.put(local, remote)
+                    else:
+                        sftp.get(remote, fetched)
+                finally:
+                    sftp.close()
+            return run
+
+        def engine(action):
+            def run():
+                if action == "put":
+                    ok, msg = conn.upload_file(local, remote)
+                else:
+                    ok, msg = conn.download_file(remote, fetched)
+                if not ok:
+                    raise RuntimeError(msg)
+            return run
+
+        print(f"{args.size_mb} MiB to {args.user}@{args.host}:{args.port}, best of {args.repeat}")
+        results = {}
+        for action in ("put", "get"):
+            base = _timed(f"baseline {action}", baseline(action), size, args.repeat)
+            tuned = _timed(f"engine {action}", engine(action), size, args.repeat)
+            results[action] = base / tuned if tuned else 0.0
+        print("  speedup: upload x%.2f, download x%.2f" % (results["put"], results["get"]))
+
+        # Resume: interrupt an upload at 90% and upload again
+        def interrupt(done, total):
+            if done >= total * 9 // 10:
+                raise InterruptedError("simulated interruption")
+
+        with conn.sftp_session() as sftp:
+            try:
+                sftp_transfer.upload(sftp, local, remote, progress=interrupt)
+            except InterruptedError:
+                pass
+            start = time.perf_counter()
+            result = sftp_transfer.upload(sftp, local, remote)
+            elapsed = time.perf_counter() - start
+            sftp.remove(remote)
+        print(f"  resume                 sent {result['transferred']} of {result['size']} bytes "
+              f"(from offset {result['resumed_from']}) in {elapsed:.2f}s")
+
+    conn.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Bounded capture of remote command output
+
+A command can print far more than we are willing to hold in memory (think
+`journalctl` across a few hundred hosts). OutputCapture keeps only the first
+and last part of a stream within a fixed byte budget and can optionally spill
+the complete stream to a gzip file on disk, up to a hard size limit. Spill
+files are deleted with their host and after OUTPUT_CAPTURE_RETENTION_DAYS.
+"""
+import gzip
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Per-stream in-memory budget (head + tail) in bytes
+CAPTURE_MAX_BYTES = int(os.getenv("OUTPUT_CAPTURE_BYTES", str(256 * 1024)))
+# Upper bound for a caller-supplied budget
+CAPTURE_LIMIT_BYTES = int(os.getenv("OUTPUT_CAPTURE_LIMIT_BYTES", str(16 * 1024 * 1024)))
+# Uncompressed bytes written to one spill file; the rest of the stream is dropped
+SPILL_MAX_BYTES = int(os.getenv("OUTPUT_SPILL_MAX_BYTES", str(256 * 1024 * 1024)))
+CAPTURE_DIR = Path(os.getenv("OUTPUT_CAPTURE_DIR", Path(__file__).parent.parent / "captures"))
+# Days a spill file is kept (0 keeps them until their host is deleted)
+CAPTURE_RETENTION_DAYS = int(os.getenv("OUTPUT_CAPTURE_RETENTION_DAYS", "7"))
+
+
+class OutputCapture:
+    """Keeps the head and tail of a byte stream within `max_bytes`"""
+
+    def __init__(self, max_bytes: Optional[int] = None, spill_path: Optional[Path] = None):
+        self.max_bytes = max(2, min(max_bytes or CAPTURE_MAX_BYTES, CAPTURE_LIMIT_BYTES))
+        self.head_limit = self.max_bytes // 2
+        self.tail_limit = self.max_bytes - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total_bytes = 0
+        self.spill_path = spill_path
+        self.spilled_bytes = 0
+        self._spill = None
+        if spill_path:
+            spill_path.parent.mkdir(parents=True, exist_ok=True)
+            self._spill = gzip.open(spill_path, "wb", compresslevel=6)
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        self.total_bytes += len(data)
+        if self._spill:
+            room = SPILL_MAX_BYTES - self.spilled_bytes
+            if room > 0:
+                self._spill.write(data[:room])
+                self.spilled_bytes += min(room, len(data))
+
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail += data[-self.tail_limit:]
+            excess = len(self.tail) - self.tail_limit
+            if excess > 0:
+                del self.tail[:excess]
+
+    def close(self):
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_bytes > len(self.head) + len(self.tail)
+
+    @property
+    def dropped_bytes(self) -> int:
+        return self.total_bytes - len(self.head) - len(self.tail)
+
+    def text(self) -> str:
+        """Decoded output, with a marker where the middle was dropped"""
+        head = self.head.decode("utf-8", errors="replace")
+        if not self.tail:
+            return head
+        tail = self.tail.decode("utf-8", errors="replace")
+        if not self.truncated:
+            return head + tail
+        return f"{head}\n... [{self.dropped_bytes} bytes truncated] ...\n{tail}"
+
+    def metadata(self) -> Dict[str, Any]:
+        return {
+            "total_bytes": self.total_bytes,
+            "truncated": self.truncated,
+            "dropped_bytes": self.dropped_bytes,
+            "spill_file": self.spill_path.name if self.spill_path else None,
+            "spill_truncated": bool(self.spill_path) and self.total_bytes > self.spilled_bytes
+        }
+
+
+def new_spill_path(host_id: int, stream: str) -> Path:
+    """Unique gzip file for the full output of one stream"""
+    return CAPTURE_DIR / f"{host_id}_{stream}_{uuid.uuid4().hex}.gz"
+
+
+def resolve_spill_file(name: str) -> Optional[Path]:
+    """Map a spill file name back to its path, refusing anything outside CAPTURE_DIR"""
+    path = CAPTURE_DIR / Path(name).name
+    if path.suffix != ".gz" or not path.is_file():
+        return None
+    return path
+
+
+def _remove(path: Path) -> bool:
+    try:
+        path.unlink()
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        logger.warning(f"Could not delete capture {path.name}: {e}")
+        return False
+
+
+def delete_host_spill_files(host_id: int) -> int:
+    """Delete every spill file of a host; returns files removed"""
+    if not CAPTURE_DIR.is_dir():
+        return 0
+    return sum(_remove(path) for path in CAPTURE_DIR.glob(f"{int(host_id)}_*.gz"))
+
+
+def purge_spill_files(max_age_days: int = CAPTURE_RETENTION_DAYS) -> int:
+    """Delete spill files older than `max_age_days`; returns files removed"""
+    if max_age_days <= 0 or not CAPTURE_DIR.is_dir():
+        return 0
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    for path in CAPTURE_DIR.glob("*.gz"):
+        try:
+            expired = path.stat().st_mtime < cutoff
+        except FileNotFoundError:
+            continue
+        if expired:
+            removed += _remove(path)
+    return removed
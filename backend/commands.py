@@ -1,13 +1,21 @@
 """Command Executor with parallel execution support"""
 import asyncio
+import codecs
 import logging
 import os
 import re
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple, Union
 from ssh_manager import pool, SSHConnection
+from executors import run_batch, run_interactive
 
 logger = logging.getLogger(__name__)
 
+# linear: hosts move through steps in lockstep; free: each host runs independently
+PLAYBOOK_STRATEGIES = ("linear", "free")
+
+# Maximum number of SSH handshakes in flight during fleet-wide connects
+CONNECT_CONCURRENCY = int(os.getenv("CONNECT_CONCURRENCY", "64"))
+
 DANGEROUS_PATTERNS = [
     r"rm\s+-rf\s+/\s*$",  # rm -rf /
     r"rm\s+-rf\s+\*\s*$",  # rm -rf *
@@ -24,44 +32,178 @@ def validate_command(command: str) -> None:
             raise ValueError("Dangerous command pattern detected and blocked.")
 
 
+async def connect_hosts_stream(
+    connections: List[Tuple[SSHConnection, bool]],
+    concurrency: int = CONNECT_CONCURRENCY
+) -> AsyncIterator[Dict[str, Any]]:
+    """Connect hosts concurrently, yielding each result as soon as it completes.
+
+    `connections` is a list of (connection, strict_host_checking) pairs. At most
+    `concurrency` handshakes run at once, so total time tracks the slowest hosts
+    rather than the sum of every host's connect time.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def connect_single(conn: SSHConnection, strict: bool) -> Dict[str, Any]:
+        async with semaphore:
+            success, message = await run_batch(pool.connect, conn, strict)
+        return {
+            "host_id": conn.host_id,
+            "name": conn.name,
+            "connected": success,
+            "message": message
+        }
+
+    tasks = [asyncio.ensure_future(connect_single(c, s)) for c, s in connections]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def connect_hosts_parallel(
+    connections: List[Tuple[SSHConnection, bool]],
+    concurrency: int = CONNECT_CONCURRENCY
+) -> Dict[int, Dict[str, Any]]:
+    """Connect hosts concurrently and collect the results keyed by host ID"""
+    results = {}
+    async for result in connect_hosts_stream(connections, concurrency):
+        results[result["host_id"]] = {
+            "name": result["name"],
+            "connected": result["connected"],
+            "message": result["message"]
+        }
+    return results
+
+
+async def _execute_on_host(
+    host_id: int,
+    command: str,
+    timeout: int,
+    run=run_batch,
+    max_output_bytes: Optional[int] = None,
+    spill_output: bool = False
+) -> Dict[str, Any]:
+    """Execute an already validated command on one host"""
+    conn = pool.get_connection(host_id)
+    if not conn or not conn.is_connected:
+        return {
+            "exit_code": -1,
+            "output": "",
+            "error": "Not connected",
+            "status": "failed"
+        }
+
+    exit_code, stdout, stderr, error = await run(
+        conn.execute_captured, command, timeout, max_output_bytes, spill_output
+    )
+
+    return {
+        "exit_code": exit_code,
+        "output": stdout.text(),
+        "error": error or stderr.text(),
+        "status": "success" if exit_code == 0 else "failed",
+        "capture": {"stdout": stdout.metadata(), "stderr": stderr.metadata()}
+    }
+
+
 async def execute_command_parallel(
     host_ids: List[int],
     command: str,
-    timeout: int = 30
+    timeout: int = 30,
+    max_output_bytes: Optional[int] = None,
+    spill_output: bool = False
 ) -> Dict[int, Dict[str, Any]]:
-    """Execute command on multiple hosts in parallel"""
+    """Execute command on multiple hosts in parallel.
+
+    Each host keeps at most `max_output_bytes` of stdout/stderr in memory (head
+    and tail); with `spill_output` the full streams are also written to disk.
+    """
     validate_command(command)
     results = {}
+    # A single target is an interactive request; anything wider is bulk fan-out
+    run = run_interactive if len(host_ids) == 1 else run_batch
 
     async def exec_single(host_id: int):
-        conn = pool.get_connection(host_id)
-        if not conn or not conn.is_connected:
-            results[host_id] = {
-                "exit_code": -1,
-                "output": "",
-                "error": "Not connected",
-                "status": "failed"
-            }
-            return
-
-        loop = asyncio.get_running_loop()
-        exit_code, output, error = await loop.run_in_executor(
-            None, conn.execute_command, command, timeout
+        results[host_id] = await _execute_on_host(
+            host_id, command, timeout, run, max_output_bytes, spill_output
         )
 
-        results[host_id] = {
-            "exit_code": exit_code,
-            "output": output,
-            "error": error,
-            "status": "success" if exit_code == 0 else "failed"
-        }
-
     tasks = [exec_single(hid) for hid in host_ids]
     await asyncio.gather(*tasks)
 
     return results
 
 
+async def stream_command_parallel(
+    host_ids: List[int],
+    command: str,
+    timeout: int = 30
+) -> AsyncIterator[Dict[str, Any]]:
+    """Execute command on multiple hosts, yielding events as they happen.
+
+    Events are `{"type": "output", "host_id", "stream", "data"}` for each chunk
+    read from a channel and `{"type": "exit", "host_id", "exit_code", "error",
+    "status"}` once per host.
+    """
+    validate_command(command)
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    run = run_interactive if len(host_ids) == 1 else run_batch
+
+    async def stream_single(host_id: int):
+        exit_code, error = -1, "Not connected"
+        try:
+            conn = pool.get_connection(host_id)
+            if not conn or not conn.is_connected:
+                return
+
+            # Chunks can split multi-byte characters, so decode incrementally
+            decoders = {
+                "stdout": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+                "stderr": codecs.getincrementaldecoder("utf-8")(errors="replace")
+            }
+
+            def emit(stream: str, text: str):
+                queue.put_nowait({"type": "output", "host_id": host_id, "stream": stream, "data": text})
+
+            def on_output(stream: str, data: bytes):
+                text = decoders[stream].decode(data)
+                if text:
+                    loop.call_soon_threadsafe(emit, stream, text)
+
+            exit_code, error = await run(conn.stream_command, command, on_output, timeout)
+
+            for stream, decoder in decoders.items():
+                tail = decoder.decode(b"", final=True)
+                if tail:
+                    emit(stream, tail)
+        except Exception as e:
+            exit_code, error = -1, str(e)
+        finally:
+            queue.put_nowait({
+                "type": "exit",
+                "host_id": host_id,
+                "exit_code": exit_code,
+                "error": error,
+                "status": "success" if exit_code == 0 else "failed"
+            })
+
+    tasks = [asyncio.ensure_future(stream_single(hid)) for hid in host_ids]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            event = await queue.get()
+            if event["type"] == "exit":
+                remaining -= 1
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 async def execute_command_single(
     host_id: int,
     command: str,
@@ -78,10 +220,7 @@ async def execute_command_single(
             "status": "failed"
         }
 
-    loop = asyncio.get_running_loop()
-    exit_code, output, error = await loop.run_in_executor(
-        None, conn.execute_command, command, timeout
-    )
+    exit_code, output, error = await run_interactive(conn.execute_command, command, timeout)
 
     return {
         "exit_code": exit_code,
@@ -91,33 +230,6 @@ async def execute_command_single(
     }
 
 
-async def upload_file_parallel(
-    host_ids: List[int],
-    local_path: str,
-    remote_path: str
-) -> Dict[int, Dict[str, Any]]:
-    """Upload file to multiple hosts in parallel"""
-    results = {}
-
-    async def upload_single(host_id: int):
-        conn = pool.get_connection(host_id)
-        if not conn or not conn.is_connected:
-            results[host_id] = {"success": False, "error": "Not connected"}
-            return
-
-        loop = asyncio.get_running_loop()
-        success, message = await loop.run_in_executor(
-            None, conn.upload_file, local_path, remote_path
-        )
-
-        results[host_id] = {"success": success, "message": message}
-
-    tasks = [upload_single(hid) for hid in host_ids]
-    await asyncio.gather(*tasks)
-
-    return results
-
-
 async def download_file_parallel(
     host_ids: List[int],
     remote_path: str,
@@ -138,10 +250,7 @@ async def download_file_parallel(
         os.makedirs(host_dir, exist_ok=True)
         local_path = os.path.join(host_dir, os.path.basename(remote_path))
 
-        loop = asyncio.get_running_loop()
-        success, message = await loop.run_in_executor(
-            None, conn.download_file, remote_path, local_path
-        )
+        success, message = await run_batch(conn.download_file, remote_path, local_path)
 
         results[host_id] = {"success": success, "message": message, "local_path": local_path}
 
@@ -151,25 +260,146 @@ async def download_file_parallel(
     return results
 
 
+SerialSpec = Union[int, str, List[Union[int, str]], None]
+
+
+def _serial_batch_size(value: Union[int, str], total: int) -> int:
+    if isinstance(value, str) and value.strip().endswith("%"):
+        try:
+            percent = float(value.strip()[:-1])
+        except ValueError:
+            raise ValueError(f"Invalid serial value: {value}")
+        return max(1, int(total * percent / 100))
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid serial value: {value}")
+    if size <= 0:
+        raise ValueError(f"Invalid serial value: {value}")
+    return size
+
+
+def serial_batches(host_ids: List[int], serial: SerialSpec = None) -> List[List[int]]:
+    """Split hosts into rolling batches, following Ansible's `serial` keyword.
+
+    `serial` is a host count, a percentage such as "25%", or a list of those
+    for growing batches (the last entry repeats). None runs all hosts at once.
+    """
+    if serial is None or serial == [] or serial == 0:
+        return [list(host_ids)] if host_ids else []
+
+    sizes = serial if isinstance(serial, list) else [serial]
+    batches = []
+    start = 0
+    while start < len(host_ids):
+        size = _serial_batch_size(sizes[min(len(batches), len(sizes) - 1)], len(host_ids))
+        batches.append(list(host_ids[start:start + size]))
+        start += size
+    return batches
+
+
+def parse_max_fail_percentage(value: Any) -> Optional[float]:
+    """Validate `max_fail_percentage`: a number (or "30%") from 0 to 100, or None"""
+    if value is None:
+        return None
+    number = value.strip()[:-1] if isinstance(value, str) and value.strip().endswith("%") else value
+    try:
+        if isinstance(number, bool):
+            raise TypeError
+        percentage = float(number)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid max_fail_percentage: {value!r}")
+    if not 0 <= percentage <= 100:
+        raise ValueError(f"max_fail_percentage must be between 0 and 100, got {value!r}")
+    return percentage
+
+
+def rollout_should_abort(failed: int, batch_size: int, max_fail_percentage: Optional[float]) -> bool:
+    """Whether a finished batch stops the rollout (whole batch failed, or too many failures)"""
+    if batch_size == 0 or failed == 0:
+        return False
+    if failed == batch_size:
+        return True
+    if max_fail_percentage is None:
+        return False
+    return failed * 100 / batch_size > max_fail_percentage
+
+
 async def run_playbook(
     host_ids: List[int],
     commands: List[str],
-    progress_callback=None
+    progress_callback=None,
+    strategy: str = "linear",
+    serial: SerialSpec = None,
+    max_fail_percentage: Optional[float] = None
 ) -> Dict[int, List[Dict[str, Any]]]:
-    """Run a playbook (sequence of commands) on multiple hosts"""
-    results = {hid: [] for hid in host_ids}
-
-    for i, command in enumerate(commands):
-        cmd_results = await execute_command_parallel(host_ids, command)
+    """Run a playbook (sequence of commands) on multiple hosts.
+
+    With the "linear" strategy every host finishes step N before any host
+    starts step N+1. With "free" each host works through the commands on its
+    own, and `progress_callback` is called per host step with a one-host result.
+
+    `serial` rolls the playbook out in batches (see serial_batches). If a batch
+    fails entirely or exceeds `max_fail_percentage`, the remaining hosts are
+    not touched and their steps are reported as skipped.
+    """
+    if strategy not in PLAYBOOK_STRATEGIES:
+        raise ValueError(f"Unknown playbook strategy: {strategy}")
+    max_fail_percentage = parse_max_fail_percentage(max_fail_percentage)
+    for command in commands:
+        validate_command(command)
 
-        for host_id, result in cmd_results.items():
-            results[host_id].append({
-                "command": command,
-                "step": i + 1,
-                **result
-            })
-
-        if progress_callback:
-            await progress_callback(i + 1, len(commands), cmd_results)
+    results = {hid: [] for hid in host_ids}
+    batches = serial_batches(host_ids, serial)
+
+    async def run_linear(batch: List[int]):
+        for i, command in enumerate(commands):
+            cmd_results = await execute_command_parallel(batch, command)
+
+            for host_id, result in cmd_results.items():
+                results[host_id].append({
+                    "command": command,
+                    "step": i + 1,
+                    **result
+                })
+
+            if progress_callback:
+                await progress_callback(i + 1, len(commands), cmd_results)
+
+    async def run_free(batch: List[int]):
+        async def run_host(host_id: int):
+            for i, command in enumerate(commands):
+                result = await _execute_on_host(host_id, command, 30)
+                results[host_id].append({
+                    "command": command,
+                    "step": i + 1,
+                    **result
+                })
+                if progress_callback:
+                    await progress_callback(i + 1, len(commands), {host_id: result})
+
+        await asyncio.gather(*(run_host(hid) for hid in batch))
+
+    run_hosts = run_free if strategy == "free" else run_linear
+    for index, batch in enumerate(batches):
+        await run_hosts(batch)
+
+        failed = sum(1 for hid in batch if any(step["status"] == "failed" for step in results[hid]))
+        if index < len(batches) - 1 and rollout_should_abort(failed, len(batch), max_fail_percentage):
+            logger.warning(f"Playbook aborted after batch {index + 1}: {failed}/{len(batch)} hosts failed")
+            for remaining in batches[index + 1:]:
+                for host_id in remaining:
+                    results[host_id] = [
+                        {
+                            "command": command,
+                            "step": i + 1,
+                            "exit_code": -1,
+                            "output": "",
+                            "error": "Skipped: rollout aborted after too many failures",
+                            "status": "skipped"
+                        }
+                        for i, command in enumerate(commands)
+                    ]
+            break
 
     return results
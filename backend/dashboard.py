@@ -0,0 +1,96 @@
+"""Dashboard statistics kept in memory
+
+Counters are loaded once at startup and then adjusted by the code paths that
+change them (host and playbook CRUD, history writes and purges), so serving
+/api/dashboard never touches the database. Every change bumps a version that
+feeds the ETag, letting polling clients revalidate with a 304.
+"""
+import threading
+import uuid
+from typing import Any, Dict, List
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from models import CommandHistory, Host, Playbook
+from ssh_manager import pool
+
+RECENT_COMMANDS = 10
+
+
+def _recent_commands(db: Session) -> List[Dict[str, Any]]:
+    rows = db.query(
+        CommandHistory.id, CommandHistory.command, CommandHistory.status, CommandHistory.executed_at
+    ).order_by(CommandHistory.executed_at.desc(), CommandHistory.id.desc()).limit(RECENT_COMMANDS).all()
+    return [
+        {
+            "id": row.id,
+            "command": row.command,
+            "status": row.status,
+            "executed_at": row.executed_at.isoformat()
+        }
+        for row in rows
+    ]
+
+
+class DashboardStats:
+    """Incrementally maintained dashboard counters; safe to update from worker threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Distinguishes ETags issued by different server processes
+        self._boot = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.total_hosts = 0
+        self.total_commands = 0
+        self.total_playbooks = 0
+        self.recent_commands: List[Dict[str, Any]] = []
+
+    def load(self, db: Session):
+        """Initialize every counter from the database"""
+        total_hosts = db.query(func.count(Host.id)).scalar()
+        total_commands = db.query(func.count(CommandHistory.id)).scalar()
+        total_playbooks = db.query(func.count(Playbook.id)).scalar()
+        recent = _recent_commands(db)
+        with self._lock:
+            self.total_hosts = total_hosts
+            self.total_commands = total_commands
+            self.total_playbooks = total_playbooks
+            self.recent_commands = recent
+            self.version += 1
+
+    def hosts_changed(self, delta: int):
+        with self._lock:
+            self.total_hosts += delta
+            self.version += 1
+
+    def playbooks_changed(self, delta: int):
+        with self._lock:
+            self.total_playbooks += delta
+            self.version += 1
+
+    def commands_changed(self, delta: int, db: Session):
+        """Adjust the history count; `db` is used to refresh the recent commands list"""
+        recent = _recent_commands(db)
+        with self._lock:
+            self.total_commands += delta
+            self.recent_commands = recent
+            self.version += 1
+
+    def etag(self) -> str:
+        # Connectivity changes outside this module (reconnects, reaping), so
+        # the live connected count is part of the tag
+        return f'W/"{self._boot}-{self.version}-{pool.connected_count()}"'
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "total_hosts": self.total_hosts,
+                "connected_hosts": pool.connected_count(),
+                "total_commands": self.total_commands,
+                "recent_commands": list(self.recent_commands),
+                "total_playbooks": self.total_playbooks
+            }
+
+
+stats = DashboardStats()
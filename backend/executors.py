@@ -0,0 +1,99 @@
+"""Bounded thread pools for blocking SSH work
+
+Paramiko is blocking, so every SSH call runs in a worker thread. Instead of the
+event loop's default executor (sized from the CPU count) we keep two dedicated
+lanes: a small *interactive* lane for single-host commands and terminals, and a
+large *batch* lane for fleet-wide fan-out, so a 500-host run can neither crawl
+nor starve the UI.
+"""
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE_WORKERS = int(os.getenv("SSH_INTERACTIVE_WORKERS", "16"))
+BATCH_WORKERS = int(os.getenv("SSH_BATCH_WORKERS", "256"))
+
+
+class LaneExecutor:
+    """Thread pool that tracks queued, active and completed jobs"""
+
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix=f"ssh-{name}"
+        )
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._completed = 0
+
+    def submit(self, func: Callable, *args: Any) -> Future:
+        """Schedule a blocking call on this lane"""
+        with self._lock:
+            self._queued += 1
+
+        def run():
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+
+        try:
+            return self._executor.submit(run)
+        except RuntimeError:
+            with self._lock:
+                self._queued -= 1
+            raise
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        """Run a blocking call on this lane and await its result"""
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "active": self._active,
+                "queued": self._queued,
+                "completed": self._completed
+            }
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+interactive = LaneExecutor("interactive", INTERACTIVE_WORKERS)
+batch = LaneExecutor("batch", BATCH_WORKERS)
+
+
+async def run_interactive(func: Callable, *args: Any) -> Any:
+    """Run latency-sensitive work (single host, terminal) off the event loop"""
+    return await interactive.run(func, *args)
+
+
+async def run_batch(func: Callable, *args: Any) -> Any:
+    """Run fleet fan-out work off the event loop"""
+    return await batch.run(func, *args)
+
+
+def get_stats() -> Dict[str, Dict[str, int]]:
+    """Queue depth and utilisation for every lane"""
+    return {lane.name: lane.stats() for lane in (interactive, batch)}
+
+
+def shutdown():
+    """Stop all lanes, dropping work that has not started yet"""
+    for lane in (interactive, batch):
+        lane.shutdown()
+    logger.info("SSH executors shut down")
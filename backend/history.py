@@ -0,0 +1,396 @@
+"""Command history: batched writer and keyset-paginated reads
+
+Command runs only queue their history rows; a background task inserts them
+in batched transactions. A 1000-host fan-out thus costs the API one list
+append instead of 1000 ORM objects and a synchronous commit.
+
+Listing walks the (executed_at, id) indexes newest first from an opaque
+cursor, so page N costs the same as page 1. On SQLite, command text and
+output are also indexed in FTS5 tables kept in sync by triggers.
+"""
+import asyncio
+import base64
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import DateTime, and_, bindparam, or_, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from models import CommandHistory
+from output_store import blob_lock, store_outputs, history_outputs
+import dashboard
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT transaction
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+# Seconds a queued row may wait before it is written
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1.0"))
+# Stored output per row
+HISTORY_OUTPUT_LIMIT = 10000
+
+
+class HistoryWriter:
+    """Queues CommandHistory rows and writes them in batches off the event loop"""
+
+    def __init__(self, session_factory, batch_size: int = HISTORY_BATCH_SIZE,
+                 flush_interval: float = HISTORY_FLUSH_INTERVAL):
+        self.session_factory = session_factory
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def record(self, command: str, results: Dict[int, Dict[str, Any]]):
+        """Queue one history row per host result; returns immediately"""
+        executed_at = datetime.now(timezone.utc)
+        rows = [
+            {
+                "host_id": host_id,
+                "command": command,
+                "output": (result["output"] or "")[:HISTORY_OUTPUT_LIMIT],
+                "exit_code": result["exit_code"],
+                "status": result["status"],
+                "executed_at": executed_at
+            }
+            for host_id, result in results.items()
+        ]
+        if not rows:
+            return
+
+        if self._task is None:
+            # Writer not running (e.g. scripts, tests): write through
+            self._write(rows)
+            return
+
+        with self._lock:
+            self._pending.extend(rows)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and write everything still queued"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    async def flush(self):
+        while True:
+            with self._lock:
+                rows = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            if not rows:
+                return
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception as e:
+                logger.error(f"Failed to write {len(rows)} history rows: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _write(self, rows: List[Dict[str, Any]]):
+        db = self.session_factory()
+        try:
+            with blob_lock:
+                blob_ids = store_outputs(db, (row["output"] for row in rows))
+                db.execute(CommandHistory.__table__.insert(), [
+                    {**row, "output": None, "output_blob_id": blob_ids.get(row["output"])}
+                    for row in rows
+                ])
+                db.commit()
+            self.written += len(rows)
+            dashboard.stats.commands_changed(len(rows), db)
+        finally:
+            db.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self.pending_count(),
+            "written": self.written,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval
+        }
+
+
+def encode_cursor(executed_at: datetime, row_id: int) -> str:
+    raw = f"{executed_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of encode_cursor; raises ValueError for anything malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        executed_at, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(executed_at), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _as_utc_naive(value: datetime) -> datetime:
+    """Timestamps are stored as naive UTC"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def query_history(
+    db: Session,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    host_id: Optional[int] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    command_prefix: Optional[str] = None,
+    include_output: bool = True
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of history, newest first, plus the cursor of the next page (None on the last)"""
+    columns = [
+        CommandHistory.id, CommandHistory.host_id, CommandHistory.command,
+        CommandHistory.exit_code, CommandHistory.status, CommandHistory.executed_at
+    ]
+    if include_output:
+        columns += [CommandHistory.output, CommandHistory.output_blob_id]
+    query = db.query(*columns)
+
+    if host_id is not None:
+        query = query.filter(CommandHistory.host_id == host_id)
+    if status:
+        query = query.filter(CommandHistory.status == status)
+    if since:
+        query = query.filter(CommandHistory.executed_at >= _as_utc_naive(since))
+    if until:
+        query = query.filter(CommandHistory.executed_at < _as_utc_naive(until))
+    if command_prefix:
+        # Case-sensitive prefix as a range, which unlike LIKE needs no escaping
+        upper = command_prefix[:-1] + chr(ord(command_prefix[-1]) + 1)
+        query = query.filter(CommandHistory.command >= command_prefix, CommandHistory.command < upper)
+    if cursor:
+        after_at, after_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            CommandHistory.executed_at < after_at,
+            and_(CommandHistory.executed_at == after_at, CommandHistory.id < after_id)
+        ))
+
+    rows = query.order_by(CommandHistory.executed_at.desc(), CommandHistory.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].executed_at, rows[-1].id)
+
+    outputs = history_outputs(db, rows) if include_output else None
+    items = []
+    for i, row in enumerate(rows):
+        item = {
+            "id": row.id,
+            "host_id": row.host_id,
+            "command": row.command,
+            "exit_code": row.exit_code,
+            "status": row.status,
+            "executed_at": row.executed_at.isoformat()
+        }
+        if include_output:
+            item["output"] = outputs[i]
+        items.append(item)
+    return items, next_cursor
+
+
+# FTS5 indexes: command text straight from command_history, output from the
+# deduplicated blobs (each distinct output is indexed once) through a view
+# that decompresses them with neutron_inflate()
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS command_fts USING fts5(
+        command, content='command_history', content_rowid='id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS command_fts_ai AFTER INSERT ON command_history BEGIN
+        INSERT INTO command_fts(rowid, command) VALUES (new.id, new.command);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS command_fts_ad AFTER DELETE ON command_history BEGIN
+        INSERT INTO command_fts(command_fts, rowid, command) VALUES ('delete', old.id, old.command);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS command_fts_au AFTER UPDATE OF command ON command_history BEGIN
+        INSERT INTO command_fts(command_fts, rowid, command) VALUES ('delete', old.id, old.command);
+        INSERT INTO command_fts(rowid, command) VALUES (new.id, new.command);
+    END""",
+    """CREATE VIEW IF NOT EXISTS output_blob_text AS
+        SELECT id, neutron_inflate(data) AS output FROM output_blobs""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS output_fts USING fts5(
+        output, content='output_blob_text', content_rowid='id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS output_fts_ai AFTER INSERT ON output_blobs BEGIN
+        INSERT INTO output_fts(rowid, output) VALUES (new.id, neutron_inflate(new.data));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS output_fts_ad AFTER DELETE ON output_blobs BEGIN
+        INSERT INTO output_fts(output_fts, rowid, output) VALUES ('delete', old.id, neutron_inflate(old.data));
+    END""",
+]
+
+# Earlier single-table index over inline output
+LEGACY_FTS = [
+    "DROP TRIGGER IF EXISTS command_history_fts_ai",
+    "DROP TRIGGER IF EXISTS command_history_fts_ad",
+    "DROP TRIGGER IF EXISTS command_history_fts_au",
+    "DROP TABLE IF EXISTS command_history_fts",
+]
+
+# How SQLAlchemy stores DateTime values in SQLite, for raw comparisons
+SQLITE_DATETIME = "%Y-%m-%d %H:%M:%S.%f"
+# Leading output shown for matches on the command alone
+SNIPPET_FALLBACK_CHARS = 120
+
+# Set by ensure_fts(); search is unavailable on other databases or SQLite builds without FTS5
+fts_enabled = False
+
+
+def ensure_fts(engine) -> bool:
+    """Create the full-text indexes and their triggers, indexing existing rows on first run"""
+    global fts_enabled
+    if engine.dialect.name != "sqlite":
+        return False
+    try:
+        with engine.begin() as conn:
+            existing = {row.name for row in conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE name IN ('command_fts', 'output_fts')"
+            ))}
+            for statement in LEGACY_FTS + FTS_SCHEMA:
+                conn.execute(text(statement))
+            for table in ("command_fts", "output_fts"):
+                if table not in existing:
+                    conn.execute(text(f"INSERT INTO {table}({table}) VALUES ('rebuild')"))
+                    logger.info(f"Built full-text index {table}")
+        fts_enabled = True
+    except Exception as e:
+        logger.warning(f"Full-text history search disabled: {e}")
+    return fts_enabled
+
+
+def fts_query(terms: str) -> str:
+    """Quote each whitespace-separated term so punctuation is matched literally (all terms must match)"""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms.split())
+
+
+def search_history(
+    db: Session,
+    query: str,
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    host_id: Optional[int] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    raw: bool = False,
+    mark: Tuple[str, str] = ("<mark>", "</mark>")
+) -> List[Dict[str, Any]]:
+    """Rows whose command or output matches, newest first; pass the last returned id as `before_id` for the next page.
+
+    `raw` passes `query` through as FTS5 syntax (AND/OR/NOT, "phrases", prefix*).
+    Raises ValueError for an invalid query.
+    """
+    match = query if raw else fts_query(query)
+    if not match:
+        raise ValueError("Empty search query")
+
+    conditions = []
+    params: Dict[str, Any] = {"match": match, "limit": limit}
+    if before_id is not None:
+        conditions.append("h.id < :before_id")
+        params["before_id"] = before_id
+    if host_id is not None:
+        conditions.append("h.host_id = :host_id")
+        params["host_id"] = host_id
+    if status:
+        conditions.append("h.status = :status")
+        params["status"] = status
+    if since:
+        conditions.append("h.executed_at >= :since")
+        params["since"] = _as_utc_naive(since).strftime(SQLITE_DATETIME)
+    if until:
+        conditions.append("h.executed_at < :until")
+        params["until"] = _as_utc_naive(until).strftime(SQLITE_DATETIME)
+    filters = "".join(f" AND {condition}" for condition in conditions)
+
+    # One newest-first page per index, merged below; a single OR query would
+    # have to sort every matching row
+    columns = "h.id, h.host_id, h.command, h.output, h.output_blob_id, h.exit_code, h.status, h.executed_at"
+    by_command = f"""
+        SELECT {columns} FROM command_fts JOIN command_history h ON h.id = command_fts.rowid
+        WHERE command_fts MATCH :match{filters}
+        ORDER BY command_fts.rowid DESC LIMIT :limit
+    """
+    by_output = f"""
+        SELECT {columns} FROM command_history h
+        WHERE h.output_blob_id IN (SELECT rowid FROM output_fts WHERE output_fts MATCH :match){filters}
+        ORDER BY h.id DESC LIMIT :limit
+    """
+    try:
+        candidates = {}
+        for sql in (by_command, by_output):
+            for row in db.execute(text(sql).columns(executed_at=DateTime), params):
+                candidates[row.id] = row
+        rows = [candidates[row_id] for row_id in sorted(candidates, reverse=True)[:limit]]
+        if not rows:
+            return []
+        # snippet()/highlight() only work in a query that MATCHes their own table
+        marks = {"match": match, "open": mark[0], "close": mark[1]}
+        snippets = dict(db.execute(
+            text(
+                "SELECT rowid, snippet(output_fts, 0, :open, :close, '...', 16) FROM output_fts "
+                "WHERE output_fts MATCH :match AND rowid IN :ids"
+            ).bindparams(bindparam("ids", expanding=True)),
+            {**marks, "ids": [row.output_blob_id for row in rows if row.output_blob_id] or [0]}
+        ).all())
+        commands = dict(db.execute(
+            text(
+                "SELECT rowid, highlight(command_fts, 0, :open, :close) FROM command_fts "
+                "WHERE command_fts MATCH :match AND rowid IN :ids"
+            ).bindparams(bindparam("ids", expanding=True)),
+            {**marks, "ids": [row.id for row in rows]}
+        ).all())
+    except OperationalError as e:
+        # Quoted terms are always valid, so this is a malformed raw query
+        if not raw:
+            raise
+        raise ValueError(f"Invalid search query: {e.orig}")
+
+    unmatched = [row for row in rows if row.output_blob_id not in snippets]
+    leading = dict(zip((row.id for row in unmatched), history_outputs(db, unmatched)))
+    return [
+        {
+            "id": row.id,
+            "host_id": row.host_id,
+            "command": commands.get(row.id, row.command),
+            "snippet": snippets.get(row.output_blob_id) or leading.get(row.id, "")[:SNIPPET_FALLBACK_CHARS],
+            "exit_code": row.exit_code,
+            "status": row.status,
+            "executed_at": row.executed_at.isoformat()
+        }
+        for row in rows
+    ]
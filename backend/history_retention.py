@@ -0,0 +1,238 @@
+"""History retention: daily rollups, archive-and-purge, incremental vacuum
+
+Runs off the request path. Each cycle first rolls completed days up into
+history_daily_rollups, then moves history rows older than the retention
+window into gzip JSONL archives and deletes them (with any output blobs no
+longer referenced), and finally returns freed pages to the filesystem a
+bounded number at a time, so neutron.db stays flat instead of growing forever.
+
+Purging is opt-in (HISTORY_RETENTION_DAYS defaults to 0). Returning pages
+needs the database in incremental auto-vacuum mode; switching an existing
+database rewrites the whole file, so it is a separate maintenance step
+(convert_to_incremental_vacuum) rather than something a cycle does.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import threading
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import bindparam, case, func, text
+from sqlalchemy.orm import Session
+
+from capture import purge_spill_files
+from models import CommandHistory, HistoryRollup
+from output_store import blob_lock, history_outputs
+import dashboard
+
+logger = logging.getLogger(__name__)
+
+# Days of detailed history to keep (0 keeps everything; rollups are still built)
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+HISTORY_RETENTION_INTERVAL = int(os.getenv("HISTORY_RETENTION_INTERVAL", "3600"))
+# Archive purged rows as gzip JSONL before deleting them
+HISTORY_ARCHIVE = os.getenv("HISTORY_ARCHIVE", "true").lower() in ("1", "true", "yes")
+HISTORY_ARCHIVE_DIR = Path(os.getenv("HISTORY_ARCHIVE_DIR", Path(__file__).parent.parent / "archives"))
+# Pages returned to the filesystem per cycle (SQLite incremental vacuum)
+HISTORY_VACUUM_PAGES = int(os.getenv("HISTORY_VACUUM_PAGES", "5000"))
+# Rows deleted per transaction
+PURGE_BATCH_SIZE = 2000
+
+last_cycle: Dict[str, Any] = {}
+
+
+def _as_date(value) -> date:
+    return value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+
+
+def build_rollups(db: Session, today: date) -> int:
+    """Roll up every completed day after the newest existing rollup; returns days added"""
+    newest = db.query(func.max(HistoryRollup.day)).scalar()
+    if newest is not None:
+        start = _as_date(newest) + timedelta(days=1)
+    else:
+        oldest = db.query(func.min(CommandHistory.executed_at)).scalar()
+        if oldest is None:
+            return 0
+        start = oldest.date()
+    if start >= today:
+        return 0
+
+    day = func.date(CommandHistory.executed_at)
+    rows = db.query(
+        day,
+        CommandHistory.host_id,
+        func.count(CommandHistory.id),
+        func.sum(case((CommandHistory.status == "success", 0), else_=1))
+    ).filter(
+        CommandHistory.executed_at >= datetime.combine(start, datetime.min.time()),
+        CommandHistory.executed_at < datetime.combine(today, datetime.min.time())
+    ).group_by(day, CommandHistory.host_id).all()
+
+    db.bulk_insert_mappings(HistoryRollup, [
+        {"day": _as_date(d), "host_id": host_id or 0, "commands": count, "failures": failures or 0}
+        for d, host_id, count, failures in rows
+    ])
+    db.commit()
+    return len({d for d, *_ in rows})
+
+
+def _archive_rows(db: Session, rows: List, archive) -> None:
+    outputs = history_outputs(db, rows)
+    for row, output in zip(rows, outputs):
+        archive.write(json.dumps({
+            "id": row.id,
+            "host_id": row.host_id,
+            "command": row.command,
+            "output": output,
+            "exit_code": row.exit_code,
+            "status": row.status,
+            "executed_at": row.executed_at.isoformat()
+        }) + "\n")
+
+
+def purge_history(session_factory, cutoff: datetime, stop: Optional[threading.Event] = None) -> Dict[str, Any]:
+    """Archive (optionally) and delete history rows executed before `cutoff`"""
+    purged = 0
+    blobs_deleted = 0
+    archive_path = None
+    archive = None
+    try:
+        while not (stop and stop.is_set()):
+            db = session_factory()
+            try:
+                rows = db.query(
+                    CommandHistory.id, CommandHistory.host_id, CommandHistory.command,
+                    CommandHistory.output, CommandHistory.output_blob_id,
+                    CommandHistory.exit_code, CommandHistory.status, CommandHistory.executed_at
+                ).filter(
+                    CommandHistory.executed_at < cutoff
+                ).order_by(CommandHistory.executed_at, CommandHistory.id).limit(PURGE_BATCH_SIZE).all()
+                if not rows:
+                    break
+
+                if HISTORY_ARCHIVE:
+                    if archive is None:
+                        HISTORY_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+                        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+                        archive_path = HISTORY_ARCHIVE_DIR / f"history-{stamp}.jsonl.gz"
+                        archive = gzip.open(archive_path, "wt", encoding="utf-8")
+                    _archive_rows(db, rows, archive)
+                    # Rows must be on disk before they are deleted
+                    archive.flush()
+
+                ids = [row.id for row in rows]
+                blob_ids = list({row.output_blob_id for row in rows if row.output_blob_id})
+                with blob_lock:
+                    db.execute(
+                        text("DELETE FROM command_history WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+                        {"ids": ids}
+                    )
+                    if blob_ids:
+                        result = db.execute(
+                            text(
+                                "DELETE FROM output_blobs WHERE id IN :ids AND NOT EXISTS "
+                                "(SELECT 1 FROM command_history h WHERE h.output_blob_id = output_blobs.id)"
+                            ).bindparams(bindparam("ids", expanding=True)),
+                            {"ids": blob_ids}
+                        )
+                        blobs_deleted += result.rowcount
+                    db.commit()
+                purged += len(rows)
+                dashboard.stats.commands_changed(-len(rows), db)
+            finally:
+                db.close()
+    finally:
+        if archive is not None:
+            archive.close()
+
+    return {
+        "purged": purged,
+        "blobs_deleted": blobs_deleted,
+        "archive": archive_path.name if archive_path else None
+    }
+
+
+def convert_to_incremental_vacuum(engine) -> Dict[str, Any]:
+    """Switch the database to incremental auto-vacuum.
+
+    Takes effect only through a full VACUUM, which rewrites the file and locks
+    the database until it is done; run it in a maintenance window.
+    """
+    if engine.dialect.name != "sqlite":
+        return {"converted": False, "detail": "Only SQLite databases are vacuumed"}
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2:
+            return {"converted": False, "detail": "Already in incremental auto-vacuum mode"}
+        logger.info("Converting database to incremental auto-vacuum")
+        conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+        conn.execute(text("VACUUM"))
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+            return {"converted": False, "detail": "VACUUM did not switch the auto-vacuum mode"}
+    return {"converted": True, "detail": "Database rewritten in incremental auto-vacuum mode"}
+
+
+def incremental_vacuum(engine, pages: int) -> Dict[str, Any]:
+    """Release up to `pages` free pages (only in incremental auto-vacuum mode)"""
+    if engine.dialect.name != "sqlite" or pages <= 0:
+        return {}
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+            return {"pages_released": 0, "incremental_vacuum": False}
+        free_before = conn.execute(text("PRAGMA freelist_count")).scalar()
+        # The sqlite3 module steps a statement once, which frees a single page;
+        # executescript runs it to completion
+        conn.connection.dbapi_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        free_after = conn.execute(text("PRAGMA freelist_count")).scalar()
+    return {"pages_released": free_before - free_after, "free_pages": free_after}
+
+
+def run_retention_cycle(session_factory, engine, stop: Optional[threading.Event] = None) -> Dict[str, Any]:
+    """One pass of rollup, purge and vacuum (blocking; run it in a worker thread)"""
+    now = datetime.now(timezone.utc)
+    db = session_factory()
+    try:
+        rolled_up = build_rollups(db, now.date())
+    finally:
+        db.close()
+
+    purge = {"purged": 0, "blobs_deleted": 0, "archive": None}
+    if HISTORY_RETENTION_DAYS > 0:
+        cutoff = (now - timedelta(days=HISTORY_RETENTION_DAYS)).replace(tzinfo=None)
+        purge = purge_history(session_factory, cutoff, stop)
+
+    vacuum = incremental_vacuum(engine, HISTORY_VACUUM_PAGES)
+    captures_deleted = purge_spill_files()
+
+    if rolled_up or purge["purged"]:
+        logger.info(
+            f"History retention: rolled up {rolled_up} days, purged {purge['purged']} rows, "
+            f"deleted {purge['blobs_deleted']} blobs"
+        )
+
+    last_cycle.clear()
+    last_cycle.update({
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "days_rolled_up": rolled_up,
+        **purge,
+        "captures_deleted": captures_deleted,
+        **vacuum
+    })
+    return last_cycle
+
+
+async def retention_loop(session_factory, engine, interval: int = HISTORY_RETENTION_INTERVAL,
+                         stop: Optional[threading.Event] = None):
+    """Run retention cycles forever; cancel the task (and set `stop`) to end it"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(run_retention_cycle, session_factory, engine, stop)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"History retention failed: {e}")
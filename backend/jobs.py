@@ -0,0 +1,259 @@
+"""Background playbook runs
+
+Submitting a run returns its ID immediately; a worker executes it while task
+results are written to the playbook_run_tasks table in small batches, so
+clients can poll progress and a browser refresh loses nothing. The same
+results are also published as events to live subscribers (the progress
+WebSocket) the moment they complete.
+"""
+import asyncio
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from models import PlaybookRun, PlaybookRunTask
+from commands import run_playbook
+from ansible_engine import AnsibleEngine
+
+logger = logging.getLogger(__name__)
+
+PLAYBOOK_MAX_CONCURRENT_RUNS = int(os.getenv("PLAYBOOK_MAX_CONCURRENT_RUNS", "4"))
+# Seconds between writes of buffered task results
+RUN_FLUSH_INTERVAL = float(os.getenv("PLAYBOOK_RUN_FLUSH_INTERVAL", "0.5"))
+# Per-task output kept in run records
+RUN_OUTPUT_LIMIT = 10000
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+class RunRecorder:
+    """Buffers the task results of one run and writes them in batches"""
+
+    def __init__(self, session_factory, run_id: int, publish: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.session_factory = session_factory
+        self.run_id = run_id
+        self.publish = publish
+        self.completed = 0
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add(self, host_id: int, step: int, name: Optional[str], status: str, changed: bool = False,
+            output: str = "", error: str = "", exit_code: Optional[int] = None):
+        """Queue a task result; safe to call from worker threads"""
+        row = {
+            "run_id": self.run_id,
+            "host_id": host_id,
+            "step": step,
+            "name": name,
+            "status": status,
+            "changed": changed,
+            "output": (output or "")[:RUN_OUTPUT_LIMIT],
+            "error": (error or "")[:RUN_OUTPUT_LIMIT],
+            "exit_code": exit_code,
+            "finished_at": utcnow()
+        }
+        with self._lock:
+            self._pending.append(row)
+            self.completed += 1
+            completed = self.completed
+        if self.publish:
+            event = {key: value for key, value in row.items() if key not in ("run_id", "finished_at")}
+            self.publish({
+                "type": "task",
+                **event,
+                "finished_at": row["finished_at"].isoformat(),
+                "completed_steps": completed
+            })
+
+    def add_engine_result(self, host_id: int, step: int, entry: Dict[str, Any]):
+        """AnsibleEngine.on_task_result hook"""
+        self.add(host_id, step, entry["name"], entry["status"], entry["changed"], error=entry["error"])
+
+    def pending(self) -> List[Dict[str, Any]]:
+        """Results not yet written to the database"""
+        with self._lock:
+            return list(self._pending)
+
+    async def flush(self):
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if rows:
+            await asyncio.to_thread(self._write, rows)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(RUN_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to persist results of run {self.run_id}: {e}")
+
+    def _write(self, rows: List[Dict[str, Any]]):
+        db = self.session_factory()
+        try:
+            db.bulk_insert_mappings(PlaybookRunTask, rows)
+            db.query(PlaybookRun).filter(PlaybookRun.id == self.run_id).update(
+                {PlaybookRun.completed_steps: PlaybookRun.completed_steps + len(rows)},
+                synchronize_session=False
+            )
+            db.commit()
+        finally:
+            db.close()
+
+
+# A run body receives the recorder and returns the final run status
+RunBody = Callable[[RunRecorder], Awaitable[str]]
+
+
+def yaml_run(host_ids: List[int], yaml_content: str, options: Dict[str, Any]) -> RunBody:
+    """Run body for a YAML playbook executed by AnsibleEngine"""
+    async def execute(recorder: RunRecorder) -> str:
+        engine = AnsibleEngine(
+            host_ids, options.get("forks"), options.get("strategy"),
+            options.get("serial"), options.get("max_fail_percentage"), options.get("pipelining")
+        )
+        engine.on_task_result = recorder.add_engine_result
+        results = await engine.run_playbook_yaml(yaml_content)
+        return "success" if all(r["success"] for r in results.values()) else "failed"
+    return execute
+
+
+def commands_run(host_ids: List[int], commands: List[str], options: Dict[str, Any]) -> RunBody:
+    """Run body for a command-list playbook"""
+    async def execute(recorder: RunRecorder) -> str:
+        async def on_progress(step: int, total: int, cmd_results: Dict[int, Dict[str, Any]]):
+            for host_id, result in cmd_results.items():
+                recorder.add(
+                    host_id, step, commands[step - 1], result["status"],
+                    output=result["output"], error=result["error"], exit_code=result["exit_code"]
+                )
+
+        results = await run_playbook(
+            host_ids, commands, on_progress,
+            strategy=options.get("strategy") or "linear",
+            serial=options.get("serial"),
+            max_fail_percentage=options.get("max_fail_percentage")
+        )
+        # Hosts cut off by an aborted rollout never reach the progress callback
+        for host_id, steps in results.items():
+            for step in steps:
+                if step["status"] == "skipped":
+                    recorder.add(host_id, step["step"], step["command"], "skipped", error=step["error"])
+
+        failed = any(step["status"] != "success" for steps in results.values() for step in steps)
+        return "failed" if failed else "success"
+    return execute
+
+
+class JobRunner:
+    """Executes playbook runs in the background, a bounded number at a time"""
+
+    def __init__(self, session_factory, max_concurrent: int = PLAYBOOK_MAX_CONCURRENT_RUNS):
+        self.session_factory = session_factory
+        self.max_concurrent = max(1, max_concurrent)
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._subscribers: Dict[int, Set[asyncio.Queue]] = {}
+        self._recorders: Dict[int, RunRecorder] = {}
+
+    def submit(self, run_id: int, body: RunBody):
+        """Schedule a queued run; returns immediately"""
+        task = asyncio.create_task(self._run(run_id, body))
+        self._tasks[run_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(run_id, None))
+
+    def is_active(self, run_id: int) -> bool:
+        return run_id in self._tasks
+
+    def subscribe(self, run_id: int) -> asyncio.Queue:
+        """Queue receiving the live events of a run ("status", "task", then "done")"""
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(run_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, run_id: int, queue: asyncio.Queue):
+        queues = self._subscribers.get(run_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[run_id]
+
+    def pending_results(self, run_id: int) -> List[Dict[str, Any]]:
+        """Results of an active run that are buffered but not yet in the database"""
+        recorder = self._recorders.get(run_id)
+        return recorder.pending() if recorder else []
+
+    def _publish(self, run_id: int, event: Dict[str, Any]):
+        for queue in self._subscribers.get(run_id, ()):
+            queue.put_nowait(event)
+
+    def _update_run(self, run_id: int, **fields):
+        db = self.session_factory()
+        try:
+            db.query(PlaybookRun).filter(PlaybookRun.id == run_id).update(fields, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    async def _run(self, run_id: int, body: RunBody):
+        loop = asyncio.get_running_loop()
+
+        def publish(event: Dict[str, Any]):
+            loop.call_soon_threadsafe(self._publish, run_id, event)
+
+        async with self._semaphore:
+            await asyncio.to_thread(self._update_run, run_id, status="running", started_at=utcnow())
+            self._publish(run_id, {"type": "status", "status": "running"})
+            recorder = RunRecorder(self.session_factory, run_id, publish)
+            self._recorders[run_id] = recorder
+            flusher = asyncio.create_task(recorder.flush_periodically())
+            status, error = "error", None
+            try:
+                status = await body(recorder)
+            except asyncio.CancelledError:
+                error = "Cancelled"
+                raise
+            except Exception as e:
+                logger.error(f"Playbook run {run_id} failed: {e}")
+                error = str(e)
+            finally:
+                flusher.cancel()
+                try:
+                    await recorder.flush()
+                finally:
+                    self._recorders.pop(run_id, None)
+                    await asyncio.to_thread(
+                        self._update_run, run_id, status=status, error=error, finished_at=utcnow()
+                    )
+                    self._publish(run_id, {
+                        "type": "done", "status": status, "error": error, "completed_steps": recorder.completed
+                    })
+
+    def recover(self):
+        """Mark runs left unfinished by a previous process as interrupted"""
+        db = self.session_factory()
+        try:
+            count = db.query(PlaybookRun).filter(PlaybookRun.status.in_(["queued", "running"])).update(
+                {PlaybookRun.status: "error", PlaybookRun.error: "Interrupted by server restart",
+                 PlaybookRun.finished_at: utcnow()},
+                synchronize_session=False
+            )
+            db.commit()
+            if count:
+                logger.warning(f"Marked {count} interrupted playbook runs as failed")
+        finally:
+            db.close()
+
+    async def shutdown(self):
+        """Cancel running jobs and wait for their final state to be written"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {"max_concurrent": self.max_concurrent, "active_or_queued": len(self._tasks)}
@@ -5,31 +5,53 @@ import yaml
 import asyncio
 import logging
 import shutil
+import threading
 from pathlib import Path
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from contextlib import asynccontextmanager
-from typing import List, Optional
+from typing import List, Optional, Union
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv(Path(__file__).parent.parent / ".env")
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends, UploadFile, File, Form, Query, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect, Depends, Query, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from sqlalchemy import create_engine
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response
+from sqlalchemy import create_engine, func
 from sqlalchemy.orm import sessionmaker, Session
 from pydantic import BaseModel
 
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from models import Base, Host, CommandHistory, Playbook, User
+from models import Base, Host, CommandHistory, HistoryRollup, Playbook, PlaybookRun, PlaybookRunTask, TerminalRecording, User, ensure_columns, ensure_indexes
 from ssh_manager import pool, SSHConnection
+import executors
+from capture import delete_host_spill_files, resolve_spill_file
+import pool_maintenance
+import history_retention
+import dashboard
+from jobs import JobRunner, yaml_run, commands_run
+from history import HistoryWriter, query_history, ensure_fts, search_history
+import history
+from output_store import (
+    register_sqlite_functions, migrate_inline_outputs, history_outputs, storage_stats, delete_orphan_blobs,
+    blob_lock
+)
+from executors import run_interactive
+import terminal
+import transfers
+from transfers import stream_push
+from recordings import RecordingWriter, iter_recording
+import recordings
 from commands import (
     execute_command_parallel, execute_command_single,
-    upload_file_parallel, download_file_parallel, run_playbook
+    download_file_parallel, run_playbook,
+    connect_hosts_stream, connect_hosts_parallel, CONNECT_CONCURRENCY,
+    stream_command_parallel, validate_command, parse_max_fail_percentage,
+    serial_batches, PLAYBOOK_STRATEGIES
 )
 
 SECRET_KEY = os.getenv("JWT_SECRET", "neutron-super-secret-key-321-abc")
@@ -65,18 +87,28 @@ class CleanupFileResponse(FileResponse):
 # Database setup
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./neutron.db")
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+register_sqlite_functions(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Create tables
 Base.metadata.create_all(bind=engine)
+ensure_columns(engine)
+ensure_indexes(engine)
+ensure_fts(engine)
+
+# Background playbook runs and batched history writes
+job_runner = JobRunner(SessionLocal)
+history_writer = HistoryWriter(SessionLocal)
+recording_writer = RecordingWriter(SessionLocal)
 
 # Config
 BASE_DIR = Path(__file__).parent.parent
-UPLOAD_DIR = BASE_DIR / "uploads"
 DOWNLOAD_DIR = BASE_DIR / "downloads"
-UPLOAD_DIR.mkdir(exist_ok=True)
 DOWNLOAD_DIR.mkdir(exist_ok=True)
 
+# Connect every inventory host in the background when the server starts
+WARM_CONNECT_ON_STARTUP = os.getenv("WARM_CONNECT_ON_STARTUP", "false").lower() in ("1", "true", "yes")
+
 
 def get_db():
     db = SessionLocal()
@@ -103,6 +135,23 @@ def get_current_user(token: Optional[str] = Depends(oauth2_scheme), db: Session
     return user
 
 
+def get_admin_user(current_user: User = Depends(get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    return current_user
+
+
+def verify_ws_token(token: Optional[str]) -> Optional[str]:
+    """Validate the JWT passed as a WebSocket query parameter; returns the username"""
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    return payload.get("sub") or None
+
+
 # Pydantic models
 class LoginRequest(BaseModel):
     username: str
@@ -133,6 +182,8 @@ class CommandRequest(BaseModel):
     host_ids: List[int]
     command: str
     timeout: int = 30
+    max_output_bytes: Optional[int] = None  # Per-stream in-memory budget, defaults to OUTPUT_CAPTURE_BYTES
+    spill_output: bool = False  # Also keep the full output in a compressed capture file
 
 
 class PlaybookCreate(BaseModel):
@@ -145,11 +196,61 @@ class PlaybookCreate(BaseModel):
 
 class PlaybookExecute(BaseModel):
     playbook_id: int
+    forks: Optional[int] = None  # Hosts per task run concurrently, defaults to PLAYBOOK_FORKS
+    strategy: Optional[str] = None  # "linear" (lockstep) or "free" (hosts proceed independently)
+    serial: Optional[Union[int, str, List[Union[int, str]]]] = None  # Batch size(s), e.g. 10, "25%" or [1, 5, "50%"]
+    max_fail_percentage: Optional[float] = None  # Abort remaining batches above this failure rate
+    pipelining: Optional[bool] = None  # Ship each host's YAML task list as one remote program
 
 
 class PlaybookExecuteYaml(BaseModel):
     host_ids: List[int]
     yaml_content: str
+    forks: Optional[int] = None
+    strategy: Optional[str] = None
+    serial: Optional[Union[int, str, List[Union[int, str]]]] = None
+    max_fail_percentage: Optional[float] = None
+    pipelining: Optional[bool] = None
+
+
+class PlaybookRunCreate(BaseModel):
+    playbook_id: Optional[int] = None  # Run a saved playbook...
+    host_ids: Optional[List[int]] = None  # ...or an ad-hoc one (overrides the saved host list)
+    yaml_content: Optional[str] = None
+    commands: Optional[List[str]] = None
+    forks: Optional[int] = None
+    strategy: Optional[str] = None
+    serial: Optional[Union[int, str, List[Union[int, str]]]] = None
+    max_fail_percentage: Optional[float] = None
+    pipelining: Optional[bool] = None
+
+
+def build_connection(host: Host) -> SSHConnection:
+    """Create an (unconnected) SSH connection object for a host row"""
+    return SSHConnection(
+        host_id=host.id,
+        name=host.name,
+        ip_address=host.ip_address,
+        port=host.port,
+        user=host.user,
+        private_key_path=host.private_key_path
+    )
+
+
+async def warm_connect_inventory():
+    """Connect all inventory hosts concurrently (startup warm-up)"""
+    db = SessionLocal()
+    try:
+        connections = [(build_connection(h), h.strict_host_checking) for h in db.query(Host).all()]
+    finally:
+        db.close()
+
+    if not connections:
+        return
+
+    results = await connect_hosts_parallel(connections)
+    connected = sum(1 for r in results.values() if r["connected"])
+    logger.info(f"Warm connect finished: {connected}/{len(results)} hosts connected")
 
 
 # Lifespan
@@ -215,10 +316,41 @@ async def lifespan(app: FastAPI):
     finally:
         db.close()
 
+    db = SessionLocal()
+    try:
+        dashboard.stats.load(db)
+    finally:
+        db.close()
+
+    job_runner.recover()
+    recording_writer.recover()
+    history_writer.start()
+    recording_writer.start()
+
+    # Tells blocking background work running in threads to stop at the next batch
+    stop_background = threading.Event()
+    background_tasks = [asyncio.create_task(asyncio.to_thread(migrate_inline_outputs, SessionLocal, stop_background))]
+    if WARM_CONNECT_ON_STARTUP:
+        background_tasks.append(asyncio.create_task(warm_connect_inventory()))
+    if pool_maintenance.POOL_MAINTENANCE_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(pool_maintenance.maintenance_loop()))
+    if history_retention.HISTORY_RETENTION_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(
+            history_retention.retention_loop(SessionLocal, engine, stop=stop_background)
+        ))
+
     yield
     
     # Cleanup on shutdown
+    stop_background.set()
+    for task in background_tasks:
+        task.cancel()
+    await job_runner.shutdown()
+    await history_writer.stop()
+    await terminal.sessions.close_all()
+    await recording_writer.stop()
     pool.disconnect_all()
+    executors.shutdown()
 
 
 # App
@@ -230,6 +362,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 
@@ -292,6 +425,7 @@ def create_host(host_data: HostCreate, db: Session = Depends(get_db), current_us
     db.add(host)
     db.commit()
     db.refresh(host)
+    dashboard.stats.hosts_changed(1)
     return {"id": host.id, "message": "Host created"}
 
 
@@ -314,9 +448,19 @@ def delete_host(host_id: int, db: Session = Depends(get_db), current_user: User
     if not host:
         raise HTTPException(404, "Host not found")
     
+    # History rows go with the host (cascade)
+    history_rows = db.query(func.count(CommandHistory.id)).filter(CommandHistory.host_id == host_id).scalar()
     pool.disconnect(host_id)
-    db.delete(host)
-    db.commit()
+    with blob_lock:
+        db.delete(host)
+        db.flush()
+        # Outputs shared only by this host's history would otherwise stay forever
+        delete_orphan_blobs(db)
+        db.commit()
+    dashboard.stats.hosts_changed(-1)
+    if history_rows:
+        dashboard.stats.commands_changed(-history_rows, db)
+    delete_host_spill_files(host_id)
     return {"message": "Host deleted"}
 
 
@@ -326,15 +470,7 @@ def connect_host(host_id: int, db: Session = Depends(get_db), current_user: User
     if not host:
         raise HTTPException(404, "Host not found")
     
-    conn = SSHConnection(
-        host_id=host.id,
-        name=host.name,
-        ip_address=host.ip_address,
-        port=host.port,
-        user=host.user,
-        private_key_path=host.private_key_path
-    )
-    
+    conn = build_connection(host)
     success, message = pool.connect(conn, host.strict_host_checking)
     
     host_entry = db.query(Host).filter(Host.id == host_id).first()
@@ -352,72 +488,102 @@ def disconnect_host(host_id: int, current_user: User = Depends(get_current_user)
 
 
 @app.post("/api/hosts/connect-all")
-def connect_all_hosts(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    hosts = db.query(Host).all()
-    results = {}
-    
-    for host in hosts:
-        conn = SSHConnection(
-            host_id=host.id,
-            name=host.name,
-            ip_address=host.ip_address,
-            port=host.port,
-            user=host.user,
-            private_key_path=host.private_key_path
-        )
-        success, message = pool.connect(conn, host.strict_host_checking)
-        results[host.id] = {"name": host.name, "connected": success, "message": message}
-    
-    return results
+async def connect_all_hosts(
+    stream: bool = Query(False),
+    concurrency: Optional[int] = Query(None, ge=1),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    connections = [(build_connection(h), h.strict_host_checking) for h in db.query(Host).all()]
+    limit = concurrency or CONNECT_CONCURRENCY
+
+    if stream:
+        # One JSON object per line, emitted as each host finishes connecting
+        async def ndjson():
+            async for result in connect_hosts_stream(connections, limit):
+                yield json.dumps(result) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    return await connect_hosts_parallel(connections, limit)
 
 
 # ============ COMMANDS API ============
 
 @app.post("/api/commands/execute")
-async def execute_command(cmd: CommandRequest, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    results = await execute_command_parallel(cmd.host_ids, cmd.command, cmd.timeout)
-    
-    # Save to history
-    for host_id, result in results.items():
-        history = CommandHistory(
-            host_id=host_id,
-            command=cmd.command,
-            output=result["output"][:10000],  # Limit output size
-            error=result["error"][:1000],
-            exit_code=result["exit_code"],
-            status=result["status"]
-        )
-        db.add(history)
+async def execute_command(cmd: CommandRequest, current_user: User = Depends(get_current_user)):
+    results = await execute_command_parallel(
+        cmd.host_ids, cmd.command, cmd.timeout, cmd.max_output_bytes, cmd.spill_output
+    )
     
-    db.commit()
+    # Save to history (written in the background)
+    history_writer.record(cmd.command, results)
     return results
 
 
+@app.post("/api/commands/stream")
+async def stream_command(cmd: CommandRequest, current_user: User = Depends(get_current_user)):
+    """Execute a command and stream NDJSON events (output chunks, per-host exit) as they arrive"""
+    try:
+        validate_command(cmd.command)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def ndjson():
+        results = {hid: {"output": "", "exit_code": -1, "status": "running"} for hid in cmd.host_ids}
+        yield json.dumps({"type": "start", "host_ids": cmd.host_ids}) + "\n"
+
+        async for event in stream_command_parallel(cmd.host_ids, cmd.command, cmd.timeout):
+            result = results[event["host_id"]]
+            if event["type"] == "output":
+                if event["stream"] == "stdout" and len(result["output"]) < 10000:
+                    result["output"] += event["data"]
+            else:
+                result["exit_code"] = event["exit_code"]
+                result["status"] = event["status"]
+            yield json.dumps(event) + "\n"
+
+        history_writer.record(cmd.command, results)
+        yield json.dumps({"type": "done"}) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@app.get("/api/commands/captures/{name}")
+def get_capture(name: str, current_user: User = Depends(get_current_user)):
+    """Download the full gzip-compressed output spilled by a command run"""
+    path = resolve_spill_file(name)
+    if not path:
+        raise HTTPException(404, "Capture not found")
+    return FileResponse(path, filename=path.name, media_type="application/gzip")
+
+
 # ============ FILE TRANSFER API ============
 
 @app.post("/api/files/push")
 async def push_file(
-    host_ids: List[int] = Form(...),
-    remote_path: str = Form(...),
-    file: UploadFile = File(...),
+    request: Request,
+    host_ids: Optional[List[int]] = Query(None),
+    remote_path: Optional[str] = Query(None),
+    transfer_id: Optional[str] = Query(None),
     current_user: User = Depends(get_current_user)
 ):
-    # Save uploaded file temporarily
-    temp_path = UPLOAD_DIR / file.filename
+    """Stream a multipart upload to every host as it arrives.
+
+    host_ids and remote_path come from the query string or from form fields
+    placed before the file part. Pass a transfer_id to follow progress on
+    /api/files/transfers.
+    """
     try:
-        with open(temp_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-        
-        results = await upload_file_parallel(host_ids, str(temp_path), remote_path)
-    finally:
-        # Cleanup temp file
-        try:
-            os.remove(temp_path)
-        except OSError:
-            pass
-    
-    return results
+        return await stream_push(request, host_ids, remote_path, transfer_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/files/transfers")
+async def get_file_transfers(current_user: User = Depends(get_current_user)):
+    """Pushes in progress with per-host byte counts"""
+    return [push.progress() for push in transfers.active_pushes.values()]
 
 
 @app.post("/api/files/pull")
@@ -489,6 +655,7 @@ def create_playbook(playbook: PlaybookCreate, db: Session = Depends(get_db), cur
     db.add(pb)
     db.commit()
     db.refresh(pb)
+    dashboard.stats.playbooks_changed(1)
     return {"id": pb.id, "message": "Playbook created"}
 
 
@@ -499,6 +666,7 @@ def delete_playbook(playbook_id: int, db: Session = Depends(get_db), current_use
         raise HTTPException(404, "Playbook not found")
     db.delete(pb)
     db.commit()
+    dashboard.stats.playbooks_changed(-1)
     return {"message": "Playbook deleted"}
 
 
@@ -511,27 +679,41 @@ async def execute_playbook(playbook: PlaybookExecute, db: Session = Depends(get_
     if pb.yaml_content:
         from ansible_engine import AnsibleEngine
         try:
-            engine = AnsibleEngine(pb.host_ids)
-            results = engine.run_playbook_yaml(pb.yaml_content)
+            engine = AnsibleEngine(
+                pb.host_ids, playbook.forks, playbook.strategy,
+                playbook.serial, playbook.max_fail_percentage, playbook.pipelining
+            )
+            results = await engine.run_playbook_yaml(pb.yaml_content)
             return results
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Playbook execution failed: {str(e)}")
             
-    results = await run_playbook(pb.host_ids, pb.commands)
+    try:
+        results = await run_playbook(
+            pb.host_ids, pb.commands,
+            strategy=playbook.strategy or "linear",
+            serial=playbook.serial,
+            max_fail_percentage=playbook.max_fail_percentage
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return results
 
 
 @app.post("/api/playbooks/execute-yaml")
-def execute_playbook_yaml(
+async def execute_playbook_yaml(
     data: PlaybookExecuteYaml,
     current_user: User = Depends(get_current_user)
 ):
     from ansible_engine import AnsibleEngine
     try:
-        engine = AnsibleEngine(data.host_ids)
-        results = engine.run_playbook_yaml(data.yaml_content)
+        engine = AnsibleEngine(
+            data.host_ids, data.forks, data.strategy,
+            data.serial, data.max_fail_percentage, data.pipelining
+        )
+        results = await engine.run_playbook_yaml(data.yaml_content)
         return results
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -539,28 +721,315 @@ def execute_playbook_yaml(
         raise HTTPException(status_code=500, detail=f"Playbook execution failed: {str(e)}")
 
 
+def serialize_run(run: PlaybookRun) -> dict:
+    return {
+        "id": run.id,
+        "playbook_id": run.playbook_id,
+        "name": run.name,
+        "status": run.status,
+        "host_ids": run.host_ids,
+        "options": run.options,
+        "total_steps": run.total_steps,
+        "completed_steps": run.completed_steps,
+        "error": run.error,
+        "created_at": run.created_at.isoformat() if run.created_at else None,
+        "started_at": run.started_at.isoformat() if run.started_at else None,
+        "finished_at": run.finished_at.isoformat() if run.finished_at else None
+    }
+
+
+def serialize_run_task(task: PlaybookRunTask, include_output: bool = True) -> dict:
+    data = {
+        "id": task.id,
+        "host_id": task.host_id,
+        "step": task.step,
+        "name": task.name,
+        "status": task.status,
+        "changed": task.changed,
+        "error": task.error,
+        "exit_code": task.exit_code,
+        "finished_at": task.finished_at.isoformat() if task.finished_at else None
+    }
+    if include_output:
+        data["output"] = task.output
+    return data
+
+
+@app.post("/api/playbooks/runs")
+async def create_playbook_run(data: PlaybookRunCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    """Queue a playbook run and return its ID without waiting for it to finish"""
+    name, yaml_content, commands, host_ids = None, data.yaml_content, data.commands, data.host_ids
+    if data.playbook_id is not None:
+        pb = db.query(Playbook).filter(Playbook.id == data.playbook_id).first()
+        if not pb:
+            raise HTTPException(404, "Playbook not found")
+        name = pb.name
+        if not yaml_content and not commands:
+            yaml_content, commands = pb.yaml_content, pb.commands
+        if host_ids is None:
+            host_ids = pb.host_ids
+
+    if not host_ids:
+        raise HTTPException(400, "No target hosts")
+    options = {
+        "forks": data.forks,
+        "strategy": data.strategy,
+        "serial": data.serial,
+        "max_fail_percentage": data.max_fail_percentage,
+        "pipelining": data.pipelining
+    }
+
+    from ansible_engine import AnsibleEngine
+    try:
+        parse_max_fail_percentage(data.max_fail_percentage)
+        serial_batches(host_ids, data.serial)
+        if data.strategy is not None and data.strategy not in PLAYBOOK_STRATEGIES:
+            raise ValueError(f"Unknown playbook strategy: {data.strategy}")
+        if yaml_content:
+            tasks, _ = AnsibleEngine.parse_playbook(yaml_content)
+            total_steps = len(tasks) * len(host_ids)
+            body = yaml_run(host_ids, yaml_content, options)
+        elif commands:
+            for command in commands:
+                validate_command(command)
+            total_steps = len(commands) * len(host_ids)
+            body = commands_run(host_ids, commands, options)
+        else:
+            raise HTTPException(400, "Playbook has no tasks")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    run = PlaybookRun(
+        playbook_id=data.playbook_id,
+        name=name,
+        status="queued",
+        host_ids=host_ids,
+        options=options,
+        total_steps=total_steps,
+        completed_steps=0
+    )
+    db.add(run)
+    db.commit()
+    db.refresh(run)
+
+    job_runner.submit(run.id, body)
+    return {"run_id": run.id, "status": run.status}
+
+
+@app.get("/api/playbooks/runs")
+def list_playbook_runs(limit: int = 50, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    runs = db.query(PlaybookRun).order_by(PlaybookRun.id.desc()).limit(limit).all()
+    return [serialize_run(run) for run in runs]
+
+
+@app.get("/api/playbooks/runs/{run_id}")
+def get_playbook_run(
+    run_id: int,
+    after: int = 0,
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Run status plus task results; pass the returned `cursor` as `after` to fetch only new results"""
+    run = db.query(PlaybookRun).filter(PlaybookRun.id == run_id).first()
+    if not run:
+        raise HTTPException(404, "Run not found")
+
+    tasks = db.query(PlaybookRunTask).filter(
+        PlaybookRunTask.run_id == run_id,
+        PlaybookRunTask.id > after
+    ).order_by(PlaybookRunTask.id).limit(limit).all()
+
+    return {
+        **serialize_run(run),
+        "tasks": [serialize_run_task(t) for t in tasks],
+        "cursor": tasks[-1].id if tasks else after
+    }
+
+
 # ============ HISTORY API ============
 
 @app.get("/api/history")
-def get_history(limit: int = 50, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    history = db.query(CommandHistory).order_by(
-        CommandHistory.executed_at.desc()
-    ).limit(limit).all()
-    
+def get_history(
+    response: Response,
+    limit: int = Query(50, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    host_id: Optional[int] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    command_prefix: Optional[str] = None,
+    include_output: bool = True,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """History newest first. The next page's cursor is returned in the X-Next-Cursor header."""
+    try:
+        items, next_cursor = query_history(
+            db, limit, cursor, host_id, status, since, until, command_prefix, include_output
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
+
+
+@app.get("/api/history/search")
+def search_history_output(
+    q: str,
+    limit: int = Query(50, ge=1, le=500),
+    before_id: Optional[int] = None,
+    host_id: Optional[int] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    raw: bool = False,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Full-text search over command text and output, newest first, with <mark> highlighted snippets"""
+    if not history.fts_enabled:
+        raise HTTPException(status_code=503, detail="Full-text search is not available on this database")
+    try:
+        return search_history(db, q, limit, before_id, host_id, status, since, until, raw)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/history/rollups")
+def get_history_rollups(
+    host_id: Optional[int] = None,
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Daily per-host command and failure counts for completed days (kept after purges)"""
+    query = db.query(HistoryRollup)
+    if host_id is not None:
+        query = query.filter(HistoryRollup.host_id == host_id)
+    if since:
+        query = query.filter(HistoryRollup.day >= since)
+    if until:
+        query = query.filter(HistoryRollup.day < until)
     return [
-        {
-            "id": h.id,
-            "host_id": h.host_id,
-            "command": h.command,
-            "output": h.output,
-            "exit_code": h.exit_code,
-            "status": h.status,
-            "executed_at": h.executed_at.isoformat()
-        }
-        for h in history
+        {"day": r.day.isoformat(), "host_id": r.host_id, "commands": r.commands, "failures": r.failures}
+        for r in query.order_by(HistoryRollup.day, HistoryRollup.host_id).all()
     ]
 
 
+@app.get("/api/history/{history_id}")
+def get_history_entry(history_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    h = db.query(CommandHistory).filter(CommandHistory.id == history_id).first()
+    if not h:
+        raise HTTPException(404, "History entry not found")
+    return {
+        "id": h.id,
+        "host_id": h.host_id,
+        "command": h.command,
+        "output": history_outputs(db, [h])[0],
+        "exit_code": h.exit_code,
+        "status": h.status,
+        "executed_at": h.executed_at.isoformat()
+    }
+
+
+# ============ TERMINAL RECORDINGS ============
+
+def serialize_recording(r: TerminalRecording) -> dict:
+    return {
+        "id": r.id,
+        "host_id": r.host_id,
+        "host_name": r.host_name,
+        "username": r.username,
+        "status": r.status,
+        "width": r.width,
+        "height": r.height,
+        "started_at": r.started_at.isoformat() if r.started_at else None,
+        "ended_at": r.ended_at.isoformat() if r.ended_at else None,
+        "duration": r.duration,
+        "events": r.events,
+        "raw_bytes": r.raw_bytes,
+        "stored_bytes": r.stored_bytes
+    }
+
+
+def get_recording_for(recording_id: int, db: Session, user: User) -> TerminalRecording:
+    """A recording its owner or an admin may read (404 for everyone else, like a missing one)"""
+    r = db.query(TerminalRecording).filter(TerminalRecording.id == recording_id).first()
+    if not r or not (user.is_admin or r.username == user.username):
+        raise HTTPException(404, "Recording not found")
+    return r
+
+
+def recording_path(r: TerminalRecording) -> Path:
+    path = recordings.RECORDINGS_DIR / (r.file_name or "")
+    if not r.file_name or not path.is_file():
+        raise HTTPException(404, "Recording file not found")
+    return path
+
+
+@app.get("/api/terminal/recordings")
+def list_terminal_recordings(
+    limit: int = Query(50, ge=1, le=500),
+    before_id: Optional[int] = None,
+    host_id: Optional[int] = None,
+    username: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Recordings newest first; pass the last ID as before_id for the next page.
+
+    Non-admins only see their own sessions.
+    """
+    query = db.query(TerminalRecording)
+    if not current_user.is_admin:
+        query = query.filter(TerminalRecording.username == current_user.username)
+    if before_id is not None:
+        query = query.filter(TerminalRecording.id < before_id)
+    if host_id is not None:
+        query = query.filter(TerminalRecording.host_id == host_id)
+    if username:
+        query = query.filter(TerminalRecording.username == username)
+    if since:
+        query = query.filter(TerminalRecording.started_at >= since)
+    if until:
+        query = query.filter(TerminalRecording.started_at < until)
+    return [serialize_recording(r) for r in query.order_by(TerminalRecording.id.desc()).limit(limit).all()]
+
+
+@app.get("/api/terminal/recordings/{recording_id}")
+def get_terminal_recording(recording_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    return serialize_recording(get_recording_for(recording_id, db, current_user))
+
+
+@app.get("/api/terminal/recordings/{recording_id}/replay")
+def replay_terminal_recording(
+    recording_id: int,
+    start: float = Query(0, ge=0),
+    end: Optional[float] = Query(None, ge=0),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Stream the recording as asciicast v2 lines (header, then events between start and end seconds)"""
+    r = get_recording_for(recording_id, db, current_user)
+    path = recording_path(r)
+    return StreamingResponse(
+        iter_recording(path, r.chunk_index, start, end),
+        media_type="application/x-asciicast"
+    )
+
+
+@app.get("/api/terminal/recordings/{recording_id}/download")
+def download_terminal_recording(recording_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    """The recording file as stored (gzip-compressed asciicast)"""
+    r = get_recording_for(recording_id, db, current_user)
+    return FileResponse(recording_path(r), media_type="application/gzip", filename=f"recording-{r.id}.cast.gz")
+
+
 # ============ WEBSOCKET FOR REAL-TIME TERMINAL ============
 
 class ConnectionManager:
@@ -583,123 +1052,289 @@ class ConnectionManager:
 manager = ConnectionManager()
 
 
+def can_use_terminal_session(username: str, session: terminal.TerminalSession) -> bool:
+    """Sessions are shared with their owner's other tabs and with admins"""
+    if session.username == username:
+        return True
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.username == username).first()
+        return bool(user and user.is_admin)
+    finally:
+        db.close()
+
+
 @app.websocket("/ws/terminal/{host_id}")
-async def terminal_websocket(websocket: WebSocket, host_id: int, token: Optional[str] = Query(None)):
+async def terminal_websocket(
+    websocket: WebSocket,
+    host_id: int,
+    token: Optional[str] = Query(None),
+    session_id: Optional[str] = Query(None),
+    readonly: bool = Query(False)
+):
+    """Interactive shell. Pass session_id to reattach to a shell that is still alive."""
     await manager.connect(websocket, host_id)
     
     # Authenticate WebSocket connection
-    authenticated = False
-    if token:
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username: str = payload.get("sub")
-            if username:
-                authenticated = True
-        except JWTError:
-            pass
-            
-    if not authenticated:
+    username = verify_ws_token(token)
+    if not username:
         await websocket.accept()
         await websocket.send_text(json.dumps({"error": "Unauthorized connection"}))
         await websocket.close(code=1008)
         manager.disconnect(websocket, host_id)
         return
-    
-    conn = pool.get_connection(host_id)
-    if not conn or not conn.is_connected:
-        await websocket.send_text(json.dumps({"error": "Not connected to host"}))
+
+    session = terminal.sessions.get(session_id)
+    if session and (session.host_id != host_id or not can_use_terminal_session(username, session)):
+        await websocket.send_text(json.dumps({"error": "Terminal session not available"}))
+        await websocket.close(code=1008)
         manager.disconnect(websocket, host_id)
         return
+    reattached = session is not None
 
-    channel = None
+    queue = None
     try:
-        transport = conn.client.get_transport()
-        if transport and not transport.is_active():
-            conn.connect()
-            transport = conn.client.get_transport()
-            
-        if not transport:
-            await websocket.send_text(json.dumps({"error": "No transport available"}))
-            manager.disconnect(websocket, host_id)
-            return
-
-        # Open interactive shell
-        channel = conn.client.invoke_shell()
-        channel.settimeout(1)
+        if not session:
+            conn = pool.get_connection(host_id)
+            if not conn or not conn.is_connected:
+                await websocket.send_text(json.dumps({"error": "Not connected to host"}))
+                return
+
+            if not conn.transport_active():
+                await run_interactive(conn.reconnect)
+                
+            if not conn.transport_active():
+                await websocket.send_text(json.dumps({"error": "No transport available"}))
+                return
+
+            # Open interactive shell
+            session = await terminal.sessions.create(host_id, conn, username, recording_writer)
+
+        # Attach before any await so no output falls between the scrollback and the queue
+        queue, scrollback = session.attach()
         
         # Send welcome
-        await websocket.send_text(json.dumps({"type": "connected", "message": "Connected to host"}))
+        await websocket.send_text(json.dumps({
+            "type": "connected",
+            "message": "Reattached to session" if reattached else "Connected to host",
+            "session_id": session.id,
+            "reattached": reattached
+        }))
+        if scrollback:
+            await websocket.send_bytes(scrollback)
         
         async def read_from_shell():
+            # Output goes out as binary frames; the terminal decodes it
             while True:
-                try:
-                    if channel.recv_ready():
-                        data = channel.recv(4096).decode('utf-8', errors='replace')
-                        await websocket.send_text(json.dumps({"type": "output", "data": data}))
-                    await asyncio.sleep(0.05)
-                except Exception:
+                data = await queue.get()
+                if data is None:
                     break
+                await websocket.send_bytes(data)
+            # Either the shell exited or this viewer fell too far behind
+            await websocket.send_text(json.dumps({"type": "exit" if session.closed else "lagged"}))
         
         async def send_to_shell():
             try:
                 while True:
-                    data = await websocket.receive_text()
-                    msg = json.loads(data)
-                    if msg.get("type") == "input":
-                        channel.send(msg["data"])
-                    elif msg.get("type") == "resize":
-                        cols = msg.get("cols", 80)
-                        rows = msg.get("rows", 24)
-                        try:
-                            channel.resize_pty(width=cols, height=rows)
-                        except Exception as e:
-                            logger.error(f"Failed to resize pty: {e}")
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        break
+                    if message.get("bytes") is not None:
+                        # Raw keystrokes
+                        data = message["bytes"]
+                    else:
+                        msg = json.loads(message.get("text") or "{}")
+                        if msg.get("type") == "close":
+                            if readonly:
+                                # A read-only viewer only leaves; the shell stays up for its owner
+                                await websocket.close()
+                                break
+                            # Explicit close ends the shell; a plain disconnect only detaches
+                            await session.close()
+                            continue
+                        if readonly:
+                            continue
+                        if msg.get("type") == "resize":
+                            try:
+                                await session.resize(msg.get("cols", 80), msg.get("rows", 24))
+                            except Exception as e:
+                                logger.error(f"Failed to resize pty: {e}")
+                            continue
+                        if msg.get("type") != "input":
+                            continue
+                        data = msg["data"].encode("utf-8")
+                    if not readonly:
+                        await session.write(data)
             except WebSocketDisconnect:
                 pass
         
-        await asyncio.gather(read_from_shell(), send_to_shell())
+        # Whichever side ends first (shell exit or client disconnect) ends this connection
+        tasks = [asyncio.create_task(read_from_shell()), asyncio.create_task(send_to_shell())]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            task.result()
+        if tasks[0] in done:
+            await websocket.close()
     
     except Exception as e:
         await websocket.send_text(json.dumps({"error": str(e)}))
     finally:
-        if channel:
-            try:
-                channel.close()
-            except Exception:
-                pass
+        if session and queue is not None:
+            session.detach(queue)
         manager.disconnect(websocket, host_id)
 
 
+@app.get("/api/terminal/sessions")
+async def list_terminal_sessions(current_user: User = Depends(get_current_user)):
+    """Live shells (attached or within their detach grace period)"""
+    return [
+        s.info() for s in terminal.sessions.list()
+        if current_user.is_admin or s.username == current_user.username
+    ]
+
+
+@app.delete("/api/terminal/sessions/{session_id}")
+async def close_terminal_session(session_id: str, current_user: User = Depends(get_current_user)):
+    session = terminal.sessions.get(session_id)
+    if not session or not (current_user.is_admin or session.username == current_user.username):
+        raise HTTPException(404, "Terminal session not found")
+    await session.close()
+    return {"message": "Terminal session closed"}
+
+
+# ============ WEBSOCKET FOR PLAYBOOK PROGRESS ============
+
+def load_run_snapshot(run_id: int, include_output: bool):
+    db = SessionLocal()
+    try:
+        run = db.query(PlaybookRun).filter(PlaybookRun.id == run_id).first()
+        if not run:
+            return None
+        tasks = db.query(PlaybookRunTask).filter(
+            PlaybookRunTask.run_id == run_id
+        ).order_by(PlaybookRunTask.id).all()
+        return serialize_run(run), [serialize_run_task(t, include_output) for t in tasks]
+    finally:
+        db.close()
+
+
+@app.websocket("/ws/playbooks/runs/{run_id}")
+async def playbook_run_websocket(
+    websocket: WebSocket,
+    run_id: int,
+    token: Optional[str] = Query(None),
+    include_output: bool = Query(False)
+):
+    """Stream a run: one "snapshot" of what is already recorded, then "status"/"task" events until "done" """
+    await websocket.accept()
+    if not verify_ws_token(token):
+        await websocket.send_text(json.dumps({"error": "Unauthorized connection"}))
+        await websocket.close(code=1008)
+        return
+
+    # Subscribe, then take unflushed results, then read the database: every
+    # result lands in at least one of the three (duplicates are dropped below)
+    queue = job_runner.subscribe(run_id)
+    try:
+        pending = job_runner.pending_results(run_id)
+        snapshot = await asyncio.to_thread(load_run_snapshot, run_id, include_output)
+        if snapshot is None:
+            await websocket.send_text(json.dumps({"error": "Run not found"}))
+            await websocket.close(code=1008)
+            return
+
+        run, tasks = snapshot
+        recorded = {(t["host_id"], t["step"]) for t in tasks}
+        for row in pending:
+            if (row["host_id"], row["step"]) in recorded:
+                continue
+            task = {key: value for key, value in row.items() if key != "run_id"}
+            task["id"] = None
+            task["finished_at"] = row["finished_at"].isoformat()
+            if not include_output:
+                task.pop("output")
+            tasks.append(task)
+        await websocket.send_text(json.dumps({"type": "snapshot", "run": run, "tasks": tasks}))
+        if run["status"] not in ("queued", "running") or (not job_runner.is_active(run_id) and queue.empty()):
+            await websocket.close()
+            return
+
+        seen = {(t["host_id"], t["step"]) for t in tasks}
+        while True:
+            event = await queue.get()
+            if event["type"] == "task":
+                if (event["host_id"], event["step"]) in seen:
+                    continue
+                if not include_output:
+                    event = {key: value for key, value in event.items() if key != "output"}
+            await websocket.send_text(json.dumps(event))
+            if event["type"] == "done":
+                break
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        job_runner.unsubscribe(run_id, queue)
+
+
 # ============ DASHBOARD API ============
 
 @app.get("/api/dashboard")
-def get_dashboard(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    hosts = db.query(Host).all()
-    total_hosts = len(hosts)
-    connected_hosts = [(h, pool.get_connection(h.id)) for h in hosts]
-    connected = sum(1 for _, conn in connected_hosts if conn and conn.is_connected)
-    
-    total_commands = db.query(CommandHistory).count()
-    recent_commands = db.query(CommandHistory).order_by(
-        CommandHistory.executed_at.desc()
-    ).limit(10).all()
-    
-    playbooks = db.query(Playbook).count()
-    
+def get_dashboard(request: Request, current_user: User = Depends(get_current_user)):
+    """Served from in-memory counters; clients polling with If-None-Match get a 304 until something changes"""
+    etag = dashboard.stats.etag()
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(dashboard.stats.snapshot(), headers=headers)
+
+
+# ============ SYSTEM API ============
+
+@app.get("/api/system/executors")
+def get_executor_stats(current_user: User = Depends(get_current_user)):
+    return executors.get_stats()
+
+
+@app.get("/api/system/history-writer")
+def get_history_writer_stats(current_user: User = Depends(get_current_user)):
+    return history_writer.stats()
+
+
+@app.get("/api/system/recordings")
+def get_recording_writer_stats(current_user: User = Depends(get_current_user)):
+    return recording_writer.stats()
+
+
+@app.get("/api/system/retention")
+def get_retention_state(current_user: User = Depends(get_current_user)):
+    return {
+        "retention_days": history_retention.HISTORY_RETENTION_DAYS,
+        "archive": history_retention.HISTORY_ARCHIVE,
+        "last_cycle": history_retention.last_cycle
+    }
+
+
+@app.post("/api/system/retention/convert-vacuum")
+async def convert_database_vacuum(current_user: User = Depends(get_admin_user)):
+    """One-off maintenance: rewrite the database in incremental auto-vacuum mode (locks it meanwhile)"""
+    return await asyncio.to_thread(history_retention.convert_to_incremental_vacuum, engine)
+
+
+@app.get("/api/system/output-store")
+def get_output_store_stats(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    return storage_stats(db)
+
+
+@app.get("/api/system/pool")
+def get_pool_state(current_user: User = Depends(get_current_user)):
     return {
-        "total_hosts": total_hosts,
-        "connected_hosts": connected,
-        "total_commands": total_commands,
-        "recent_commands": [
-            {
-                "id": c.id,
-                "command": c.command,
-                "status": c.status,
-                "executed_at": c.executed_at.isoformat()
-            }
-            for c in recent_commands
-        ],
-        "total_playbooks": playbooks
+        "connections": pool.get_state(),
+        "last_maintenance": pool_maintenance.last_cycle
     }
 
 
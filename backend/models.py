@@ -1,5 +1,5 @@
 """Database models for Neutron Web"""
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, ForeignKey, JSON
+from sqlalchemy import Column, Integer, Float, String, Text, Date, DateTime, Boolean, ForeignKey, JSON, Index, LargeBinary, inspect, text
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime, timezone
 
@@ -34,13 +34,42 @@ class CommandHistory(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     host_id = Column(Integer, ForeignKey("hosts.id"))
     command = Column(Text, nullable=False)
-    output = Column(Text, nullable=True)
+    output = Column(Text, nullable=True)  # Legacy inline output; new rows use output_blob_id
+    output_blob_id = Column(Integer, ForeignKey("output_blobs.id"), nullable=True)
     exit_code = Column(Integer, nullable=True)
     executed_at = Column(DateTime, default=utcnow)
     status = Column(String(20), default="running")  # running, success, failed
 
     host = relationship("Host", back_populates="commands")
 
+    # Keyset pagination walks (executed_at, id) newest first, optionally within one host or status
+    __table_args__ = (
+        Index("ix_command_history_executed_at_id", "executed_at", "id"),
+        Index("ix_command_history_host_executed_at_id", "host_id", "executed_at", "id"),
+        Index("ix_command_history_status_executed_at_id", "status", "executed_at", "id"),
+        Index("ix_command_history_output_blob_id_id", "output_blob_id", "id"),
+    )
+
+
+class OutputBlob(Base):
+    """Compressed command output, stored once per distinct content"""
+    __tablename__ = "output_blobs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    sha256 = Column(String(64), nullable=False, unique=True)
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed UTF-8
+    size = Column(Integer, nullable=False)  # Uncompressed bytes
+
+
+class HistoryRollup(Base):
+    """Daily per-host command counts; outlive the history rows they summarize"""
+    __tablename__ = "history_daily_rollups"
+
+    day = Column(Date, primary_key=True)
+    host_id = Column(Integer, primary_key=True)  # 0 for rows without a host
+    commands = Column(Integer, default=0)
+    failures = Column(Integer, default=0)  # status other than "success"
+
 
 class Playbook(Base):
     __tablename__ = "playbooks"
@@ -55,6 +84,64 @@ class Playbook(Base):
     updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
 
 
+class PlaybookRun(Base):
+    __tablename__ = "playbook_runs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    playbook_id = Column(Integer, ForeignKey("playbooks.id", ondelete="SET NULL"), nullable=True)
+    name = Column(String(255), nullable=True)
+    status = Column(String(20), default="queued")  # queued, running, success, failed, error
+    host_ids = Column(JSON, nullable=False)
+    options = Column(JSON, nullable=True)  # forks, strategy, serial, ...
+    total_steps = Column(Integer, default=0)  # hosts x tasks
+    completed_steps = Column(Integer, default=0)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    tasks = relationship("PlaybookRunTask", back_populates="run", cascade="all, delete-orphan")
+
+
+class PlaybookRunTask(Base):
+    __tablename__ = "playbook_run_tasks"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_id = Column(Integer, ForeignKey("playbook_runs.id"), nullable=False, index=True)
+    host_id = Column(Integer, nullable=False)
+    step = Column(Integer, nullable=False)
+    name = Column(Text, nullable=True)
+    status = Column(String(20), nullable=False)  # ok, changed, success, failed, skipped
+    changed = Column(Boolean, default=False)
+    output = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    exit_code = Column(Integer, nullable=True)
+    finished_at = Column(DateTime, default=utcnow)
+
+    run = relationship("PlaybookRun", back_populates="tasks")
+
+
+class TerminalRecording(Base):
+    """Recorded interactive terminal session; events are in recordings/<file_name>"""
+    __tablename__ = "terminal_recordings"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    host_id = Column(Integer, nullable=True, index=True)
+    host_name = Column(String(255), nullable=True)  # Kept for audits after the host is deleted
+    username = Column(String(100), nullable=True)
+    width = Column(Integer, default=80)
+    height = Column(Integer, default=24)
+    status = Column(String(20), default="recording")  # recording, finished, interrupted
+    started_at = Column(DateTime, default=utcnow, index=True)
+    ended_at = Column(DateTime, nullable=True)
+    duration = Column(Float, default=0)  # Seconds
+    events = Column(Integer, default=0)
+    raw_bytes = Column(Integer, nullable=True)  # Uncompressed asciicast size
+    stored_bytes = Column(Integer, nullable=True)
+    file_name = Column(String(255), nullable=True)
+    chunk_index = Column(JSON, nullable=True)  # [[time, file offset], ...] per gzip member
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -63,3 +150,25 @@ class User(Base):
     hashed_password = Column(String(255), nullable=False)
     is_admin = Column(Boolean, default=False)
     created_at = Column(DateTime, default=utcnow)
+
+
+def ensure_columns(engine):
+    """Add nullable columns declared on models but missing from existing tables"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
+def ensure_indexes(engine):
+    """Create indexes added to tables that already exist (create_all skips those)"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
@@ -0,0 +1,162 @@
+"""Content-addressed storage for command output
+
+A fleet-wide command usually prints the same thing on most hosts. Outputs are
+stored once per distinct content (keyed by SHA-256) and zlib-compressed in
+the output_blobs table; command_history rows only reference the blob.
+"""
+import hashlib
+import logging
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from models import OutputBlob
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_LEVEL = 6
+# Rows per transaction when moving inline outputs into blobs
+MIGRATION_BATCH_SIZE = 1000
+
+# Held from blob lookup until commit by writers that reference blobs, and from
+# delete until commit by anything removing unreferenced blobs, so a sweep cannot
+# drop a blob a writer is about to point at. Take it before the transaction's
+# first write, otherwise it can wait on a session that holds SQLite's write lock.
+blob_lock = threading.Lock()
+
+
+def compress(output: str) -> bytes:
+    return zlib.compress(output.encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def decompress(data: Optional[bytes]) -> str:
+    if data is None:
+        return ""
+    return zlib.decompress(data).decode("utf-8", errors="replace")
+
+
+def content_hash(output: str) -> str:
+    return hashlib.sha256(output.encode("utf-8")).hexdigest()
+
+
+def register_sqlite_functions(engine):
+    """Expose decompression to SQL as neutron_inflate(data), used by the full-text index"""
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _register(dbapi_connection, connection_record):
+        dbapi_connection.create_function("neutron_inflate", 1, decompress, deterministic=True)
+
+
+def store_outputs(db: Session, outputs: Iterable[str]) -> Dict[str, int]:
+    """Ensure a blob exists for every non-empty output; returns {output: blob_id}.
+
+    Runs inside the caller's transaction; the caller holds blob_lock and commits.
+    """
+    by_hash = {content_hash(o): o for o in set(outputs) if o}
+    if not by_hash:
+        return {}
+
+    ids = _blob_ids(db, list(by_hash))
+    missing = [sha for sha in by_hash if sha not in ids]
+    if missing:
+        # Another connection may have inserted the same content without committing yet
+        db.execute(insert(OutputBlob).on_conflict_do_nothing(index_elements=["sha256"]), [
+            {
+                "sha256": sha,
+                "data": compress(by_hash[sha]),
+                "size": len(by_hash[sha].encode("utf-8"))
+            }
+            for sha in missing
+        ])
+        ids.update(_blob_ids(db, missing))
+
+    return {output: ids[sha] for sha, output in by_hash.items()}
+
+
+def _blob_ids(db: Session, hashes: List[str]) -> Dict[str, int]:
+    ids = {}
+    # Stay well below SQLite's bound parameter limit
+    for i in range(0, len(hashes), 500):
+        for blob_id, sha in db.query(OutputBlob.id, OutputBlob.sha256).filter(OutputBlob.sha256.in_(hashes[i:i + 500])):
+            ids[sha] = blob_id
+    return ids
+
+
+def load_outputs(db: Session, blob_ids: Iterable[int]) -> Dict[int, str]:
+    """Decompressed output for each blob ID"""
+    wanted = list({b for b in blob_ids if b is not None})
+    outputs = {}
+    for i in range(0, len(wanted), 500):
+        for blob_id, data in db.query(OutputBlob.id, OutputBlob.data).filter(OutputBlob.id.in_(wanted[i:i + 500])):
+            outputs[blob_id] = decompress(data)
+    return outputs
+
+
+def migrate_inline_outputs(session_factory, stop: Optional[threading.Event] = None) -> int:
+    """Move outputs still stored inline in command_history into blobs; returns rows migrated.
+
+    Safe to interrupt (via `stop`) and resume: each batch is its own transaction.
+    """
+    migrated = 0
+    last_id = 0
+    while not (stop and stop.is_set()):
+        db = session_factory()
+        try:
+            rows = db.execute(text(
+                "SELECT id, output FROM command_history "
+                "WHERE id > :last_id AND output IS NOT NULL AND output_blob_id IS NULL "
+                "ORDER BY id LIMIT :limit"
+            ), {"last_id": last_id, "limit": MIGRATION_BATCH_SIZE}).all()
+            if not rows:
+                break
+
+            with blob_lock:
+                blob_ids = store_outputs(db, (row.output for row in rows))
+                db.execute(
+                    text("UPDATE command_history SET output_blob_id = :blob_id, output = NULL WHERE id = :id"),
+                    [{"id": row.id, "blob_id": blob_ids.get(row.output)} for row in rows]
+                )
+                db.commit()
+            migrated += len(rows)
+            last_id = rows[-1].id
+        except Exception as e:
+            logger.error(f"Output store migration stopped: {e}")
+            break
+        finally:
+            db.close()
+
+    if migrated:
+        logger.info(f"Moved {migrated} history outputs into the deduplicated output store")
+    return migrated
+
+
+def delete_orphan_blobs(db: Session) -> int:
+    """Delete blobs no history row references any more (e.g. after a host is deleted); returns blobs removed.
+
+    Runs inside the caller's transaction; the caller holds blob_lock and commits.
+    """
+    result = db.execute(text(
+        "DELETE FROM output_blobs WHERE NOT EXISTS "
+        "(SELECT 1 FROM command_history h WHERE h.output_blob_id = output_blobs.id)"
+    ))
+    return result.rowcount
+
+
+def storage_stats(db: Session) -> Dict[str, int]:
+    row = db.execute(text(
+        "SELECT COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS raw_bytes, "
+        "COALESCE(SUM(LENGTH(data)), 0) AS stored_bytes FROM output_blobs"
+    )).one()
+    return {"blobs": row.blobs, "raw_bytes": row.raw_bytes, "stored_bytes": row.stored_bytes}
+
+
+def history_outputs(db: Session, rows: List) -> List[str]:
+    """Output text for history rows that carry `output` and `output_blob_id`"""
+    blobs = load_outputs(db, (row.output_blob_id for row in rows if row.output is None))
+    return [row.output if row.output is not None else blobs.get(row.output_blob_id, "") for row in rows]
@@ -0,0 +1,62 @@
+"""Background upkeep of the SSH connection pool
+
+Runs off the request path: probes every transport, reaps idle connections and
+reconnects dropped hosts (with per-host backoff), so a fan-out never has to
+pay for a surprise reconnect.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict
+
+from ssh_manager import pool
+from executors import run_batch
+
+logger = logging.getLogger(__name__)
+
+POOL_MAINTENANCE_INTERVAL = int(os.getenv("POOL_MAINTENANCE_INTERVAL", "30"))
+# Seconds without use before a connection is closed (0 disables reaping)
+POOL_IDLE_TIMEOUT = int(os.getenv("POOL_IDLE_TIMEOUT", "3600"))
+
+last_cycle: Dict[str, Any] = {}
+
+
+async def run_maintenance_cycle() -> Dict[str, Any]:
+    """One pass of idle reaping, health probing and reconnecting"""
+    # Cached SFTP sessions hold a session slot, which would keep a connection from being reaped
+    sftp_closed = pool.close_idle_sftp()
+    reaped = pool.cleanup_idle(POOL_IDLE_TIMEOUT) if POOL_IDLE_TIMEOUT > 0 else []
+
+    dead = await run_batch(pool.find_dead)
+    due = [conn for conn in dead if not conn.in_backoff()]
+    outcomes = await asyncio.gather(*(run_batch(conn.reconnect) for conn in due))
+    reconnected = [conn.host_id for conn, (success, _) in zip(due, outcomes) if success]
+
+    if reaped or dead:
+        logger.info(
+            f"Pool maintenance: reaped {len(reaped)}, dead {len(dead)}, "
+            f"reconnected {len(reconnected)}/{len(due)}"
+        )
+
+    last_cycle.clear()
+    last_cycle.update({
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "reaped": reaped,
+        "sftp_sessions_closed": sftp_closed,
+        "dead": [conn.host_id for conn in dead],
+        "reconnected": reconnected
+    })
+    return last_cycle
+
+
+async def maintenance_loop(interval: int = POOL_MAINTENANCE_INTERVAL):
+    """Run maintenance cycles forever; cancel the task to stop it"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_maintenance_cycle()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Pool maintenance failed: {e}")
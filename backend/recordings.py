@@ -0,0 +1,367 @@
+"""Terminal session recording and replay
+
+Each interactive session is written as an asciicast v2 stream (a JSON header
+line, then one [time, code, data] line per event) to recordings/<id>.cast.gz.
+The file is a series of independent gzip members of roughly
+RECORDING_CHUNK_BYTES each, so `zcat` reads it as a plain .cast file while the
+replay endpoint can seek straight to the member covering a given time using
+the chunk index kept on the TerminalRecording row.
+
+The shell bridge only appends events to an in-memory list; a single
+background task compresses and writes every active session in a worker
+thread once per RECORDING_FLUSH_INTERVAL. The same task deletes recordings
+older than RECORDING_RETENTION_DAYS, rows and files together.
+"""
+import asyncio
+import codecs
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from models import TerminalRecording
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_RECORDING = os.getenv("TERMINAL_RECORDING", "true").lower() in ("1", "true", "yes")
+# Keystrokes can contain passwords typed at prompts; off unless asked for
+TERMINAL_RECORD_INPUT = os.getenv("TERMINAL_RECORD_INPUT", "false").lower() in ("1", "true", "yes")
+RECORDINGS_DIR = Path(os.getenv("RECORDINGS_DIR", Path(__file__).parent.parent / "recordings"))
+RECORDING_FLUSH_INTERVAL = float(os.getenv("RECORDING_FLUSH_INTERVAL", "1.0"))
+# Uncompressed bytes per gzip member (the seek granularity)
+RECORDING_CHUNK_BYTES = int(os.getenv("RECORDING_CHUNK_BYTES", str(256 * 1024)))
+# Days a finished recording is kept (0 keeps them forever)
+RECORDING_RETENTION_DAYS = int(os.getenv("RECORDING_RETENTION_DAYS", "30"))
+RECORDING_PURGE_INTERVAL = 3600
+COMPRESSION_LEVEL = 6
+READ_BLOCK_BYTES = 64 * 1024
+
+
+class Recording:
+    """Event sink for one session; every method returns immediately"""
+
+    def __init__(self, recording_id: int, path: Path, width: int, height: int):
+        self.id = recording_id
+        self.path = path
+        self.width = width
+        self.height = height
+        self._started = time.monotonic()
+        self._events: List[tuple] = []
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def _add(self, code: str, data):
+        with self._lock:
+            if not self.closed:
+                self._events.append((time.monotonic() - self._started, code, data))
+
+    def output(self, data: bytes):
+        self._add("o", data)
+
+    def input(self, data: bytes):
+        if TERMINAL_RECORD_INPUT:
+            self._add("i", data)
+
+    def resize(self, cols: int, rows: int):
+        self._add("r", f"{cols}x{rows}")
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+
+    def take(self) -> List[tuple]:
+        with self._lock:
+            events, self._events = self._events, []
+            return events
+
+
+class _RecordingFile:
+    """Writer-thread state for one recording: open file, current gzip member, chunk index"""
+
+    def __init__(self, recording: Recording, header: Dict[str, Any]):
+        self.recording = recording
+        self.file = open(recording.path, "ab")
+        self.compressor = None
+        self.member_bytes = 0
+        self.index: List[List[float]] = []
+        self.events = 0
+        self.raw_bytes = 0
+        self.duration = 0.0
+        # Multi-byte characters may be split across reads
+        self.decoders = {"o": codecs.getincrementaldecoder("utf-8")("replace"),
+                         "i": codecs.getincrementaldecoder("utf-8")("replace")}
+        self._write_line(0.0, json.dumps(header).encode() + b"\n")
+
+    def _write_line(self, t: float, line: bytes):
+        if self.compressor is None:
+            self.index.append([round(t, 6), self.file.tell()])
+            self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+        self.file.write(self.compressor.compress(line))
+        self.member_bytes += len(line)
+        self.raw_bytes += len(line)
+        if self.member_bytes >= RECORDING_CHUNK_BYTES:
+            self._end_member()
+
+    def _end_member(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+            self.member_bytes = 0
+
+    def write(self, events: List[tuple]):
+        for t, code, data in events:
+            if isinstance(data, bytes):
+                data = self.decoders[code].decode(data)
+                if not data:
+                    continue
+            self._write_line(t, json.dumps([round(t, 6), code, data]).encode() + b"\n")
+            self.events += 1
+            self.duration = t
+        if self.compressor is not None:
+            # Make everything so far readable (live replay, crash) without ending the member
+            self.file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.file.flush()
+
+    def finish(self) -> int:
+        self._end_member()
+        size = self.file.tell()
+        self.file.close()
+        return size
+
+
+class RecordingWriter:
+    """Creates recordings and writes their events from a background task"""
+
+    def __init__(self, session_factory, flush_interval: float = RECORDING_FLUSH_INTERVAL):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self._files: Dict[int, _RecordingFile] = {}
+        self._files_lock = threading.Lock()
+        # A flush cancelled by stop() keeps running in its thread; never overlap two
+        self._flush_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def open(self, host_id: int, host_name: str, username: Optional[str],
+                   width: int = 80, height: int = 24) -> Optional[Recording]:
+        """Start recording a session; None when recording is disabled or fails"""
+        if not TERMINAL_RECORDING:
+            return None
+        try:
+            return await asyncio.to_thread(self._open, host_id, host_name, username, width, height)
+        except Exception as e:
+            logger.error(f"Failed to start terminal recording: {e}")
+            return None
+
+    def _open(self, host_id, host_name, username, width, height) -> Recording:
+        RECORDINGS_DIR.mkdir(parents=True, exist_ok=True)
+        started_at = datetime.now(timezone.utc)
+        db = self.session_factory()
+        try:
+            row = TerminalRecording(
+                host_id=host_id, host_name=host_name, username=username,
+                width=width, height=height, started_at=started_at, status="recording"
+            )
+            db.add(row)
+            db.flush()
+            row.file_name = f"{row.id}.cast.gz"
+            db.commit()
+            recording = Recording(row.id, RECORDINGS_DIR / row.file_name, width, height)
+        finally:
+            db.close()
+
+        header = {
+            "version": 2,
+            "width": width,
+            "height": height,
+            "timestamp": int(started_at.timestamp()),
+            "title": f"{username or ''}@{host_name}"
+        }
+        state = _RecordingFile(recording, header)
+        with self._files_lock:
+            self._files[recording.id] = state
+        return recording
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and finish every open recording"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        with self._files_lock:
+            states = list(self._files.values())
+        for state in states:
+            state.recording.close()
+        await asyncio.to_thread(self._flush)
+
+    async def _run(self):
+        next_purge = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self._flush)
+            except Exception as e:
+                logger.error(f"Terminal recording flush failed: {e}")
+            if RECORDING_RETENTION_DAYS > 0 and time.monotonic() >= next_purge:
+                next_purge = time.monotonic() + RECORDING_PURGE_INTERVAL
+                try:
+                    await asyncio.to_thread(self.purge, RECORDING_RETENTION_DAYS)
+                except Exception as e:
+                    logger.error(f"Terminal recording purge failed: {e}")
+
+    def _flush(self):
+        with self._flush_lock:
+            with self._files_lock:
+                states = list(self._files.values())
+            for state in states:
+                # Read before take() so events added just before close() are kept
+                closed = state.recording.closed
+                try:
+                    state.write(state.recording.take())
+                except Exception as e:
+                    logger.error(f"Failed to write terminal recording {state.recording.id}: {e}")
+                    closed = True
+                if closed:
+                    with self._files_lock:
+                        del self._files[state.recording.id]
+                    self._finish(state)
+
+    def _finish(self, state: _RecordingFile):
+        try:
+            stored_bytes = state.finish()
+        except Exception as e:
+            logger.error(f"Failed to close terminal recording {state.recording.id}: {e}")
+            stored_bytes = None
+        db = self.session_factory()
+        try:
+            row = db.query(TerminalRecording).filter(TerminalRecording.id == state.recording.id).first()
+            if row:
+                row.status = "finished"
+                row.ended_at = datetime.now(timezone.utc)
+                row.duration = round(state.duration, 3)
+                row.events = state.events
+                row.raw_bytes = state.raw_bytes
+                row.stored_bytes = stored_bytes
+                row.chunk_index = state.index
+                db.commit()
+        finally:
+            db.close()
+
+    def recover(self):
+        """Mark recordings left open by a previous process; they replay from the start"""
+        db = self.session_factory()
+        try:
+            count = db.query(TerminalRecording).filter(
+                TerminalRecording.status == "recording"
+            ).update({"status": "interrupted"})
+            db.commit()
+            if count:
+                logger.warning(f"Marked {count} unfinished terminal recordings as interrupted")
+        finally:
+            db.close()
+
+    def purge(self, max_age_days: int) -> int:
+        """Delete recordings (rows and files) that ended more than `max_age_days` ago; returns recordings removed"""
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).replace(tzinfo=None)
+        db = self.session_factory()
+        try:
+            rows = db.query(TerminalRecording).filter(
+                TerminalRecording.status != "recording",
+                TerminalRecording.started_at < cutoff
+            ).all()
+            deleted = 0
+            for row in rows:
+                if row.file_name:
+                    try:
+                        (RECORDINGS_DIR / row.file_name).unlink()
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        # Keep the row so the file is retried next time
+                        logger.warning(f"Could not delete recording file {row.file_name}: {e}")
+                        continue
+                db.delete(row)
+                deleted += 1
+            db.commit()
+        finally:
+            db.close()
+        if deleted:
+            logger.info(f"Deleted {deleted} terminal recordings older than {max_age_days} days")
+        return deleted
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": TERMINAL_RECORDING,
+            "active": len(self._files),
+            "record_input": TERMINAL_RECORD_INPUT,
+            "flush_interval": self.flush_interval,
+            "retention_days": RECORDING_RETENTION_DAYS
+        }
+
+
+def _event_time(line: bytes) -> float:
+    return float(line[1:line.index(b",")])
+
+
+def iter_recording(path: Path, chunk_index: Optional[List], start: float = 0.0,
+                   end: Optional[float] = None) -> Iterator[bytes]:
+    """Yield the asciicast header, then event lines with start <= time <= end.
+
+    Seeks to the gzip member covering `start` and decompresses block by block,
+    so memory use does not depend on the recording's length.
+    """
+    offset = 0
+    for t, member_offset in chunk_index or []:
+        if t > start:
+            break
+        offset = member_offset
+
+    with open(path, "rb") as f:
+        if offset:
+            # The header lives in the first member
+            yield _read_header(f)
+            f.seek(offset)
+
+        decompressor = zlib.decompressobj(31)
+        pending = b""
+        while True:
+            block = f.read(READ_BLOCK_BYTES)
+            if not block:
+                break
+            data = decompressor.decompress(block)
+            while decompressor.eof and decompressor.unused_data:
+                rest = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+                data += decompressor.decompress(rest)
+
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if not line:
+                    continue
+                if line.startswith(b"{"):
+                    yield line + b"\n"
+                    continue
+                t = _event_time(line)
+                if end is not None and t > end:
+                    return
+                if t >= start:
+                    yield line + b"\n"
+
+
+def _read_header(f) -> bytes:
+    decompressor = zlib.decompressobj(31)
+    data = b""
+    while b"\n" not in data:
+        block = f.read(4096)
+        if not block:
+            break
+        data += decompressor.decompress(block)
+    return data.split(b"\n", 1)[0] + b"\n"
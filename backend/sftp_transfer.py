@@ -0,0 +1,205 @@
+"""Pipelined, resumable SFTP transfers
+
+paramiko's put/get wait on small windows and start from zero every time.
+These helpers work on an already open SFTPClient (see
+SSHConnection.sftp_session, which reuses sessions):
+
+- up to SFTP_MAX_REQUESTS 32 KiB requests are kept in flight in both
+  directions: downloads prefetch, uploads pipeline their writes and wait
+  only for the oldest acknowledgement (paramiko's own pipelining stops to
+  collect every outstanding acknowledgement each time more than 100 are
+  pending, which stalls the pipe once per round trip)
+- sessions are opened with a SFTP_WINDOW_BYTES channel window, which is what
+  bounds throughput on high-latency links
+- data goes to "<path>.part" and is renamed into place when complete. Next to
+  it, "<path>.part.json" records the source's size and modification time; a
+  leftover .part is resumed only when that record matches the source as it
+  is now (and the tail of the part still matches), so a partial copy of an
+  older version or of another file is never extended into place
+"""
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, Optional
+
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from the source per step (paramiko splits them into 32 KiB requests)
+SFTP_CHUNK_BYTES = int(os.getenv("SFTP_CHUNK_BYTES", str(1024 * 1024)))
+# Outstanding 32 KiB requests per transfer (writes are capped below 100, see write_pipelined)
+SFTP_MAX_REQUESTS = int(os.getenv("SFTP_MAX_REQUESTS", "128"))
+# SSH channel window for SFTP sessions; raise it for long fat links
+SFTP_WINDOW_BYTES = int(os.getenv("SFTP_WINDOW_BYTES", str(16 * 1024 * 1024)))
+SFTP_RESUME = os.getenv("SFTP_RESUME", "true").lower() in ("1", "true", "yes")
+PART_SUFFIX = ".part"
+META_SUFFIX = PART_SUFFIX + ".json"
+# Bytes compared at the end of a partial file before trusting it
+VERIFY_BYTES = 64 * 1024
+
+Progress = Optional[Callable[[int, int], None]]
+
+
+def open_sftp(transport: paramiko.Transport) -> paramiko.SFTPClient:
+    return paramiko.SFTPClient.from_transport(transport, window_size=SFTP_WINDOW_BYTES)
+
+
+def replace_remote(sftp: paramiko.SFTPClient, source: str, target: str):
+    """Rename over an existing file (plain SFTP rename refuses to)"""
+    try:
+        sftp.posix_rename(source, target)
+        return
+    except IOError:
+        pass
+    try:
+        sftp.remove(target)
+    except IOError:
+        pass
+    sftp.rename(source, target)
+
+
+def _identity(path: str, size: int, mtime: float) -> Dict[str, Any]:
+    """What a partial copy must have been made from to be resumed"""
+    return {"source": path, "size": size, "mtime": int(mtime)}
+
+
+def _read_at(f, offset: int, length: int) -> bytes:
+    f.seek(offset)
+    return f.read(length)
+
+
+def _resume_offset(part_size: Optional[int], size: int, part_file, source_file) -> int:
+    """Size of a partial copy if its last bytes match the source, else 0"""
+    if not part_size or part_size > size:
+        return 0
+    n = min(VERIFY_BYTES, part_size)
+    if _read_at(part_file, part_size - n, n) != _read_at(source_file, part_size - n, n):
+        return 0
+    return part_size
+
+
+def write_pipelined(f: paramiko.SFTPFile, data: bytes, max_requests: int = SFTP_MAX_REQUESTS):
+    """Write to a pipelined file, keeping at most max_requests writes unacknowledged"""
+    # The window reads SFTPFile internals (paramiko is pinned in requirements.txt);
+    # without them fall back to paramiko's own pipelining
+    if not (hasattr(f, "_reqs") and hasattr(f.sftp, "_read_response")):
+        f.write(data)
+        return
+    # paramiko drains every pending write once a new one makes more than 100
+    limit = max(1, min(max_requests, 96))
+    view = memoryview(data)
+    for i in range(0, len(data), f.MAX_REQUEST_SIZE):
+        f.write(view[i:i + f.MAX_REQUEST_SIZE])
+        while len(f._reqs) > limit:
+            f.sftp._read_response(f._reqs.popleft())
+
+
+def _read_remote_meta(sftp: paramiko.SFTPClient, path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with sftp.open(path, "r") as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _read_local_meta(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def upload(sftp: paramiko.SFTPClient, local_path: str, remote_path: str, resume: bool = SFTP_RESUME,
+           chunk_size: int = SFTP_CHUNK_BYTES, max_requests: int = SFTP_MAX_REQUESTS,
+           progress: Progress = None) -> Dict[str, Any]:
+    st = os.stat(local_path)
+    size = st.st_size
+    identity = _identity(local_path, size, st.st_mtime)
+    part = remote_path + PART_SUFFIX
+    meta = remote_path + META_SUFFIX
+    offset = 0
+    with open(local_path, "rb") as src:
+        if resume and _read_remote_meta(sftp, meta) == identity:
+            try:
+                part_size = sftp.stat(part).st_size
+            except IOError:
+                part_size = None
+            if part_size:
+                with sftp.open(part, "r") as existing:
+                    offset = _resume_offset(part_size, size, existing, src)
+        if resume and not offset:
+            # Recorded before any data, so the .part never outlives a record of its source
+            with sftp.open(meta, "w") as f:
+                f.write(json.dumps(identity))
+
+        with sftp.open(part, "r+" if offset else "w") as dst:
+            dst.set_pipelined(True)
+            dst.seek(offset)
+            src.seek(offset)
+            done = offset
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                write_pipelined(dst, chunk, max_requests)
+                done += len(chunk)
+                if progress:
+                    progress(done, size)
+        # close() above collected every pipelined acknowledgement
+
+    written = sftp.stat(part).st_size
+    if written != size:
+        raise IOError(f"Remote file has {written} bytes, expected {size}")
+    replace_remote(sftp, part, remote_path)
+    if resume:
+        try:
+            sftp.remove(meta)
+        except IOError:
+            pass
+    return {"size": size, "transferred": size - offset, "resumed_from": offset}
+
+
+def download(sftp: paramiko.SFTPClient, remote_path: str, local_path: str, resume: bool = SFTP_RESUME,
+             chunk_size: int = SFTP_CHUNK_BYTES, max_requests: int = SFTP_MAX_REQUESTS,
+             progress: Progress = None) -> Dict[str, Any]:
+    part = local_path + PART_SUFFIX
+    meta = local_path + META_SUFFIX
+    with sftp.open(remote_path, "r") as src:
+        attrs = src.stat()
+        size = attrs.st_size
+        identity = _identity(remote_path, size, attrs.st_mtime or 0)
+        offset = 0
+        if resume and os.path.exists(part) and _read_local_meta(meta) == identity:
+            with open(part, "rb") as existing:
+                offset = _resume_offset(os.path.getsize(part), size, existing, src)
+        if resume and not offset:
+            with open(meta, "w") as f:
+                json.dump(identity, f)
+
+        with open(part, "r+b" if offset else "wb") as dst:
+            dst.seek(offset)
+            dst.truncate()
+            src.seek(offset)
+            # Prefetch starts at the current position
+            src.prefetch(size, max_concurrent_requests=max_requests)
+            done = offset
+            while done < size:
+                chunk = src.read(min(chunk_size, size - done))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(done, size)
+
+    if done != size:
+        raise IOError(f"Read {done} of {size} bytes")
+    os.replace(part, local_path)
+    if resume:
+        try:
+            os.remove(meta)
+        except FileNotFoundError:
+            pass
+    return {"size": size, "transferred": size - offset, "resumed_from": offset}
@@ -2,10 +2,16 @@
 import paramiko
 import threading
 import os
+import time
+import select
 import logging
-from typing import Dict, Optional, Tuple
+import weakref
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from capture import OutputCapture, new_spill_path
+import sftp_transfer
 
 
 def utcnow():
@@ -14,6 +20,151 @@ def utcnow():
 logger = logging.getLogger(__name__)
 
 
+# Concurrent sessions per transport; keep below the server's MaxSessions (OpenSSH default 10)
+MAX_SESSIONS_PER_TRANSPORT = int(os.getenv("SSH_MAX_SESSIONS", "8"))
+# Transports per host; extra ones are opened only when requests queue up
+MAX_TRANSPORTS_PER_HOST = int(os.getenv("SSH_MAX_TRANSPORTS", "1"))
+# Number of queued requests that justifies opening another transport
+TRANSPORT_SPAWN_QUEUE_DEPTH = int(os.getenv("SSH_TRANSPORT_SPAWN_QUEUE", "2"))
+# How long a request may wait for a free session slot (the waiting worker thread is blocked meanwhile)
+SESSION_WAIT_TIMEOUT = int(os.getenv("SSH_SESSION_WAIT_TIMEOUT", "30"))
+# Backoff between failed reconnect attempts (doubles up to the maximum)
+RECONNECT_BASE_BACKOFF = int(os.getenv("SSH_RECONNECT_BACKOFF", "5"))
+RECONNECT_MAX_BACKOFF = int(os.getenv("SSH_RECONNECT_MAX_BACKOFF", "300"))
+# Idle SFTP sessions cached per host for reuse; each keeps one session slot
+SFTP_IDLE_SESSIONS = int(os.getenv("SFTP_IDLE_SESSIONS", "1"))
+SFTP_IDLE_TIMEOUT = int(os.getenv("SFTP_IDLE_TIMEOUT", "60"))
+# Attempts per transfer; later attempts reconnect if needed and resume
+SFTP_TRANSFER_ATTEMPTS = int(os.getenv("SFTP_TRANSFER_ATTEMPTS", "3"))
+
+
+class ChannelScheduler:
+    """Hands out session slots on the transports of one host.
+
+    Each transport carries at most `max_sessions` open channels; further
+    requests queue until a slot is released. When the queue reaches
+    `spawn_queue_depth` and fewer than `max_transports` are open, another
+    transport to the same host is opened to absorb the load.
+    """
+
+    def __init__(self, connection: "SSHConnection", max_sessions: int, max_transports: int,
+                 spawn_queue_depth: int = TRANSPORT_SPAWN_QUEUE_DEPTH):
+        self.connection = connection
+        self.max_sessions = max(1, max_sessions)
+        self.max_transports = max(1, max_transports)
+        self.spawn_queue_depth = max(1, spawn_queue_depth)
+        self.extra_clients: List[paramiko.SSHClient] = []
+        # Open sessions per transport; keyed by the object so a new transport never inherits counts
+        self._in_use: "weakref.WeakKeyDictionary[paramiko.Transport, int]" = weakref.WeakKeyDictionary()
+        self._waiting = 0
+        self._spawning = False
+        self._spawn_retry_at = 0.0
+        self._cond = threading.Condition()
+
+    def _transports(self) -> List[paramiko.Transport]:
+        clients = [self.connection.client] + self.extra_clients
+        transports = [c.get_transport() for c in clients if c]
+        return [t for t in transports if t and t.is_active()]
+
+    def _should_spawn(self) -> bool:
+        return (
+            not self._spawning
+            and time.monotonic() >= self._spawn_retry_at
+            and self._waiting >= self.spawn_queue_depth
+            and 1 + len(self.extra_clients) < self.max_transports
+        )
+
+    def acquire(self, timeout: Optional[float] = None) -> paramiko.Transport:
+        """Reserve a session slot, waiting (or adding a transport) if all are busy"""
+        deadline = time.monotonic() + (SESSION_WAIT_TIMEOUT if timeout is None else timeout)
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    transports = self._transports()
+                    if not transports:
+                        raise RuntimeError("No transport available")
+                    for transport in transports:
+                        if self._in_use.get(transport, 0) < self.max_sessions:
+                            self._in_use[transport] = self._in_use.get(transport, 0) + 1
+                            return transport
+
+                    if self._should_spawn():
+                        self._spawning = True
+                        self._cond.release()
+                        try:
+                            client, message = self.connection.open_client()
+                        finally:
+                            self._cond.acquire()
+                            self._spawning = False
+                        if client:
+                            self.extra_clients.append(client)
+                            logger.info(f"Opened transport {1 + len(self.extra_clients)} to {self.connection.name}")
+                        else:
+                            # Don't hammer a host that refuses more connections
+                            self._spawn_retry_at = time.monotonic() + 30
+                            logger.warning(f"Extra transport to {self.connection.name} failed: {message}")
+                        # Let other waiters claim the new slots (or spawn the next transport)
+                        self._cond.notify_all()
+                        continue
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"Timed out waiting for a free SSH session on {self.connection.name}")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+    def release(self, transport: paramiko.Transport):
+        with self._cond:
+            count = self._in_use.get(transport, 0) - 1
+            if count > 0:
+                self._in_use[transport] = count
+            else:
+                self._in_use.pop(transport, None)
+            # Drop extra transports that died once nothing uses them
+            for client in list(self.extra_clients):
+                t = client.get_transport()
+                if (not t or not t.is_active()) and t not in self._in_use:
+                    self.extra_clients.remove(client)
+                    client.close()
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self, timeout: Optional[float] = None) -> Iterator[paramiko.Transport]:
+        transport = self.acquire(timeout)
+        try:
+            yield transport
+        finally:
+            self.release(transport)
+
+    def close_extra(self):
+        with self._cond:
+            for client in self.extra_clients:
+                try:
+                    client.close()
+                except Exception:
+                    pass
+            self.extra_clients.clear()
+            self._cond.notify_all()
+
+    def reset(self):
+        """Forget all slot accounting and extra transports (the connection is going away)"""
+        with self._cond:
+            self.close_extra()
+            self._in_use.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "transports": len(self._transports()),
+                "sessions_in_use": sum(self._in_use.values()),
+                "queued": self._waiting,
+                "max_sessions": self.max_sessions,
+                "max_transports": self.max_transports
+            }
+
+
 @dataclass
 class SSHConnection:
     host_id: int
@@ -25,21 +176,35 @@ class SSHConnection:
     client: Optional[paramiko.SSHClient] = None
     is_connected: bool = False
     last_used: datetime = field(default_factory=utcnow)
-
-    def connect(self, strict_host_checking: bool = False) -> Tuple[bool, str]:
-        """Establish SSH connection"""
+    strict_host_checking: bool = False
+    max_sessions: int = MAX_SESSIONS_PER_TRANSPORT
+    max_transports: int = MAX_TRANSPORTS_PER_HOST
+    reconnect_failures: int = 0
+    next_reconnect_at: float = 0.0
+    scheduler: ChannelScheduler = field(init=False, repr=False)
+    _reconnect_lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+    # (sftp, transport, idle since) of cached SFTP sessions
+    _sftp_idle: List[Tuple[paramiko.SFTPClient, paramiko.Transport, float]] = field(
+        init=False, repr=False, default_factory=list
+    )
+    _sftp_lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self):
+        self.scheduler = ChannelScheduler(self, self.max_sessions, self.max_transports)
+
+    def open_client(self) -> Tuple[Optional[paramiko.SSHClient], str]:
+        """Open a new authenticated SSH client (transport) to this host"""
+        client = paramiko.SSHClient()
         try:
-            self.client = paramiko.SSHClient()
-            
-            if strict_host_checking:
-                self.client.load_system_host_keys()
-                self.client.set_missing_host_key_policy(paramiko.RejectPolicy())
+            if self.strict_host_checking:
+                client.load_system_host_keys()
+                client.set_missing_host_key_policy(paramiko.RejectPolicy())
             else:
-                self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
             # Load private key
             if not self.private_key_path or not os.path.exists(self.private_key_path):
-                return False, f"Private key not found: {self.private_key_path}"
+                return None, f"Private key not found: {self.private_key_path}"
 
             pkey = None
             for key_class in [paramiko.RSAKey, paramiko.Ed25519Key, paramiko.ECDSAKey]:
@@ -50,9 +215,9 @@ class SSHConnection:
                     continue
 
             if pkey is None:
-                return False, "Failed to load private key (unsupported format or encrypted)"
+                return None, "Failed to load private key (unsupported format or encrypted)"
 
-            self.client.connect(
+            client.connect(
                 hostname=self.ip_address,
                 port=self.port,
                 username=self.user,
@@ -63,84 +228,307 @@ class SSHConnection:
             )
             
             # Prevent silent disconnections on idle connections
-            transport = self.client.get_transport()
+            transport = client.get_transport()
             if transport:
                 transport.set_keepalive(30)
-            
-            self.is_connected = True
-            self.last_used = utcnow()
-            logger.info(f"Connected to {self.name} ({self.ip_address}:{self.port})")
-            return True, "Connected successfully"
+            return client, "Connected successfully"
 
         except paramiko.AuthenticationException:
-            return False, "Authentication failed"
+            return None, "Authentication failed"
         except paramiko.SSHException as e:
-            return False, f"SSH error: {str(e)}"
+            return None, f"SSH error: {str(e)}"
         except Exception as e:
-            return False, f"Connection failed: {str(e)}"
+            return None, f"Connection failed: {str(e)}"
+
+    def connect(self, strict_host_checking: Optional[bool] = None) -> Tuple[bool, str]:
+        """Establish SSH connection (reconnects reuse the previous host key policy)"""
+        if strict_host_checking is not None:
+            self.strict_host_checking = strict_host_checking
+
+        client, message = self.open_client()
+        if not client:
+            return False, message
+
+        old_client, self.client = self.client, client
+        if old_client:
+            try:
+                old_client.close()
+            except Exception:
+                pass
+
+        self.is_connected = True
+        self.last_used = utcnow()
+        logger.info(f"Connected to {self.name} ({self.ip_address}:{self.port})")
+        return True, message
+
+    def transport_active(self) -> bool:
+        transport = self.client.get_transport() if self.client else None
+        return bool(transport and transport.is_active())
+
+    def probe(self) -> bool:
+        """Cheap liveness check: sends an SSH ignore message, no round trip"""
+        if not self.transport_active():
+            return False
+        try:
+            self.client.get_transport().send_ignore()
+            return True
+        except Exception:
+            return False
+
+    def in_backoff(self) -> bool:
+        return time.monotonic() < self.next_reconnect_at
+
+    def reconnect(self) -> Tuple[bool, str]:
+        """Re-establish a dropped transport; concurrent callers share one attempt"""
+        with self._reconnect_lock:
+            if self.transport_active():
+                return True, "Already connected"
+
+            success, message = self.connect()
+            if success:
+                self.reconnect_failures = 0
+                self.next_reconnect_at = 0.0
+            else:
+                self.reconnect_failures += 1
+                backoff = min(RECONNECT_MAX_BACKOFF, RECONNECT_BASE_BACKOFF * 2 ** (self.reconnect_failures - 1))
+                self.next_reconnect_at = time.monotonic() + backoff
+                logger.warning(f"Reconnect to {self.name} failed ({message}), retrying in {backoff}s")
+            return success, message
+
+    def state(self) -> Dict[str, Any]:
+        """Snapshot of connection health for the pool status API"""
+        return {
+            "name": self.name,
+            "connected": self.is_connected,
+            "transport_active": self.transport_active(),
+            "idle_seconds": int((utcnow() - self.last_used).total_seconds()),
+            "reconnect_failures": self.reconnect_failures,
+            "next_reconnect_in": max(0, int(self.next_reconnect_at - time.monotonic())),
+            "sessions": self.scheduler.stats()
+        }
+
+    def open_shell(self, term: str = "vt100", width: int = 80, height: int = 24) -> paramiko.Channel:
+        """Open an interactive shell channel; release it with close_shell()"""
+        if not self.is_connected or not self.client:
+            raise RuntimeError("Not connected")
+        transport = self.scheduler.acquire()
+        try:
+            channel = transport.open_session()
+            channel.get_pty(term, width, height)
+            channel.invoke_shell()
+            return channel
+        except Exception:
+            self.scheduler.release(transport)
+            raise
+
+    def close_shell(self, channel: paramiko.Channel):
+        """Close a shell opened with open_shell() and free its session slot"""
+        try:
+            channel.close()
+        finally:
+            self.scheduler.release(channel.get_transport())
 
     def execute_command(self, command: str, timeout: int = 30) -> Tuple[int, str, str]:
         """Execute command on remote host"""
+        exit_code, stdout, stderr, error = self.execute_captured(command, timeout)
+        return exit_code, stdout.text(), error or stderr.text()
+
+    def execute_captured(
+        self,
+        command: str,
+        timeout: int = 30,
+        max_bytes: Optional[int] = None,
+        spill: bool = False
+    ) -> Tuple[int, OutputCapture, OutputCapture, str]:
+        """Execute command keeping at most `max_bytes` of each stream in memory.
+
+        With `spill`, the complete stdout/stderr are also written to gzip files.
+        Returns (exit_code, stdout_capture, stderr_capture, error).
+        """
+        captures = {
+            stream: OutputCapture(max_bytes, new_spill_path(self.host_id, stream) if spill else None)
+            for stream in ("stdout", "stderr")
+        }
+        try:
+            exit_code, error = self.stream_command(
+                command, lambda stream, data: captures[stream].write(data), timeout
+            )
+        finally:
+            for capture in captures.values():
+                capture.close()
+        return exit_code, captures["stdout"], captures["stderr"], error
+
+    def stream_command(
+        self,
+        command: str,
+        on_output: Callable[[str, bytes], None],
+        timeout: int = 30
+    ) -> Tuple[int, str]:
+        """Execute command, passing stdout/stderr chunks to `on_output` as they arrive.
+
+        Returns (exit_code, error). `timeout` is an idle timeout: it is reset
+        whenever the remote side produces output.
+        """
         if not self.is_connected or not self.client:
-            return -1, "", "Not connected"
+            return -1, "Not connected"
 
         try:
-            transport = self.client.get_transport()
-            if transport and not transport.is_active():
-                success, msg = self.connect()
+            if not self.transport_active():
+                # The maintenance task retries failed hosts; don't stall fan-out on them
+                if self.in_backoff():
+                    return -1, "Host unreachable, reconnect pending"
+                success, msg = self.reconnect()
                 if not success:
-                    return -1, "", f"Reconnection failed: {msg}"
-                transport = self.client.get_transport()
+                    return -1, f"Reconnection failed: {msg}"
 
-            if not transport:
-                return -1, "", "No transport available"
+            with self.scheduler.slot() as transport:
+                return self._run_streaming(transport, command, on_output, timeout)
 
-            channel = transport.open_session()
-            channel.settimeout(timeout)
+        except Exception as e:
+            logger.error(f"Streaming command failed: {str(e)}")
+            return -1, str(e)
+
+    def _run_streaming(
+        self,
+        transport: paramiko.Transport,
+        command: str,
+        on_output: Callable[[str, bytes], None],
+        timeout: int
+    ) -> Tuple[int, str]:
+        channel = transport.open_session()
+        try:
             channel.exec_command(command)
 
-            stdout = channel.makefile('rb')
-            stderr = channel.makefile_stderr('rb')
+            deadline = time.monotonic() + timeout
+            while True:
+                received = False
+                if channel.recv_ready():
+                    on_output("stdout", channel.recv(32768))
+                    received = True
+                if channel.recv_stderr_ready():
+                    on_output("stderr", channel.recv_stderr(32768))
+                    received = True
+
+                if received:
+                    deadline = time.monotonic() + timeout
+                    continue
+                if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+                if time.monotonic() > deadline:
+                    return -1, f"Command timed out after {timeout}s without output"
+                if channel.eof_received:
+                    # The descriptor stays readable after EOF; the process may still be running
+                    channel.status_event.wait(max(0.0, deadline - time.monotonic()))
+                else:
+                    # Channel.fileno() is signalled on new data or EOF, so this sleeps until there is work
+                    select.select([channel], [], [], 0.5)
 
-            output = stdout.read().decode('utf-8', errors='replace')
-            error = stderr.read().decode('utf-8', errors='replace')
             exit_code = channel.recv_exit_status()
-
             self.last_used = utcnow()
-            return exit_code, output, error
-
-        except Exception as e:
-            logger.error(f"Command execution failed: {str(e)}")
-            return -1, "", str(e)
-
-    def upload_file(self, local_path: str, remote_path: str) -> Tuple[bool, str]:
-        """Upload file via SFTP"""
-        if not self.is_connected or not self.client:
-            return False, "Not connected"
-
+            return exit_code, ""
+        finally:
+            channel.close()
+
+    @contextmanager
+    def sftp_session(self) -> Iterator[paramiko.SFTPClient]:
+        """An SFTP session for this host; sessions that end cleanly are cached for the next transfer"""
+        sftp, transport = self._checkout_sftp()
+        reusable = False
+        try:
+            yield sftp
+            reusable = True
+        finally:
+            self._return_sftp(sftp, transport, reusable)
+
+    def _checkout_sftp(self) -> Tuple[paramiko.SFTPClient, paramiko.Transport]:
+        now = time.monotonic()
+        stale = []
+        found = None
+        with self._sftp_lock:
+            while self._sftp_idle and not found:
+                sftp, transport, idle_since = self._sftp_idle.pop()
+                if transport.is_active() and not sftp.get_channel().closed and now - idle_since < SFTP_IDLE_TIMEOUT:
+                    found = (sftp, transport)
+                else:
+                    stale.append((sftp, transport))
+        for sftp, transport in stale:
+            self._close_sftp(sftp, transport)
+        if found:
+            return found
+
+        transport = self.scheduler.acquire()
+        try:
+            return sftp_transfer.open_sftp(transport), transport
+        except Exception:
+            self.scheduler.release(transport)
+            raise
+
+    def _return_sftp(self, sftp: paramiko.SFTPClient, transport: paramiko.Transport, reusable: bool):
+        if reusable and transport.is_active() and not sftp.get_channel().closed:
+            with self._sftp_lock:
+                if len(self._sftp_idle) < SFTP_IDLE_SESSIONS:
+                    self._sftp_idle.append((sftp, transport, time.monotonic()))
+                    return
+        self._close_sftp(sftp, transport)
+
+    def _close_sftp(self, sftp: paramiko.SFTPClient, transport: paramiko.Transport):
         try:
-            sftp = self.client.open_sftp()
-            sftp.put(local_path, remote_path)
             sftp.close()
-            return True, "Upload successful"
-        except Exception as e:
-            return False, f"Upload failed: {str(e)}"
-
-    def download_file(self, remote_path: str, local_path: str) -> Tuple[bool, str]:
-        """Download file via SFTP"""
+        except Exception:
+            pass
+        self.scheduler.release(transport)
+
+    def close_idle_sftp(self, max_idle: float = 0) -> int:
+        """Close cached SFTP sessions idle for longer than `max_idle` seconds"""
+        now = time.monotonic()
+        with self._sftp_lock:
+            expired = [entry for entry in self._sftp_idle if now - entry[2] >= max_idle]
+            self._sftp_idle = [entry for entry in self._sftp_idle if now - entry[2] < max_idle]
+        for sftp, transport, _ in expired:
+            self._close_sftp(sftp, transport)
+        return len(expired)
+
+    def _transfer(self, kind: str, func: Callable, *args) -> Tuple[bool, str]:
+        """Run a transfer, reconnecting and resuming from the partial file after a failure"""
         if not self.is_connected or not self.client:
             return False, "Not connected"
 
-        try:
-            sftp = self.client.open_sftp()
-            sftp.get(remote_path, local_path)
-            sftp.close()
-            return True, "Download successful"
-        except Exception as e:
-            return False, f"Download failed: {str(e)}"
+        error = None
+        for attempt in range(max(1, SFTP_TRANSFER_ATTEMPTS)):
+            if attempt:
+                if not self.transport_active():
+                    success, message = self.reconnect()
+                    if not success:
+                        break
+                logger.warning(f"{kind} on {self.name} failed ({error}), resuming (attempt {attempt + 1})")
+            try:
+                with self.sftp_session() as sftp:
+                    result = func(sftp, *args)
+                self.last_used = utcnow()
+                message = f"{kind} successful"
+                if result["resumed_from"]:
+                    message += f" (resumed at byte {result['resumed_from']})"
+                return True, message
+            except (FileNotFoundError, PermissionError) as e:
+                # Missing file or directory, no access: retrying won't help
+                error = str(e)
+                break
+            except Exception as e:
+                error = str(e)
+        return False, f"{kind} failed: {error}"
+
+    def upload_file(self, local_path: str, remote_path: str) -> Tuple[bool, str]:
+        """Upload file via SFTP (pipelined, resumable)"""
+        return self._transfer("Upload", sftp_transfer.upload, local_path, remote_path)
+
+    def download_file(self, remote_path: str, local_path: str) -> Tuple[bool, str]:
+        """Download file via SFTP (prefetched, resumable)"""
+        return self._transfer("Download", sftp_transfer.download, remote_path, local_path)
 
     def disconnect(self):
         """Close SSH connection"""
+        self.close_idle_sftp()
+        self.scheduler.reset()
         if self.client:
             try:
                 self.client.close()
@@ -201,18 +589,37 @@ class ConnectionPool:
         """Get all connections"""
         return self._connections.copy()
 
-    def cleanup_idle(self, timeout_seconds: int = 3600):
-        """Remove idle connections"""
+    def cleanup_idle(self, timeout_seconds: int = 3600) -> List[int]:
+        """Remove idle connections, returning the reaped host IDs"""
         now = utcnow()
         with self._lock:
             to_remove = []
             for host_id, conn in self._connections.items():
+                if conn.scheduler.stats()["sessions_in_use"]:
+                    continue  # Open terminals/transfers don't touch last_used
                 if (now - conn.last_used).total_seconds() > timeout_seconds:
                     to_remove.append(host_id)
             
             for host_id in to_remove:
                 self._connections[host_id].disconnect()
                 del self._connections[host_id]
+        return to_remove
+
+    def close_idle_sftp(self, max_idle: float = SFTP_IDLE_TIMEOUT) -> int:
+        """Close cached SFTP sessions idle for too long, freeing their session slots"""
+        return sum(conn.close_idle_sftp(max_idle) for conn in self.get_all_connections().values())
+
+    def find_dead(self) -> List[SSHConnection]:
+        """Probe every transport and return connections that have dropped"""
+        return [conn for conn in self.get_all_connections().values() if not conn.probe()]
+
+    def get_state(self) -> Dict[int, Dict[str, Any]]:
+        """Per-host connection health"""
+        return {host_id: conn.state() for host_id, conn in self.get_all_connections().items()}
+
+    def connected_count(self) -> int:
+        with self._lock:
+            return sum(1 for conn in self._connections.values() if conn.is_connected)
 
 
 # Global connection pool
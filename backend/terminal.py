@@ -0,0 +1,343 @@
+"""Interactive shells: event-driven channel bridge and detachable sessions
+
+A paramiko channel's fileno() becomes readable whenever the transport thread
+buffers data for it. ShellBridge registers that descriptor with the event
+loop, so an idle terminal costs nothing and output is picked up as soon as it
+arrives instead of on the next 50 ms poll. The readiness callback only drains
+paramiko's in-memory buffer (recv is called only when data is ready, so it
+never blocks); writes, which can block on a full SSH window, go through the
+interactive executor lane. Event loops that cannot watch descriptors (the
+Proactor loop uvicorn uses on Windows) get a reader thread per shell instead.
+
+TerminalSession keeps a shell alive independently of the WebSocket that
+opened it. Output is fanned out to every attached viewer and kept in a
+scrollback ring buffer that is replayed on (re)attach; a session with no
+viewers is closed after TERMINAL_DETACH_GRACE seconds.
+"""
+import asyncio
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import paramiko
+
+from executors import run_interactive
+
+logger = logging.getLogger(__name__)
+
+# Extra wait (ms) before sending bulk output, so a burst goes out as one frame
+TERMINAL_COALESCE_MS = float(os.getenv("TERMINAL_COALESCE_MS", "2"))
+# Output smaller than this (keystroke echo) is sent without waiting
+COALESCE_MIN_BYTES = 1024
+MAX_FRAME_BYTES = 64 * 1024
+# Stop draining the channel above this many unsent bytes; the SSH window then
+# fills up and the remote side pauses
+READ_BUFFER_LIMIT = 1024 * 1024
+# Seconds a shell survives with no viewer attached (0 closes it on disconnect)
+TERMINAL_DETACH_GRACE = int(os.getenv("TERMINAL_DETACH_GRACE", "300"))
+TERMINAL_SCROLLBACK_BYTES = int(os.getenv("TERMINAL_SCROLLBACK_BYTES", str(256 * 1024)))
+# Frames a viewer may fall behind before it is dropped (it can reattach)
+VIEWER_QUEUE_FRAMES = 256
+
+
+class ShellBridge:
+    """Reads a shell channel on loop readiness events and hands out coalesced chunks"""
+
+    def __init__(self, channel: paramiko.Channel):
+        self.channel = channel
+        self._loop = asyncio.get_running_loop()
+        self._fd = channel.fileno()
+        self._buffer = bytearray()
+        self._ready = asyncio.Event()
+        self._eof = False
+        self._reading = False
+        # Thread fallback: set while the reader thread may add to the buffer
+        self._room = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._resume_reading()
+
+    def _resume_reading(self):
+        if self._eof:
+            return
+        if self._thread:
+            self._room.set()
+        elif not self._reading:
+            try:
+                self._loop.add_reader(self._fd, self._on_readable)
+            except NotImplementedError:
+                self._room.set()
+                self._thread = threading.Thread(
+                    target=self._read_in_thread, name=f"shell-reader-{self._fd}", daemon=True
+                )
+                self._thread.start()
+                return
+            self._reading = True
+
+    def _pause_reading(self):
+        if self._thread:
+            self._room.clear()
+        elif self._reading:
+            self._loop.remove_reader(self._fd)
+            self._reading = False
+
+    def _on_readable(self):
+        channel = self.channel
+        try:
+            while len(self._buffer) < READ_BUFFER_LIMIT:
+                if channel.recv_ready():
+                    self._buffer += channel.recv(MAX_FRAME_BYTES)
+                elif channel.recv_stderr_ready():
+                    self._buffer += channel.recv_stderr(MAX_FRAME_BYTES)
+                else:
+                    break
+            else:
+                self._pause_reading()
+                self._ready.set()
+                return
+            # The descriptor stays readable forever once the channel is done
+            if channel.eof_received or channel.closed:
+                self._finish()
+        except Exception as e:
+            logger.error(f"Shell read failed: {e}")
+            self._finish()
+        self._ready.set()
+
+    def _read_in_thread(self):
+        """Blocking reads for loops without add_reader; recv returns b"" once the channel closes"""
+        channel = self.channel
+        try:
+            while self._room.wait() and not self._eof:
+                data = channel.recv(MAX_FRAME_BYTES)
+                if channel.recv_stderr_ready():
+                    data += channel.recv_stderr(MAX_FRAME_BYTES)
+                if not data:
+                    break
+                # One chunk in flight; the loop reopens the window if the buffer has room
+                self._room.clear()
+                self._loop.call_soon_threadsafe(self._on_thread_data, data)
+        except Exception as e:
+            logger.error(f"Shell read failed: {e}")
+        try:
+            self._loop.call_soon_threadsafe(self._on_thread_data, b"")
+        except RuntimeError:
+            pass  # Event loop already closed
+
+    def _on_thread_data(self, data: bytes):
+        if data:
+            self._buffer += data
+            if len(self._buffer) < READ_BUFFER_LIMIT:
+                self._resume_reading()
+        else:
+            self._finish()
+        self._ready.set()
+
+    def _finish(self):
+        self._pause_reading()
+        self._eof = True
+        # Let a paused reader thread run into the closed channel and exit
+        self._room.set()
+
+    async def read(self) -> bytes:
+        """Next chunk of output (at most MAX_FRAME_BYTES); b"" once the shell has exited"""
+        while not self._buffer:
+            if self._eof:
+                return b""
+            self._ready.clear()
+            await self._ready.wait()
+
+        if TERMINAL_COALESCE_MS > 0 and len(self._buffer) >= COALESCE_MIN_BYTES and not self._eof:
+            await asyncio.sleep(TERMINAL_COALESCE_MS / 1000)
+
+        data = bytes(self._buffer[:MAX_FRAME_BYTES])
+        del self._buffer[:MAX_FRAME_BYTES]
+        if len(self._buffer) < READ_BUFFER_LIMIT:
+            self._resume_reading()
+        return data
+
+    async def write(self, data: bytes):
+        if data:
+            await run_interactive(self.channel.sendall, data)
+
+    async def resize(self, cols: int, rows: int):
+        await run_interactive(self.channel.resize_pty, cols, rows)
+
+    def close(self):
+        """Stop watching the channel (closing it is up to the owner)"""
+        self._finish()
+        self._ready.set()
+
+    @property
+    def closed(self) -> bool:
+        return self._eof and not self._buffer
+
+
+class TerminalSession:
+    """A shell that outlives WebSocket connections; viewers attach and detach"""
+
+    def __init__(self, session_id: str, host_id: int, conn, channel: paramiko.Channel,
+                 username: Optional[str], recording=None, on_close=None):
+        self.id = session_id
+        self.host_id = host_id
+        self.conn = conn
+        self.channel = channel
+        self.username = username
+        self.recording = recording
+        self.created_at = datetime.now(timezone.utc)
+        self.bridge = ShellBridge(channel)
+        self.scrollback = bytearray()
+        self.viewers: List[asyncio.Queue] = []
+        self.closed = False
+        # The creator attaches right away; the grace period starts when the last viewer leaves
+        self.detached_at: Optional[float] = None
+        self._on_close = on_close
+        self._reaper: Optional[asyncio.TimerHandle] = None
+        self._close_task: Optional[asyncio.Task] = None
+        self._pump = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                data = await self.bridge.read()
+                if not data:
+                    break
+                self._append_scrollback(data)
+                if self.recording:
+                    self.recording.output(data)
+                for queue in list(self.viewers):
+                    try:
+                        queue.put_nowait(data)
+                    except asyncio.QueueFull:
+                        logger.warning(f"Terminal session {self.id}: dropping a viewer that fell behind")
+                        self.viewers.remove(queue)
+                        self._end_viewer(queue)
+        finally:
+            if not self.closed:
+                self._close_later()
+
+    def _append_scrollback(self, data: bytes):
+        self.scrollback += data
+        excess = len(self.scrollback) - TERMINAL_SCROLLBACK_BYTES
+        if excess > 0:
+            # Cut at a line start so replay doesn't begin inside an escape sequence
+            newline = self.scrollback.find(b"\n", excess, excess + 4096)
+            del self.scrollback[:newline + 1 if newline >= 0 else excess]
+
+    @staticmethod
+    def _end_viewer(queue: asyncio.Queue):
+        """Queue the end-of-stream marker, discarding output if the queue is full"""
+        while True:
+            try:
+                queue.put_nowait(None)
+                return
+            except asyncio.QueueFull:
+                queue.get_nowait()
+
+    def attach(self) -> Tuple[asyncio.Queue, bytes]:
+        """Register a viewer; returns its output queue (None marks the end) and the scrollback"""
+        queue = asyncio.Queue(VIEWER_QUEUE_FRAMES)
+        if self.closed:
+            self._end_viewer(queue)
+            return queue, bytes(self.scrollback)
+        self.viewers.append(queue)
+        self.detached_at = None
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+        return queue, bytes(self.scrollback)
+
+    def detach(self, queue: asyncio.Queue):
+        if queue in self.viewers:
+            self.viewers.remove(queue)
+        if not self.viewers and not self.closed and self.detached_at is None:
+            self.detached_at = time.monotonic()
+            self._schedule_reap()
+
+    def _schedule_reap(self):
+        self._reaper = asyncio.get_running_loop().call_later(TERMINAL_DETACH_GRACE, self._close_later)
+
+    def _close_later(self):
+        if self._close_task is None:
+            self._close_task = asyncio.create_task(self.close())
+
+    async def write(self, data: bytes):
+        if self.recording:
+            self.recording.input(data)
+        await self.bridge.write(data)
+
+    async def resize(self, cols: int, rows: int):
+        if self.recording:
+            self.recording.resize(cols, rows)
+        await self.bridge.resize(cols, rows)
+
+    async def close(self):
+        """End the shell and tell every viewer; safe to call more than once"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._reaper:
+            self._reaper.cancel()
+        self.bridge.close()
+        if self._pump is not asyncio.current_task():
+            self._pump.cancel()
+        for queue in self.viewers:
+            self._end_viewer(queue)
+        self.viewers.clear()
+        if self.recording:
+            self.recording.close()
+        try:
+            await run_interactive(self.conn.close_shell, self.channel)
+        except Exception:
+            pass
+        if self._on_close:
+            self._on_close(self)
+        logger.info(f"Terminal session {self.id} on host {self.host_id} closed")
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.id,
+            "host_id": self.host_id,
+            "username": self.username,
+            "created_at": self.created_at.isoformat(),
+            "viewers": len(self.viewers),
+            "detached_seconds": round(time.monotonic() - self.detached_at, 1) if self.detached_at else None,
+            "scrollback_bytes": len(self.scrollback),
+            "recording_id": self.recording.id if self.recording else None
+        }
+
+
+class TerminalSessionManager:
+    """Live terminal sessions by ID (event-loop only)"""
+
+    def __init__(self):
+        self._sessions: Dict[str, TerminalSession] = {}
+
+    async def create(self, host_id: int, conn, username: Optional[str], recording_writer=None) -> TerminalSession:
+        channel = await run_interactive(conn.open_shell)
+        recording = None
+        if recording_writer:
+            recording = await recording_writer.open(host_id, conn.name, username)
+        session = TerminalSession(
+            secrets.token_urlsafe(16), host_id, conn, channel, username, recording, on_close=self._remove
+        )
+        self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id: Optional[str]) -> Optional[TerminalSession]:
+        session = self._sessions.get(session_id) if session_id else None
+        return session if session and not session.closed else None
+
+    def list(self) -> List[TerminalSession]:
+        return list(self._sessions.values())
+
+    def _remove(self, session: TerminalSession):
+        self._sessions.pop(session.id, None)
+
+    async def close_all(self):
+        await asyncio.gather(*(s.close() for s in list(self._sessions.values())), return_exceptions=True)
+
+
+sessions = TerminalSessionManager()
@@ -0,0 +1,254 @@
+"""Streaming file push to many hosts
+
+The multipart request body is parsed as it arrives and every chunk of the file
+part is handed to one SFTP writer per host, so a large artifact is never held
+in memory or spooled to disk, and hosts start receiving it while the browser
+is still uploading. Each host may have at most PUSH_WINDOW_CHUNKS chunks
+queued; when the slowest host's window is full the request body is not read
+further, which pushes back on the client.
+"""
+import asyncio
+import logging
+import os
+import queue
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import paramiko
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import ClientDisconnect, Request
+
+import executors
+from sftp_transfer import PART_SUFFIX, replace_remote, write_pipelined
+from ssh_manager import pool
+
+logger = logging.getLogger(__name__)
+
+# Chunks queued per host before the upload is throttled (chunks are shared,
+# so memory is bounded by roughly window x request chunk size)
+PUSH_WINDOW_CHUNKS = int(os.getenv("PUSH_WINDOW_CHUNKS", "64"))
+# Form fields sent before the file part (host_ids, remote_path) are small
+MAX_FIELD_BYTES = 64 * 1024
+
+_END = object()
+_ABORT = object()
+
+active_pushes: Dict[str, "FanOutPush"] = {}
+
+
+class _HostWriter:
+    """Writes the stream to one host from a batch-lane thread"""
+
+    def __init__(self, host_id: int, remote_path: str, loop: asyncio.AbstractEventLoop):
+        self.host_id = host_id
+        self.remote_path = remote_path
+        self.status = "pending"  # pending, writing, done, failed
+        self.message = ""
+        self.bytes = 0
+        self.failed = False
+        self.window = asyncio.Semaphore(PUSH_WINDOW_CHUNKS)
+        self._queue: "queue.Queue" = queue.Queue()
+        self._loop = loop
+        self.future: Optional[asyncio.Future] = None
+
+    def start(self):
+        conn = pool.get_connection(self.host_id)
+        if not conn or not conn.is_connected:
+            self._fail("Not connected")
+            return
+        self.future = asyncio.wrap_future(executors.batch.submit(self._run, conn))
+
+    async def put(self, chunk: bytes):
+        if self.failed:
+            return
+        await self.window.acquire()
+        if not self.failed:
+            self._queue.put_nowait(chunk)
+
+    def finish(self, abort: bool = False):
+        self._queue.put_nowait(_ABORT if abort else _END)
+
+    def _fail(self, message: str):
+        self.failed = True
+        self.status = "failed"
+        self.message = message
+
+    def _run(self, conn):
+        try:
+            with conn.sftp_session() as sftp:
+                self._write(sftp)
+        except Exception as e:
+            self._fail(f"Upload failed: {str(e)}")
+            # Wake the feeder if it is waiting for this host's window
+            self._loop.call_soon_threadsafe(self.window.release)
+
+    def _write(self, sftp: paramiko.SFTPClient):
+        aborted = False
+        # Written under a temporary name and renamed once complete
+        part = self.remote_path + PART_SUFFIX
+        with sftp.open(part, "wb") as f:
+            # Don't wait for an acknowledgement per write; errors surface in a later write or on close
+            f.set_pipelined(True)
+            self.status = "writing"
+            while True:
+                chunk = self._queue.get()
+                if chunk is _END:
+                    break
+                if chunk is _ABORT:
+                    aborted = True
+                    break
+                write_pipelined(f, chunk)
+                self.bytes += len(chunk)
+                self._loop.call_soon_threadsafe(self.window.release)
+
+        if aborted:
+            try:
+                sftp.remove(part)
+            except IOError:
+                pass
+            raise RuntimeError("upload aborted by client")
+        replace_remote(sftp, part, self.remote_path)
+        self.status = "done"
+        self.message = "Upload successful"
+
+    def result(self) -> Dict[str, Any]:
+        return {"success": self.status == "done", "message": self.message, "bytes": self.bytes}
+
+
+class FanOutPush:
+    """One multipart upload streamed to several hosts"""
+
+    def __init__(self, transfer_id: str, host_ids: List[int], remote_path: Optional[str]):
+        self.id = transfer_id
+        self.host_ids = host_ids
+        self.remote_path = remote_path
+        self.filename: Optional[str] = None
+        self.received = 0
+        self.started_at = time.time()
+        self.writers: Dict[int, _HostWriter] = {}
+
+    def _start_writers(self):
+        loop = asyncio.get_running_loop()
+        for host_id in dict.fromkeys(self.host_ids):
+            writer = _HostWriter(host_id, self.remote_path, loop)
+            writer.start()
+            self.writers[host_id] = writer
+
+    async def _feed(self, chunk: bytes):
+        self.received += len(chunk)
+        for writer in self.writers.values():
+            await writer.put(chunk)
+
+    async def run(self, request: Request) -> Dict[int, Dict[str, Any]]:
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise ValueError("Expected a multipart/form-data upload")
+
+        # Parser callbacks are synchronous; they queue events handled after each write
+        events: List[tuple] = []
+        headers: Dict[bytes, bytes] = {}
+        field = bytearray()
+
+        def on_header_field(data, start, end):
+            events.append(("header_field", bytes(data[start:end])))
+
+        def on_header_value(data, start, end):
+            events.append(("header_value", bytes(data[start:end])))
+
+        def on_part_data(data, start, end):
+            events.append(("data", bytes(data[start:end])))
+
+        callbacks = {
+            "on_part_begin": lambda: events.append(("begin",)),
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_headers_finished": lambda: events.append(("headers_finished",)),
+            "on_part_data": on_part_data,
+            "on_part_end": lambda: events.append(("end",)),
+        }
+        parser = MultipartParser(params[b"boundary"], callbacks)
+
+        header_field = b""
+        part_name = None
+        in_file = False
+        file_done = False
+        try:
+            async for body in request.stream():
+                parser.write(body)
+                for event in events:
+                    kind = event[0]
+                    if kind == "begin":
+                        headers.clear()
+                        field.clear()
+                    elif kind == "header_field":
+                        header_field = event[1].lower()
+                    elif kind == "header_value":
+                        headers[header_field] = headers.get(header_field, b"") + event[1]
+                    elif kind == "headers_finished":
+                        _, disposition = parse_options_header(headers.get(b"content-disposition", b""))
+                        part_name = disposition.get(b"name", b"").decode()
+                        in_file = b"filename" in disposition and not file_done
+                        if in_file:
+                            self.filename = disposition[b"filename"].decode(errors="replace")
+                            if not self.host_ids or not self.remote_path:
+                                raise ValueError("host_ids and remote_path must be sent before the file")
+                            self._start_writers()
+                    elif kind == "data":
+                        if in_file:
+                            await self._feed(event[1])
+                        else:
+                            field.extend(event[1])
+                            if len(field) > MAX_FIELD_BYTES:
+                                raise ValueError(f"Form field {part_name} is too large")
+                    elif kind == "end":
+                        if in_file:
+                            in_file = False
+                            file_done = True
+                        elif part_name == "host_ids":
+                            self.host_ids.append(int(field.decode()))
+                        elif part_name == "remote_path":
+                            self.remote_path = field.decode()
+                events.clear()
+            parser.finalize()
+        except BaseException as e:
+            # Client went away, bad form or cancellation: don't leave partial files behind
+            for writer in self.writers.values():
+                writer.finish(abort=True)
+            if isinstance(e, ClientDisconnect):
+                logger.warning(f"Push {self.id} aborted: client disconnected after {self.received} bytes")
+            raise
+
+        if not file_done:
+            raise ValueError("No file in upload")
+
+        for writer in self.writers.values():
+            writer.finish()
+        await asyncio.gather(*(w.future for w in self.writers.values() if w.future), return_exceptions=True)
+        return {host_id: writer.result() for host_id, writer in self.writers.items()}
+
+    def progress(self) -> Dict[str, Any]:
+        return {
+            "transfer_id": self.id,
+            "filename": self.filename,
+            "remote_path": self.remote_path,
+            "received_bytes": self.received,
+            "elapsed": round(time.time() - self.started_at, 1),
+            "hosts": {
+                host_id: {"status": w.status, "bytes": w.bytes, "message": w.message}
+                for host_id, w in self.writers.items()
+            }
+        }
+
+
+async def stream_push(request: Request, host_ids: Optional[List[int]], remote_path: Optional[str],
+                      transfer_id: Optional[str] = None) -> Dict[int, Dict[str, Any]]:
+    """Stream the request's file part to every host; raises ValueError for a malformed upload"""
+    push = FanOutPush(transfer_id or uuid.uuid4().hex, list(host_ids or []), remote_path)
+    if push.id in active_pushes:
+        raise ValueError("Transfer ID already in use")
+    active_pushes[push.id] = push
+    try:
+        return await push.run(request)
+    finally:
+        del active_pushes[push.id]
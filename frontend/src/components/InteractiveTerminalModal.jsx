@@ -7,6 +7,7 @@ import '@xterm/xterm/css/xterm.css'
 function InteractiveTerminalModal({ host, onClose }) {
   const terminalRef = useRef(null)
   const wsRef = useRef(null)
+  const closeSessionRef = useRef(null)
   const termInstance = useRef(null)
   const [isFullscreen, setIsFullscreen] = useState(false)
   const [connecting, setConnecting] = useState(true)
@@ -46,61 +47,107 @@ function InteractiveTerminalModal({ host, onClose }) {
 
     termInstance.current = term
 
-    // Connect WebSocket
+    // Connect WebSocket. The shell outlives the socket: reconnects reattach by session ID
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
     const token = localStorage.getItem('neutron_token') || ''
-    const wsUrl = `${protocol}//${window.location.host}/ws/terminal/${host.id}${token ? `?token=${encodeURIComponent(token)}` : ''}`
-    const ws = new WebSocket(wsUrl)
-    wsRef.current = ws
-
-    ws.onopen = () => {
-      setConnecting(false)
-      if (ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({
+    const sessionKey = `neutron_terminal_session_${host.id}`
+    const encoder = new TextEncoder()
+    let ws = null
+    let finished = false
+    let retries = 0
+    let retryTimer = null
+
+    const connect = () => {
+      const params = new URLSearchParams()
+      if (token) params.set('token', token)
+      const sessionId = sessionStorage.getItem(sessionKey)
+      if (sessionId) params.set('session_id', sessionId)
+      ws = new WebSocket(`${protocol}//${window.location.host}/ws/terminal/${host.id}?${params}`)
+      ws.binaryType = 'arraybuffer'
+      wsRef.current = ws
+      const socket = ws
+
+      socket.onopen = () => {
+        setConnecting(false)
+        retries = 0
+        socket.send(JSON.stringify({
           type: 'resize',
           cols: term.cols,
           rows: term.rows
         }))
       }
-    }
 
-    ws.onmessage = (event) => {
-      try {
-        const msg = JSON.parse(event.data)
-        if (msg.error) {
-          setError(msg.error)
-          term.writeln(`\r\n\x1b[31mError: ${msg.error}\x1b[0m`)
-        } else if (msg.type === 'output') {
-          term.write(msg.data)
-        } else if (msg.type === 'connected') {
-          term.writeln(`\x1b[32mSuccessfully connected to ${host.name} interactive shell.\x1b[0m\r\n`)
+      socket.onmessage = (event) => {
+        // Shell output arrives as raw bytes; text frames are control messages
+        if (event.data instanceof ArrayBuffer) {
+          term.write(new Uint8Array(event.data))
+          return
+        }
+        try {
+          const msg = JSON.parse(event.data)
+          if (msg.error) {
+            // Don't keep retrying a session the server refused
+            sessionStorage.removeItem(sessionKey)
+            setError(msg.error)
+            term.writeln(`\r\n\x1b[31mError: ${msg.error}\x1b[0m`)
+          } else if (msg.type === 'output') {
+            term.write(msg.data)
+          } else if (msg.type === 'connected') {
+            sessionStorage.setItem(sessionKey, msg.session_id)
+            setError(null)
+            if (msg.reattached) {
+              // Scrollback follows and redraws the screen
+              term.reset()
+            } else {
+              term.writeln(`\x1b[32mSuccessfully connected to ${host.name} interactive shell.\x1b[0m\r\n`)
+            }
+          } else if (msg.type === 'exit') {
+            finished = true
+            sessionStorage.removeItem(sessionKey)
+          }
+        } catch (e) {
+          console.error('Failed to parse websocket message', e)
         }
-      } catch (e) {
-        console.error('Failed to parse websocket message', e)
       }
-    }
 
-    ws.onclose = () => {
-      term.writeln('\r\n\x1b[90mConnection closed.\x1b[0m')
-      setConnecting(false)
+      socket.onclose = () => {
+        if (socket !== wsRef.current) return
+        if (!finished && sessionStorage.getItem(sessionKey) && retries < 5) {
+          retries += 1
+          setConnecting(true)
+          retryTimer = setTimeout(connect, Math.min(250 * 2 ** (retries - 1), 8000))
+          return
+        }
+        term.writeln('\r\n\x1b[90mConnection closed.\x1b[0m')
+        setConnecting(false)
+      }
+
+      socket.onerror = () => {
+        setError('Connection failed')
+        setConnecting(false)
+      }
     }
+    connect()
 
-    ws.onerror = (e) => {
-      setError('Connection failed')
-      setConnecting(false)
+    closeSessionRef.current = () => {
+      finished = true
+      sessionStorage.removeItem(sessionKey)
+      if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({ type: 'close' }))
+      }
     }
 
     // Handle terminal input
     term.onData((data) => {
-      if (ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({ type: 'input', data }))
+      if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(encoder.encode(data))
       }
     })
 
     // Handle window resize
     const resizeObserver = new ResizeObserver(() => {
       fitAddon.fit()
-      if (ws.readyState === WebSocket.OPEN) {
+      if (ws && ws.readyState === WebSocket.OPEN) {
         ws.send(JSON.stringify({
           type: 'resize',
           cols: term.cols,
@@ -112,6 +159,8 @@ function InteractiveTerminalModal({ host, onClose }) {
 
     return () => {
       resizeObserver.disconnect()
+      clearTimeout(retryTimer)
+      wsRef.current = null
       if (ws.readyState === WebSocket.OPEN || ws.readyState === WebSocket.CONNECTING) {
         ws.close()
       }
@@ -133,6 +182,12 @@ function InteractiveTerminalModal({ host, onClose }) {
     }
   }, [isFullscreen])
 
+  // Closing the window ends the shell; a reload or dropped connection only detaches
+  const handleClose = () => {
+    if (closeSessionRef.current) closeSessionRef.current()
+    onClose()
+  }
+
   return (
     <div className="fixed inset-0 z-50 flex items-center justify-center p-4 bg-black/80 backdrop-blur-sm">
       <div 
@@ -159,7 +214,7 @@ function InteractiveTerminalModal({ host, onClose }) {
               {isFullscreen ? <Minimize2 className="w-4 h-4" /> : <Maximize2 className="w-4 h-4" />}
             </button>
             <button
-              onClick={onClose}
+              onClick={handleClose}
               className="p-2 text-gray-400 hover:text-white hover:bg-red-500/20 rounded-lg transition-colors"
               title="Close"
             >
@@ -174,7 +229,7 @@ function InteractiveTerminalModal({ host, onClose }) {
             <div className="mb-2 p-3 bg-red-500/10 border border-red-500/20 rounded text-red-400 text-sm flex justify-between items-center">
               <span>{error}</span>
               <button 
-                onClick={onClose}
+                onClick={handleClose}
                 className="px-3 py-1 bg-gray-800 hover:bg-gray-700 rounded transition-colors text-white"
               >
                 Close Window
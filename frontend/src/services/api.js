@@ -50,10 +50,11 @@ export const commands = {
 
 export const files = {
   push: (hostIds, remotePath, file) => {
+    // Targets must precede the file: the server streams the file part as it arrives
     const formData = new FormData()
-    formData.append('file', file)
     formData.append('remote_path', remotePath)
     hostIds.forEach(id => formData.append('host_ids', id))
+    formData.append('file', file)
     return api.post('/files/push', formData, {
       headers: { 'Content-Type': 'multipart/form-data' }
     })
@@ -72,11 +73,21 @@ export const playbooks = {
   create: (data) => api.post('/playbooks', data),
   delete: (id) => api.delete(`/playbooks/${id}`),
   execute: (playbookId) => api.post('/playbooks/execute', { playbook_id: playbookId }),
-  executeYaml: (hostIds, yamlContent) => api.post('/playbooks/execute-yaml', { host_ids: hostIds, yaml_content: yamlContent })
+  executeYaml: (hostIds, yamlContent) => api.post('/playbooks/execute-yaml', { host_ids: hostIds, yaml_content: yamlContent }),
+  createRun: (data) => api.post('/playbooks/runs', data),
+  getRun: (runId, after = 0) => api.get(`/playbooks/runs/${runId}`, { params: { after } }),
+  // WebSocket URL streaming a run's snapshot followed by live task events
+  progressUrl: (runId) => {
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
+    const token = localStorage.getItem('neutron_token')
+    return `${protocol}//${window.location.host}/ws/playbooks/runs/${runId}${token ? `?token=${encodeURIComponent(token)}` : ''}`
+  }
 }
 
 export const history = {
-  getAll: (limit = 50) => api.get('/history', { params: { limit } })
+  // Listing omits output; the next page's cursor comes back in the X-Next-Cursor header
+  getAll: (limit = 50, params = {}) => api.get('/history', { params: { limit, include_output: false, ...params } }),
+  get: (id) => api.get(`/history/${id}`)
 }
 
 export const dashboard = {